@@ -1,38 +1,180 @@
-from flask import Blueprint, request
-from sqlalchemy import and_, func, or_
+import base64
+import datetime
+import functools
+import gzip
+import hashlib
+import json
+import logging
+import re
+import time
+
+import redis
+from flask import (
+    Blueprint,
+    Response,
+    abort,
+    current_app,
+    g,
+    has_app_context,
+    request,
+    stream_with_context,
+    url_for,
+)
+from sqlalchemy import and_, event, func, or_
+from sqlalchemy.engine import Engine
 from sqlalchemy.orm import class_mapper
 
-from .models import Case, Court, Region, ScrapeLog, ScrapeSession, db
+from . import metrics
+from .cache import CASES, COURTS, SESSIONS, cached, data_version
+from .changes import acquire_stream, get_listener, release_stream
+from .diagnostics import (
+    PROFILE_COUNTERS,
+    PROFILE_STAGES,
+    court_profiles,
+    load_diagnostics,
+    load_profile,
+)
+from .export import EXPORT_FORMATS, export, gzip_stream
+from .models import Case, CaseArticle, Court, Region, ScrapeLog, ScrapeSession, db
+from .stats import DATE_FIELDS, query_stats, stat_labels
+from .store import get_store, key
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
 
 ITEMS_PER_PAGE = 50
 ALLOWED_ITEMS_PER_PAGE = (10, 25, 50, 75, 100)
 
+MONTH_PATTERN = re.compile(r"\d{4}-\d{2}")
+
+ARTICLE_FILTER_PATTERN = re.compile(
+    r"(?:ст\.?\s*)?(\d+(?:\.\d+)*)(\.?\*)?(?:\s*ч\.?\s*(\d+))?", re.I
+)
+
+logger = logging.getLogger(__name__)
+
+# Endpoints which need to see what got committed right now, a replica might
+# not have it yet
+PRIMARY_ENDPOINTS = ("api.changes",)
+
 api = Blueprint("api", __name__, url_prefix="/api")
 
 
-def cursor_encode(cursor: int) -> str:
-    return str(cursor)
+@event.listens_for(Engine, "before_cursor_execute")
+def count_query(*args):
+    # Count database queries of every API request
+    if has_app_context() and "query_count" in g:
+        g.query_count += 1
+
+
+@api.before_request
+def start_request():
+    g.request_started_at = time.monotonic()
+    g.query_count = 0
+    # Read from the read-only database if there is one
+    g.read_only = request.method == "GET" and request.endpoint not in PRIMARY_ENDPOINTS
+
+
+@api.after_request
+def record_request(response):
+    metrics.observe(
+        "api_request_seconds",
+        time.monotonic() - g.request_started_at,
+        endpoint=request.endpoint,
+        status=response.status_code,
+    )
+    metrics.observe("api_request_queries", g.query_count, endpoint=request.endpoint)
+    return response
+
+
+@api.after_request
+def compress_response(response):
+    # Compress larger JSON responses with brotli or gzip, whatever the client
+    # accepts. Streamed responses (exports, changes) take care of themselves
+    if (
+        response.status_code != 200
+        or response.direct_passthrough
+        or response.is_streamed
+        or response.mimetype != "application/json"
+        or "Content-Encoding" in response.headers
+    ):
+        return response
+    response.vary.add("Accept-Encoding")
+    data = response.get_data()
+    if len(data) < current_app.config["API_COMPRESS_MIN_BYTES"]:
+        return response
+    encodings = ["gzip"] if brotli is None else ["br", "gzip"]
+    encoding = request.accept_encodings.best_match(encodings)
+    if encoding is None:
+        return response
+    if encoding == "br":
+        data = brotli.compress(data, quality=5)
+    else:
+        data = gzip.compress(data, compresslevel=6)
+    response.set_data(data)
+    response.headers["Content-Encoding"] = encoding
+    # Compressed body is not the same bytes as the uncompressed one anymore
+    etag, is_weak = response.get_etag()
+    if etag is not None and not is_weak:
+        response.set_etag(etag, weak=True)
+    return response
+
+
+# Query arguments which don't change the listing itself
+PAGINATION_ARGS = ("before", "after", "itemsPerPage", "fields", "include")
+
+
+# Hash of the listing and its filters, cursors are only valid for the listing
+# they were created for. Listings returned by another endpoint pass the path
+# of their own endpoint, so their cursors work there and back again
+def filter_hash(path=None):
+    query = "&".join(
+        "{}={}".format(k, v)
+        for k, v in sorted(request.args.items(multi=True))
+        if k not in PAGINATION_ARGS
+    )
+    return hashlib.sha1(
+        "{}?{}".format(path or request.path, query).encode("utf-8")
+    ).hexdigest()[:16]
+
 
+# Cursors are opaque to clients and carry everything we need to seek to the
+# next page: sort value and id of the item and the hash of the filters
+def cursor_encode(value, id: int, path=None) -> str:
+    data = json.dumps([value, id, filter_hash(path)], separators=(",", ":"))
+    return base64.urlsafe_b64encode(data.encode("utf-8")).decode("ascii").rstrip("=")
 
-def cursor_decode(cursor: str) -> int:
-    return int(cursor)
 
+def cursor_decode(cursor: str, path=None):
+    data = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+    value, id, cursor_filter_hash = json.loads(data)
+    if value is not None and not isinstance(value, str):
+        raise ValueError("Invalid sort value")
+    if cursor_filter_hash != filter_hash(path):
+        raise ValueError("Cursor belongs to other filters")
+    return (value, int(id))
 
-def pagination_args(request):
+
+def pagination_args(request, path=None):
     before = request.args.get("before")
     after = request.args.get("after")
     if before is not None and after is not None:
         after = None
         before = None
+    # Invalid or stale cursors (filters changed) start at the first page
     if before is not None:
         try:
-            before = cursor_decode(before)
+            before = cursor_decode(before, path)
         except Exception:
+            metrics.incr("api_invalid_cursors_total", endpoint=request.endpoint)
             before = None
     if after is not None:
         try:
-            after = cursor_decode(after)
+            after = cursor_decode(after, path)
         except Exception:
+            metrics.incr("api_invalid_cursors_total", endpoint=request.endpoint)
             after = None
     items_per_page = int(request.args.get("itemsPerPage", ITEMS_PER_PAGE))
     if items_per_page not in ALLOWED_ITEMS_PER_PAGE:
@@ -40,7 +182,7 @@ def pagination_args(request):
     return (before, after, items_per_page)
 
 
-def paginated_response(items, before, after, items_per_page, total_items):
+def paginated_response(items, cursors, before, after, items_per_page, total_items):
     has_next_page = False
     has_previous_page = False
     if after is None and before is None:
@@ -51,7 +193,14 @@ def paginated_response(items, before, after, items_per_page, total_items):
     elif before is not None:
         has_next_page = True
         has_previous_page = len(items) == items_per_page + 1
-    items = items[0:items_per_page]
+
+    # Paginating backwards, the additional item is in front of the page
+    if before is not None:
+        items = items[-items_per_page:]
+        cursors = cursors[-items_per_page:]
+    else:
+        items = items[0:items_per_page]
+        cursors = cursors[0:items_per_page]
 
     return {
         "pagination": {
@@ -59,98 +208,247 @@ def paginated_response(items, before, after, items_per_page, total_items):
             "totalItems": total_items,
             "hasNextPage": has_next_page,
             "hasPreviousPage": has_previous_page,
-            # previous cursor is id of first item in this page
-            "startCursor": None if len(items) == 0 else cursor_encode(items[0]["id"]),
-            # next cursor is id of last item in this page
-            "endCursor": None if len(items) == 0 else cursor_encode(items[-1]["id"]),
+            # previous cursor points at the first item in this page
+            "startCursor": None if len(items) == 0 else cursors[0],
+            # next cursor points at the last item in this page
+            "endCursor": None if len(items) == 0 else cursors[-1],
         },
         "items": items,
     }
 
 
+@functools.lru_cache(maxsize=None)
+def column_keys(model_class):
+    return [c.key for c in class_mapper(model_class).columns]
+
+
 # Convert database results to format which can be serialized to JSON
-def serialize(model):
-    columns = [c.key for c in class_mapper(model.__class__).columns]
-    result = dict((c, getattr(model, c)) for c in columns)
+def serialize(model, exclude=()):
+    result = dict(
+        (c, getattr(model, c)) for c in column_keys(model.__class__) if c not in exclude
+    )
     result["created_at"] = model.created_at.isoformat()
     result["updated_at"] = model.updated_at.isoformat()
     return result
 
 
-def prepare_case(item):
-    case_dict = serialize(item)
+# Related objects which can be side-loaded, with the key they are listed
+# under in the response
+INCLUDES = {"case": "cases", "court": "courts", "region": "regions"}
+
+
+class Representation:
+    # How a client wants the items of a response: only with some of their
+    # fields ("fields") and with related cases, courts and regions listed
+    # once next to the items ("include") instead of within every item
+
+    def __init__(self, fields=None, include=None):
+        self.fields = None if fields is None else set(fields) | {"id"}
+        self.include = None if include is None else set(include)
+        self.included = {INCLUDES[name]: {} for name in self.include or ()}
+
+    @classmethod
+    def from_args(cls, args):
+        fields = args.get("fields")
+        if fields is not None:
+            fields = [field.strip() for field in fields.split(",") if field.strip()]
+        include = args.get("include")
+        if include is not None:
+            include = [name.strip() for name in include.split(",") if name.strip()]
+            for name in include:
+                if name not in INCLUDES:
+                    abort(400, "Unknown include '{}'".format(name))
+        return cls(fields, include)
+
+    def relate(self, item_dict, name, related, prepare):
+        # Embed related object, or only refer to it and side-load it
+        if self.include is None:
+            item_dict[name] = None if related is None else prepare(related)
+            return
+        item_dict["{}_id".format(name)] = None if related is None else related.id
+        if related is not None and name in self.include:
+            objects = self.included[INCLUDES[name]]
+            if related.id not in objects:
+                objects[related.id] = prepare(related)
+
+    def select(self, item_dict):
+        if self.fields is None:
+            return item_dict
+        return {k: v for k, v in item_dict.items() if k in self.fields}
+
+    def respond(self, body):
+        if self.include is not None:
+            body["included"] = self.included
+        return body
+
+
+def prepare_court(item):
+    return serialize(item)
+
+
+def prepare_region(item):
+    return serialize(item)
+
+
+def prepare_case(item, representation=None):
+    representation = representation or Representation()
+    case_dict = serialize(item, exclude=("fingerprint", "articles_parsed"))
     if item.entry_date is not None:
         case_dict["entry_date"] = item.entry_date.isoformat()
     if item.result_date is not None:
         case_dict["result_date"] = item.result_date.isoformat()
     if item.effective_date is not None:
         case_dict["effective_date"] = item.effective_date.isoformat()
-    if item.court is not None:
-        case_dict["court"] = serialize(item.court)
-        case_dict["region"] = serialize(item.court.region)
-    else:
-        case_dict["court"] = None
-        case_dict["region"] = None
+    court = item.court
+    representation.relate(case_dict, "court", court, prepare_court)
+    representation.relate(
+        case_dict, "region", None if court is None else court.region, prepare_region
+    )
     return case_dict
 
 
+def prepare_log(item, representation=None):
+    representation = representation or Representation()
+    item_dict = serialize(item)
+    representation.relate(
+        item_dict,
+        "case",
+        item.case,
+        lambda case: prepare_case(case, representation),
+    )
+    return item_dict
+
+
+# Count items of a listing once per version of the data, instead of with
+# every page
+def count_items(query, path=None):
+    count_query = query.subquery()
+    count_query = db.select(func.count(count_query.c.id))
+    if not current_app.config["API_CACHE_ENABLED"]:
+        return db.session.execute(count_query).scalar()
+
+    store = get_store()
+    try:
+        version, _ = data_version((CASES, SESSIONS, COURTS))
+        cache_key = key("api-count", filter_hash(path), version)
+        total_items = store.get(cache_key)
+    except redis.RedisError as err:
+        logger.warning("Could not read cached count: {}".format(err))
+        return db.session.execute(count_query).scalar()
+    if total_items is not None:
+        return int(total_items)
+
+    total_items = db.session.execute(count_query).scalar()
+    try:
+        store.set(cache_key, total_items, ex=current_app.config["API_CACHE_TTL_SEC"])
+    except redis.RedisError as err:
+        logger.warning("Could not cache count: {}".format(err))
+    return total_items
+
+
+# Items are ordered by the given column and their id, both descending, with
+# empty values last (like SQLite sorts them). Pages are found by comparing
+# with the values of the cursor, which can use an index on (column, id)
+# instead of skipping over all previous items
 def execute_cursor_pagination(
-    before, after, items_per_page, base, id, col, query, filter
+    before, after, items_per_page, base, id, col, query, filter, path=None
 ):
     # Retrieve total number of items
-    count_query = query.where(*filter).subquery()
-    total_items = db.session.execute(db.select(func.count(count_query.c.id))).scalar()
+    total_items = count_items(query.where(*filter), path)
 
-    # Prepare filter for cursor paginated query with multiple order by fields
+    # Sort values are compared the way the database stores them, dates
+    # converted to Python and back might not be equal anymore
+    sort_value = db.cast(col, db.String).label("sort_value")
+    query = query.add_columns(sort_value)
+    stored_col = db.type_coerce(col, db.String)
+
+    # Every part is a condition with an ordering, the next part is only
+    # queried when the page is not full yet
     if after is not None:
-        subquery = db.select(col).where(id == after).scalar_subquery()
-        filter.append(
-            and_(
-                or_(
-                    col < subquery,
-                    and_(
-                        col == subquery,
-                        id > after,
-                    ),
+        value, after_id = after
+        if value is not None:
+            parts = [
+                (
+                    db.tuple_(stored_col, id) < (value, after_id),
+                    (col.desc(), id.desc()),
                 ),
-            )
-        )
+                (col.is_(None), (id.desc(),)),
+            ]
+        else:
+            parts = [(and_(col.is_(None), id < after_id), (id.desc(),))]
     elif before is not None:
-        subquery = db.select(col).where(id == before).scalar_subquery()
-        filter.append(
-            and_(
-                or_(
-                    col > subquery,
-                    and_(
-                        col == subquery,
-                        id < before,
-                    ),
-                ),
-            )
-        )
-
-    # Base query for all pagination cases
-    query = query.where(*filter)
-
-    # Change ordering if we're paginating forwards or backwards
-    if before is not None:
-        query = query.order_by(col.asc(), id.desc())
+        value, before_id = before
+        if value is not None:
+            parts = [
+                (
+                    db.tuple_(stored_col, id) > (value, before_id),
+                    (col.asc(), id.asc()),
+                )
+            ]
+        else:
+            parts = [
+                (and_(col.is_(None), id > before_id), (id.asc(),)),
+                (col.isnot(None), (col.asc(), id.asc())),
+            ]
     else:
-        query = query.order_by(col.desc(), id.asc())
-
-    # Always limit result
-    query = query.limit(items_per_page + 1)
-
-    # Wrap in a subquery and reverse ordering if we're paginating backwards
+        parts = [(None, (col.desc(), id.desc()))]
+
+    rows = []
+    for condition, order in parts:
+        part_query = query.where(*filter)
+        if condition is not None:
+            part_query = part_query.where(condition)
+        part_query = part_query.order_by(*order).limit(items_per_page + 1 - len(rows))
+        rows.extend(db.session.execute(part_query).all())
+        if len(rows) > items_per_page:
+            break
+
+    # Paginating backwards we've found the items in reverse order
     if before is not None:
-        subquery = query.subquery()
-        alias = db.aliased(base, subquery)
-        query = db.select(alias).order_by(
-            alias.__getattr__(col.key).desc(), alias.__getattr__(id.key).asc()
-        )
+        rows.reverse()
 
     # Finally process the results
-    return (db.session.execute(query).scalars().all(), total_items)
+    items = [row[0] for row in rows]
+    cursors = [cursor_encode(row[1], row[0].id, path) for row in rows]
+    return (items, total_items, cursors)
+
+
+def batch_ids(args):
+    try:
+        ids = [int(id) for id in args.getlist("id")]
+    except ValueError:
+        abort(400, "Invalid id")
+    # Keep the order of the request, without duplicates
+    ids = list(dict.fromkeys(ids))
+    if len(ids) > current_app.config["API_BATCH_MAX_IDS"]:
+        abort(
+            400,
+            "Too many ids, at most {} are allowed".format(
+                current_app.config["API_BATCH_MAX_IDS"]
+            ),
+        )
+    return ids
+
+
+# Look up items by their "id" query arguments in one query on the primary key,
+# without counting or paginating them. Items are returned in the order of the
+# ids, unknown ids are left out
+def execute_batch(base, query, prepare):
+    representation = Representation.from_args(request.args)
+    ids = batch_ids(request.args)
+    items = {}
+    if len(ids) > 0:
+        query = query.where(base.id.in_(ids))
+        items = {item.id: item for item in db.session.execute(query).scalars()}
+    return representation.respond(
+        {
+            "items": [
+                representation.select(prepare(items[id], representation))
+                for id in ids
+                if id in items
+            ]
+        }
+    )
 
 
 # ~~~~~~~
@@ -159,6 +457,7 @@ def execute_cursor_pagination(
 
 
 @api.route("/regions", methods=["GET"])
+@cached(COURTS)
 def regions():
     """
     List all regions
@@ -176,22 +475,37 @@ def regions():
     if len(ids) > 0:
         filter.append(and_(Region.id.in_(ids)))
 
+    representation = Representation.from_args(request.args)
+
     def prepare_results(items):
         dicts = []
         for item in items:
-            item_dict = serialize(item)
-            dicts.append(item_dict)
+            item_dict = prepare_region(item)
+            dicts.append(representation.select(item_dict))
         return dicts
 
     query = db.select(Region)
 
     # Execute w. cursor-based pagination
     (before, after, items_per_page) = pagination_args(request)
-    (items, total_items) = execute_cursor_pagination(
+    (items, total_items, cursors) = execute_cursor_pagination(
         before, after, items_per_page, Region, Region.id, Region.name, query, filter
     )
     items = prepare_results(items)
-    return paginated_response(items, before, after, items_per_page, total_items)
+    return representation.respond(
+        paginated_response(items, cursors, before, after, items_per_page, total_items)
+    )
+
+
+@api.route("/regions/batch", methods=["GET"])
+@cached(COURTS)
+def regions_batch():
+    """
+    Regions by id
+    """
+    return execute_batch(
+        Region, db.select(Region), lambda item, representation: prepare_region(item)
+    )
 
 
 # ~~~~~~
@@ -200,6 +514,7 @@ def regions():
 
 
 @api.route("/courts", methods=["GET"])
+@cached(COURTS)
 def courts():
     """
     List all courts
@@ -222,49 +537,73 @@ def courts():
     if len(region_ids) > 0:
         filter.append(and_(Region.id.in_(region_ids)))
 
+    representation = Representation.from_args(request.args)
+
     def prepare_results(items):
         dicts = []
         for item in items:
-            item_dict = serialize(item)
-            item_dict["region"] = serialize(item.region)
-            dicts.append(item_dict)
+            item_dict = prepare_court(item)
+            representation.relate(item_dict, "region", item.region, prepare_region)
+            dicts.append(representation.select(item_dict))
         return dicts
 
     query = db.select(Court).join(Region)
 
     # Execute w. cursor-based pagination
     (before, after, items_per_page) = pagination_args(request)
-    (items, total_items) = execute_cursor_pagination(
+    (items, total_items, cursors) = execute_cursor_pagination(
         before, after, items_per_page, Court, Court.id, Court.name, query, filter
     )
     items = prepare_results(items)
-    return paginated_response(items, before, after, items_per_page, total_items)
+    return representation.respond(
+        paginated_response(items, cursors, before, after, items_per_page, total_items)
+    )
+
+
+@api.route("/courts/batch", methods=["GET"])
+@cached(COURTS)
+def courts_batch():
+    """
+    Courts by id
+    """
+
+    def prepare(item, representation):
+        item_dict = prepare_court(item)
+        representation.relate(item_dict, "region", item.region, prepare_region)
+        return item_dict
+
+    query = db.select(Court).options(db.joinedload(Court.region))
+    return execute_batch(Court, query, prepare)
 
 
 @api.route("/courts/<int:id>", methods=["GET"])
+@cached(COURTS)
 def court(id):
     """
     Court details
     """
+    representation = Representation.from_args(request.args)
     query = db.select(Court).join(Region).where(Court.id == id)
     result = db.session.execute(query).scalars().first()
-    case_dict = serialize(result)
-    case_dict["region"] = serialize(result.region)
-    return case_dict
+    court_dict = prepare_court(result)
+    representation.relate(court_dict, "region", result.region, prepare_region)
+    return representation.respond(representation.select(court_dict))
 
 
 @api.route("/courts/<int:id>/history", methods=["GET"])
+@cached(CASES, COURTS)
 def court_history(id):
     """
     History of all case updates for this court
     """
 
+    representation = Representation.from_args(request.args)
+
     def prepare_results(items):
         dicts = []
         for item in items:
-            item_dict = serialize(item)
-            item_dict["case"] = prepare_case(item.case)
-            dicts.append(item_dict)
+            item_dict = prepare_log(item, representation)
+            dicts.append(representation.select(item_dict))
         return dicts
 
     query = db.select(ScrapeLog).join(Case)
@@ -272,7 +611,7 @@ def court_history(id):
 
     # Execute w. cursor-based pagination
     (before, after, items_per_page) = pagination_args(request)
-    (items, total_items) = execute_cursor_pagination(
+    (items, total_items, cursors) = execute_cursor_pagination(
         before,
         after,
         items_per_page,
@@ -283,7 +622,9 @@ def court_history(id):
         filter,
     )
     items = prepare_results(items)
-    return paginated_response(items, before, after, items_per_page, total_items)
+    return representation.respond(
+        paginated_response(items, cursors, before, after, items_per_page, total_items)
+    )
 
 
 # ~~~~~~~~
@@ -291,33 +632,49 @@ def court_history(id):
 # ~~~~~~~~
 
 
+# Sessions of the Moscow meta search don't belong to a court
+def prepare_session_relations(session_dict, item, representation):
+    court = item.court
+    representation.relate(session_dict, "court", court, prepare_court)
+    representation.relate(
+        session_dict,
+        "region",
+        None if court is None else court.region,
+        prepare_region,
+    )
+
+
 @api.route("/sessions", methods=["GET"])
+@cached(SESSIONS, COURTS)
 def sessions():
     """
     List all scrape sessions
     """
 
+    representation = Representation.from_args(request.args)
+
     def prepare_results(items):
         dicts = []
         for item in items:
-            item_dict = serialize(item)
-            if item.court is not None:
-                item_dict["court"] = serialize(item.court)
-                item_dict["region"] = serialize(item.court.region)
-            else:
-                item_dict["court"] = None
-                item_dict["region"] = None
+            # Debug messages are only part of the session details
+            item_dict = serialize(item, exclude=("debug_message",))
+            prepare_session_relations(item_dict, item, representation)
             if item.error_type == "None":
                 item_dict["error_type"] = None
-            dicts.append(item_dict)
+            dicts.append(representation.select(item_dict))
         return dicts
 
-    query = db.select(ScrapeSession).outerjoin(Court).outerjoin(Region)
+    query = (
+        db.select(ScrapeSession)
+        .options(db.defer(ScrapeSession.debug_message))
+        .outerjoin(Court)
+        .outerjoin(Region)
+    )
     filter = []
 
     # Execute w. cursor-based pagination
     (before, after, items_per_page) = pagination_args(request)
-    (items, total_items) = execute_cursor_pagination(
+    (items, total_items, cursors) = execute_cursor_pagination(
         before,
         after,
         items_per_page,
@@ -328,10 +685,13 @@ def sessions():
         filter,
     )
     items = prepare_results(items)
-    return paginated_response(items, before, after, items_per_page, total_items)
+    return representation.respond(
+        paginated_response(items, cursors, before, after, items_per_page, total_items)
+    )
 
 
 @api.route("/sessions/<int:id>", methods=["GET"])
+@cached(SESSIONS, COURTS)
 def session(id):
     """
     Session details
@@ -343,31 +703,62 @@ def session(id):
         .where(ScrapeSession.id == id)
     )
 
+    representation = Representation.from_args(request.args)
     result = db.session.execute(query).scalars().first()
     session_dict = serialize(result)
-    if result.court is not None:
-        session_dict["court"] = serialize(result.court)
-        session_dict["region"] = serialize(result.court.region)
-    else:
-        session_dict["court"] = None
-        session_dict["region"] = None
+    prepare_session_relations(session_dict, result, representation)
     if result.error_type == "None":
         session_dict["error_type"] = None
-    return session_dict
+
+    # Older sessions keep their debug message in the session itself
+    diagnostics = load_diagnostics(id)
+    if diagnostics is not None:
+        session_dict["debug_message"] = diagnostics.format()
+        session_dict["urls"] = diagnostics.urls
+
+    session_dict["profile"] = load_profile(id)
+    return representation.respond(representation.select(session_dict))
+
+
+@api.route("/sessions/profiles", methods=["GET"])
+@cached(SESSIONS, COURTS)
+def session_profiles():
+    """
+    Average time spent per stage of scraping for every court
+    """
+    order = request.args.get("order", "network_seconds")
+    if order not in PROFILE_STAGES + list(PROFILE_COUNTERS.keys()):
+        abort(400, "Unknown order '{}'".format(order))
+
+    # Only look at recent sessions
+    since = request.args.get("since")
+    if since is not None:
+        try:
+            since = datetime.datetime.fromisoformat(since)
+        except ValueError:
+            abort(400, "Invalid 'since' timestamp")
+
+    (_, _, items_per_page) = pagination_args(request)
+    items = court_profiles(
+        order, request.args.getlist("court"), since, limit=items_per_page
+    )
+    return {"order": order, "items": items}
 
 
 @api.route("/sessions/<int:id>/history", methods=["GET"])
+@cached(CASES, COURTS)
 def session_history(id):
     """
     History of all session updates
     """
 
+    representation = Representation.from_args(request.args)
+
     def prepare_results(items):
         dicts = []
         for item in items:
-            item_dict = serialize(item)
-            item_dict["case"] = prepare_case(item.case)
-            dicts.append(item_dict)
+            item_dict = prepare_log(item, representation)
+            dicts.append(representation.select(item_dict))
         return dicts
 
     query = db.select(ScrapeLog).join(Case)
@@ -375,7 +766,7 @@ def session_history(id):
 
     # Execute w. cursor-based pagination
     (before, after, items_per_page) = pagination_args(request)
-    (items, total_items) = execute_cursor_pagination(
+    (items, total_items, cursors) = execute_cursor_pagination(
         before,
         after,
         items_per_page,
@@ -386,7 +777,9 @@ def session_history(id):
         filter,
     )
     items = prepare_results(items)
-    return paginated_response(items, before, after, items_per_page, total_items)
+    return representation.respond(
+        paginated_response(items, cursors, before, after, items_per_page, total_items)
+    )
 
 
 # ~~~~~
@@ -394,19 +787,45 @@ def session_history(id):
 # ~~~~~
 
 
-@api.route("/cases", methods=["GET"])
-def cases():
-    """
-    List all cases
-    """
+# Filter cases by an article like "205.2", "205.2 ч.2" or "205*" (prefix,
+# matches "205" and all its sub-articles like "205.2") via the article index.
+# Falls back to searching in the raw articles string for anything else, and
+# for cases whose articles could not be parsed
+def article_filter(value):
+    match = ARTICLE_FILTER_PATTERN.fullmatch(value.strip())
+    if match is None:
+        return db.column("articles").contains(value.strip())
+    article, is_prefix, part = match.groups()
+
+    if is_prefix:
+        # Range instead of LIKE, so the index can be used ("/" follows ".")
+        condition = or_(
+            CaseArticle.article == article,
+            and_(
+                CaseArticle.article >= article + ".",
+                CaseArticle.article < article + "/",
+            ),
+        )
+    else:
+        condition = CaseArticle.article == article
+    if part is not None:
+        condition = and_(condition, CaseArticle.part == part)
+
+    return or_(
+        Case.id.in_(db.select(CaseArticle.case_id).where(condition)),
+        and_(Case.articles_parsed.isnot(True), Case.articles.contains(article)),
+    )
 
+
+# Build filter for cases from query arguments, shared by listing and export
+def cases_filter(args):
     filter = []
 
     # Search by "defendant_name"
     defendant_names = list(
         map(
             lambda i: db.column("defendant_name").contains(i.strip()),
-            request.args.getlist("defendant"),
+            args.getlist("defendant"),
         )
     )
     if len(defendant_names) > 0:
@@ -416,61 +835,70 @@ def cases():
     judge_names = list(
         map(
             lambda i: db.column("judge_name").contains(i.strip()),
-            request.args.getlist("judge"),
+            args.getlist("judge"),
         )
     )
     if len(judge_names) > 0:
         filter.append(and_(*judge_names))
 
     # Search by "article"
-    articles = list(
-        map(
-            lambda i: db.column("articles").contains(i.strip()),
-            request.args.getlist("article"),
-        )
-    )
+    articles = list(map(article_filter, args.getlist("article")))
     if len(articles) > 0:
         filter.append(and_(*articles))
 
     # Filter by court "id"
-    court_ids = request.args.getlist("court")
+    court_ids = args.getlist("court")
     if len(court_ids) > 0:
         filter.append(and_(Court.id.in_(court_ids)))
 
     # Filter by region "id"
-    region_ids = request.args.getlist("region")
+    region_ids = args.getlist("region")
     if len(region_ids) > 0:
         filter.append(and_(Region.id.in_(region_ids)))
 
     # Filter by "entry_date"
-    entry_date_from = request.args.get("from")
+    entry_date_from = args.get("from")
     if entry_date_from is not None:
         filter.append(and_(Case.entry_date >= entry_date_from))
-    entry_date_to = request.args.get("to")
+    entry_date_to = args.get("to")
     if entry_date_to is not None:
         filter.append(and_(Case.entry_date <= entry_date_to))
 
     # Filter by "result_date"
-    result_date_from = request.args.get("rfrom")
+    result_date_from = args.get("rfrom")
     if result_date_from is not None:
         filter.append(and_(Case.result_date >= result_date_from))
-    result_date_to = request.args.get("rto")
+    result_date_to = args.get("rto")
     if result_date_to is not None:
         filter.append(and_(Case.result_date <= result_date_to))
 
     # Filter by "effective_date"
-    effective_date_from = request.args.get("ecfrom")
+    effective_date_from = args.get("ecfrom")
     if effective_date_from is not None:
         filter.append(and_(Case.effective_date >= effective_date_from))
-    effectiv_date_to = request.args.get("ecto")
+    effectiv_date_to = args.get("ecto")
     if effectiv_date_to is not None:
         filter.append(and_(Case.effective_date <= effectiv_date_to))
 
+    return filter
+
+
+@api.route("/cases", methods=["GET"])
+@cached(CASES, COURTS)
+def cases():
+    """
+    List all cases
+    """
+
+    filter = cases_filter(request.args)
+
+    representation = Representation.from_args(request.args)
+
     def prepare_results(items):
         dicts = []
         for item in items:
-            item_dict = prepare_case(item)
-            dicts.append(item_dict)
+            item_dict = prepare_case(item, representation)
+            dicts.append(representation.select(item_dict))
 
         return dicts
 
@@ -478,43 +906,88 @@ def cases():
 
     # Execute w. cursor-based pagination
     (before, after, items_per_page) = pagination_args(request)
-    (items, total_items) = execute_cursor_pagination(
+    (items, total_items, cursors) = execute_cursor_pagination(
         before, after, items_per_page, Case, Case.id, Case.entry_date, query, filter
     )
     items = prepare_results(items)
-    return paginated_response(items, before, after, items_per_page, total_items)
+    return representation.respond(
+        paginated_response(items, cursors, before, after, items_per_page, total_items)
+    )
+
+
+@api.route("/cases/batch", methods=["GET"])
+@cached(CASES, COURTS)
+def cases_batch():
+    """
+    Cases by id
+    """
+    query = db.select(Case).options(db.joinedload(Case.court).joinedload(Court.region))
+    return execute_batch(Case, query, prepare_case)
 
 
 @api.route("/cases/<int:id>", methods=["GET"])
+@cached(CASES, COURTS)
 def case(id):
     """
     Case details
     """
+    representation = Representation.from_args(request.args)
     query = db.select(Case).join(Court).join(Region).where(Case.id == id)
     result = db.session.execute(query).scalars().first()
-    return prepare_case(result)
+    return representation.respond(
+        representation.select(prepare_case(result, representation))
+    )
+
+
+@api.route("/cases/<int:id>/detail", methods=["GET"])
+@cached(CASES, COURTS)
+def case_detail(id):
+    """
+    Case details together with the first page of its history
+    """
+    representation = Representation.from_args(request.args)
+    query = (
+        db.select(Case)
+        .options(db.joinedload(Case.court).joinedload(Court.region))
+        .where(Case.id == id)
+    )
+    result = db.session.execute(query).scalars().first()
+    if result is None:
+        abort(404)
+    # Cursors of the history page continue at the history endpoint
+    history = load_case_history(id, representation, url_for("api.case_history", id=id))
+    return representation.respond(
+        {
+            "case": representation.select(prepare_case(result, representation)),
+            "history": history,
+        }
+    )
 
 
 @api.route("/cases/<int:id>/history", methods=["GET"])
+@cached(CASES, COURTS)
 def case_history(id):
     """
     History of all case updates
     """
+    representation = Representation.from_args(request.args)
+    return representation.respond(load_case_history(id, representation))
 
+
+def load_case_history(id, representation, path=None):
     def prepare_results(items):
         dicts = []
         for item in items:
-            item_dict = serialize(item)
-            item_dict["case"] = prepare_case(item.case)
-            dicts.append(item_dict)
+            item_dict = prepare_log(item, representation)
+            dicts.append(representation.select(item_dict))
         return dicts
 
     query = db.select(ScrapeLog).join(Case)
     filter = [Case.id == id]
 
     # Execute w. cursor-based pagination
-    (before, after, items_per_page) = pagination_args(request)
-    (items, total_items) = execute_cursor_pagination(
+    (before, after, items_per_page) = pagination_args(request, path)
+    (items, total_items, cursors) = execute_cursor_pagination(
         before,
         after,
         items_per_page,
@@ -523,6 +996,207 @@ def case_history(id):
         ScrapeLog.created_at,
         query,
         filter,
+        path,
     )
     items = prepare_results(items)
-    return paginated_response(items, before, after, items_per_page, total_items)
+    return paginated_response(
+        items, cursors, before, after, items_per_page, total_items
+    )
+
+
+# ~~~~~~~~~~
+# Statistics
+# ~~~~~~~~~~
+
+
+@api.route(
+    "/stats/<any(all, region, court, article, sub_type, result):dimension>",
+    methods=["GET"],
+)
+@cached(CASES, COURTS)
+def stats(dimension):
+    """
+    Number of cases per value of a dimension and month
+    """
+    date_field = request.args.get("date", "entry_date")
+    if date_field not in DATE_FIELDS:
+        abort(400, "Unknown date field '{}'".format(date_field))
+
+    # Limit to a range of months, given as "YYYY-MM"
+    month_from = request.args.get("from")
+    month_to = request.args.get("to")
+    for month in (month_from, month_to):
+        if month is not None and MONTH_PATTERN.fullmatch(month) is None:
+            abort(400, "Invalid month '{}'".format(month))
+
+    items = query_stats(
+        dimension, date_field, request.args.getlist("value"), month_from, month_to
+    )
+    labels = stat_labels(dimension, [item["value"] for item in items])
+    for item in items:
+        item["label"] = labels.get(item["value"], item["value"])
+
+    return {
+        "dimension": dimension,
+        "date": date_field,
+        "total": sum(item["total"] for item in items),
+        "items": items,
+    }
+
+
+# ~~~~~~
+# Export
+# ~~~~~~
+
+
+@api.route("/export/<any(cases, history):entity>", methods=["GET"])
+def export_data(entity):
+    """
+    Stream all cases or their history as NDJSON or CSV
+    """
+    format = request.args.get("format", "ndjson")
+    if format not in EXPORT_FORMATS:
+        abort(400, "Unknown format '{}'".format(format))
+
+    # Only export what changed since a given point in time, clients can use
+    # the "X-Exported-At" header of their last export for this
+    since = request.args.get("since")
+    if since is not None:
+        try:
+            since = datetime.datetime.fromisoformat(since)
+        except ValueError:
+            abort(400, "Invalid 'since' timestamp")
+
+    exported_at = datetime.datetime.utcnow().isoformat(sep=" ", timespec="seconds")
+    chunks = export(entity, format, cases_filter(request.args), since)
+    headers = {
+        "X-Exported-At": exported_at,
+        "Content-Disposition": "attachment; filename={}.{}".format(entity, format),
+    }
+    if "gzip" in request.accept_encodings:
+        chunks = gzip_stream(chunks)
+        headers["Content-Encoding"] = "gzip"
+
+    return Response(
+        stream_with_context(chunks),
+        mimetype="text/csv" if format == "csv" else "application/x-ndjson",
+        headers=headers,
+    )
+
+
+# ~~~~~~~
+# Changes
+# ~~~~~~~
+
+
+# Returns the next created or updated cases after the given scrape log id
+def load_changes(after_id):
+    query = (
+        db.select(ScrapeLog)
+        .options(
+            db.joinedload(ScrapeLog.case)
+            .joinedload(Case.court)
+            .joinedload(Court.region)
+        )
+        .where(ScrapeLog.id > after_id)
+        .order_by(ScrapeLog.id)
+        .limit(current_app.config["API_CHANGES_BATCH_SIZE"])
+    )
+    items = []
+    for item in db.session.execute(query).scalars():
+        items.append(prepare_log(item))
+
+    # Don't keep a read transaction open while waiting for the next changes,
+    # it would hold back SQLite from writing
+    db.session.close()
+    return items
+
+
+@api.route("/changes", methods=["GET"])
+def changes():
+    """
+    Created and updated cases as server-sent events or long-poll
+    """
+    config = current_app.config
+    app = current_app._get_current_object()
+
+    # The database only gets queried when the listener knows about changes
+    # the client has not seen yet
+    listener = get_listener(app)
+
+    # Continue after the last event a client has seen, or only send changes
+    # from now on
+    last_event_id = request.headers.get("Last-Event-ID") or request.args.get(
+        "lastEventId"
+    )
+    if last_event_id is not None:
+        try:
+            last_event_id = int(last_event_id)
+        except ValueError:
+            abort(400, "Invalid last event id")
+    else:
+        last_event_id = listener.last_id
+
+    is_stream = request.accept_mimetypes.best == "text/event-stream"
+    if not is_stream:
+        timeout = request.args.get("timeout", config["API_CHANGES_POLL_MAX_SEC"])
+        try:
+            timeout = min(float(timeout), config["API_CHANGES_POLL_MAX_SEC"])
+        except ValueError:
+            abort(400, "Invalid timeout")
+
+    if not acquire_stream(app):
+        abort(
+            503,
+            "Too many open change streams",
+            retry_after=config["API_CHANGES_RETRY_AFTER_SEC"],
+        )
+
+    if is_stream:
+
+        def events(last_event_id):
+            started_at = time.monotonic()
+            # Clients reconnect after this many milliseconds
+            yield "retry: 1000\n\n"
+            while time.monotonic() - started_at < config["API_CHANGES_STREAM_MAX_SEC"]:
+                if not listener.wait(
+                    last_event_id, config["API_CHANGES_HEARTBEAT_SEC"]
+                ):
+                    # Keep the connection open through proxies
+                    yield ": heartbeat\n\n"
+                    continue
+                items = load_changes(last_event_id)
+                for item in items:
+                    last_event_id = item["id"]
+                    yield "id: {}\nevent: change\ndata: {}\n\n".format(
+                        last_event_id, json.dumps(item, ensure_ascii=False)
+                    )
+                metrics.incr("api_change_events_total", len(items))
+                if len(items) == 0:
+                    # Published id is ahead of anything we can read, the
+                    # entries got removed in the meantime
+                    last_event_id = max(last_event_id, listener.last_id)
+
+        response = Response(
+            stream_with_context(events(last_event_id)),
+            mimetype="text/event-stream",
+            headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+        )
+        # Stream keeps its slot until the client is gone
+        response.call_on_close(lambda: release_stream(app))
+        return response
+
+    # Long-poll: answer right away when there are changes already, otherwise
+    # wait for them
+    try:
+        items = []
+        if listener.wait(last_event_id, timeout):
+            items = load_changes(last_event_id)
+    finally:
+        release_stream(app)
+    metrics.incr("api_change_events_total", len(items))
+    if len(items) > 0:
+        last_event_id = items[-1]["id"]
+    else:
+        last_event_id = max(last_event_id, listener.last_id)
+    return {"lastEventId": last_event_id, "items": items}
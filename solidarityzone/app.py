@@ -1,9 +1,9 @@
 import os
 
-from flask import Flask, render_template
+from flask import Flask, Response, render_template
 
 
-def init_app() -> Flask:
+def init_app(config=None) -> Flask:
     # Initialize Flask HTTP server
     app = Flask(
         __name__,
@@ -13,6 +13,16 @@ def init_app() -> Flask:
     app.config.from_mapping(
         SECRET_KEY="dev",
         SQLALCHEMY_DATABASE_URI="sqlite:///db.sqlite",
+        # Read-only API requests can use their own database, for example a
+        # replica or "sqlite:///file:db.sqlite?mode=ro&uri=true". Without it
+        # everything uses the primary database. Both get their own engine
+        # options, like pool size and timeouts. Responses to cache for data
+        # which changed more recently than the read-only database might lag
+        # behind get computed from the primary database
+        SQLALCHEMY_READ_DATABASE_URI=None,
+        SQLALCHEMY_READ_MAX_LAG_SEC=60,
+        SQLALCHEMY_ENGINE_OPTIONS={},
+        SQLALCHEMY_READ_ENGINE_OPTIONS={},
         CELERY=dict(
             timezone="Asia/Yekaterinburg",
             broker_url="redis://127.0.0.1:6379/0",
@@ -21,11 +31,108 @@ def init_app() -> Flask:
             ),
         ),
         TEMPLATES_AUTO_RELOAD=True,
+        # Shared state between web and worker processes, defaults to the
+        # Redis broker. Use "memory://" to keep it inside the process
+        REDIS_URL=None,
+        # Cache API responses until ingestion changes the data
+        API_CACHE_ENABLED=True,
+        API_CACHE_TTL_SEC=15 * 60,
+        # Feed of created and updated cases: streams end after a while and
+        # clients reconnect with the last event id, long-polls wait at most
+        # this long for new changes
+        API_CHANGES_STREAM_MAX_SEC=5 * 60,
+        API_CHANGES_POLL_MAX_SEC=25,
+        API_CHANGES_HEARTBEAT_SEC=15,
+        API_CHANGES_BATCH_SIZE=100,
+        # Open streams and long-polls per process, every one of them holds a
+        # worker thread. Clients above the limit are asked to retry later
+        API_CHANGES_MAX_STREAMS=10,
+        API_CHANGES_RETRY_AFTER_SEC=30,
+        # JSON responses at least this large get compressed when the client
+        # accepts it
+        API_COMPRESS_MIN_BYTES=1024,
+        # Batch lookups resolve at most this many ids at once
+        API_BATCH_MAX_IDS=100,
+        # Lease held on a court server while scraping it, tasks for busy
+        # servers get deferred to a later point for as long as it takes,
+        # tasks deferred more often than this get reported
+        SCRAPER_LEASE_TTL_SEC=600,
+        SCRAPER_LEASE_MIN_DEFER_SEC=60,
+        SCRAPER_LEASE_MAX_DEFER_SEC=300,
+        SCRAPER_LEASE_WARN_DEFERRALS=100,
+        # Failed searches get retried depending on their error: with
+        # exponential backoff, after a cooldown of the blocking host or not at
+        # all, quarantining courts whose pages we repeatedly can't parse.
+        # Retries share a budget per hour so they don't crowd out fresh work
+        SCRAPER_RETRY_BASE_SEC=5 * 60,
+        SCRAPER_RETRY_MAX_SEC=6 * 60 * 60,
+        SCRAPER_RETRY_MAX_ATTEMPTS=4,
+        SCRAPER_RETRY_BUDGET_PER_HOUR=200,
+        SCRAPER_BLOCKED_COOLDOWN_SEC=2 * 60 * 60,
+        SCRAPER_QUARANTINE_AFTER_FAILURES=3,
+        SCRAPER_QUARANTINE_SEC=7 * 24 * 60 * 60,
+        # Interrupted searches continue from their last completed page
+        SCRAPER_CHECKPOINT_MAX_AGE_SEC=6 * 60 * 60,
+        SCRAPER_CHECKPOINT_RETRY_SEC=15 * 60,
+        SCRAPER_CHECKPOINT_MAX_RESUMES=3,
+        # Directory for a compressed archive of all fetched pages, disabled
+        # when not set
+        SCRAPER_ARCHIVE_PATH=None,
+        # Search result pages which did not change since the last search are
+        # skipped, every couple of cycles everything gets parsed again
+        SCRAPER_FINGERPRINT_FULL_PASS_CYCLES=7,
+        # Case cards of the Moscow meta search are fetched by a few workers,
+        # together never faster than one card per random interval
+        SCRAPER_MOSCOW_CARD_WORKERS=4,
+        SCRAPER_MOSCOW_CARD_MIN_INTERVAL_SEC=2,
+        SCRAPER_MOSCOW_CARD_MAX_INTERVAL_SEC=6,
+        # Courts get scraped in their off-peak hours (local time of their
+        # region), hours with mostly failed or slow searches get avoided and
+        # other hours preferred after a while. Courts are scraped at most once
+        # per interval and at the latest after the maximum wait
+        SCRAPER_DEFAULT_TIMEZONE="Europe/Moscow",
+        SCRAPER_REGION_TIMEZONES={},
+        SCRAPER_OFF_PEAK_START_HOUR=18,
+        SCRAPER_OFF_PEAK_END_HOUR=9,
+        SCRAPER_HOUR_MIN_SEARCHES=20,
+        SCRAPER_HOUR_MIN_SUCCESS_RATE=0.8,
+        SCRAPER_HOUR_MAX_LATENCY_FACTOR=1.5,
+        SCRAPER_SCHEDULE_MIN_INTERVAL_SEC=3 * 24 * 60 * 60,
+        SCRAPER_SCHEDULE_MAX_WAIT_SEC=7 * 24 * 60 * 60,
+        # Pools of workers with their own egress, as {"name": "proxy URL"}.
+        # Courts are assigned to pools by consistent hashing, a pool whose
+        # searches get blocked too often hands its courts over to the other
+        # pools for a while. Everything runs on the default queue without pools
+        SCRAPER_POOLS={},
+        SCRAPER_POOL_WINDOW_SEC=60 * 60,
+        SCRAPER_POOL_MIN_SEARCHES=20,
+        SCRAPER_POOL_MAX_BLOCKED_RATE=0.5,
+        SCRAPER_POOL_COOLDOWN_SEC=6 * 60 * 60,
+        # Scrape sessions which did not change data get removed after some
+        # days, in small batches with pauses so other writers are not blocked
+        RETENTION_AFTER_DAYS=7,
+        RETENTION_BATCH_SIZE=500,
+        RETENTION_BATCH_PAUSE_SEC=0.5,
+        RETENTION_DEBUG_MESSAGE_MAX_LENGTH=2000,
+        RETENTION_VACUUM_STEP_PAGES=1000,
+        # Unused URLs are kept for a while after they were last used, so
+        # scrapes still running can reference them
+        RETENTION_URL_GRACE_SEC=60 * 60,
     )
     app.config.from_prefixed_env()
+    if config is not None:
+        app.config.update(config)
 
     # Initialize SQLite database
-    from .models import db
+    from .models import READ_BIND, db
+
+    read_uri = app.config["SQLALCHEMY_READ_DATABASE_URI"]
+    if read_uri and read_uri != app.config["SQLALCHEMY_DATABASE_URI"]:
+        binds = dict(app.config.get("SQLALCHEMY_BINDS") or {})
+        binds[READ_BIND] = dict(
+            app.config["SQLALCHEMY_READ_ENGINE_OPTIONS"], url=read_uri
+        )
+        app.config["SQLALCHEMY_BINDS"] = binds
 
     db.init_app(app)
 
@@ -41,17 +148,36 @@ def init_app() -> Flask:
 
         return render_template("index.html", VERSION=__version__)
 
+    # Expose metrics of web and worker processes to Prometheus
+    @app.route("/metrics")
+    def prometheus_metrics():
+        from . import metrics
+
+        return Response(metrics.exposition(), mimetype="text/plain; version=0.0.4")
+
     with app.app_context():
         from . import commands
         from .api import api
 
         # Initialize CLI commands
+        app.cli.add_command(commands.benchmark_moscow)
+        app.cli.add_command(commands.benchmark_pagination)
+        app.cli.add_command(commands.benchmark_startup)
         app.cli.add_command(commands.clean_sessions)
+        app.cli.add_command(commands.export_command)
+        app.cli.add_command(commands.fingerprint_cases)
         app.cli.add_command(commands.init_db_command)
+        app.cli.add_command(commands.rebuild_stats_command)
+        app.cli.add_command(commands.release_court)
+        app.cli.add_command(commands.reparse_archive)
+        app.cli.add_command(commands.show_metrics)
+        app.cli.add_command(commands.vacuum_database)
         app.cli.add_command(commands.scrape)
         app.cli.add_command(commands.scrape_all)
+        app.cli.add_command(commands.scrape_hours)
         app.cli.add_command(commands.scrape_next_batch)
         app.cli.add_command(commands.scrape_test_courts)
+        app.cli.add_command(commands.scraper_pools)
 
         # Register API routes
         app.register_blueprint(api)
@@ -0,0 +1,132 @@
+import gzip
+import hashlib
+import os
+
+from flask import current_app
+
+from .models import ArchivedPage, db
+
+# Query parameters which change with every search without changing the
+# results, they are removed before we archive a page under its URL
+VOLATILE_PARAMS = ["captcha", "captchaid", "vnkod"]
+
+
+def normalize_url(url):
+    base, _, query = url.partition("?")
+    if query == "":
+        return base
+    params = [
+        param
+        for param in query.split("&")
+        if param.split("=")[0] not in VOLATILE_PARAMS
+    ]
+    return "{}?{}".format(base, "&".join(params))
+
+
+def content_digest(text):
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+class PageArchive:
+    # Compressed, content-addressed archive of all pages we've fetched from
+    # the courts. Every page is stored only once on disk, no matter how often
+    # we've seen it, the database keeps track under which URL it appeared
+
+    def __init__(self, path, court_code=None, article=None, sub_type=None):
+        self.path = path
+        self.court_code = court_code
+        self.article = article
+        self.sub_type = sub_type
+
+    def file_path(self, digest):
+        return os.path.join(self.path, digest[:2], "{}.html.gz".format(digest))
+
+    def store(self, url, kind, text):
+        digest = content_digest(text)
+
+        # Write page only once to disk, atomically so readers never see
+        # half-written files
+        file_path = self.file_path(digest)
+        if not os.path.exists(file_path):
+            os.makedirs(os.path.dirname(file_path), exist_ok=True)
+            tmp_path = "{}.{}.tmp".format(file_path, os.getpid())
+            with gzip.open(tmp_path, "wt", encoding="utf-8") as file:
+                file.write(text)
+            os.replace(tmp_path, file_path)
+
+        # Remember that we've seen this content under this URL (again)
+        url = normalize_url(url)
+        query = (
+            db.update(ArchivedPage)
+            .where(ArchivedPage.url == url, ArchivedPage.digest == digest)
+            .values(updated_at=db.func.now())
+        )
+        result = db.session.execute(query)
+        if result.rowcount == 0:
+            query = db.insert(ArchivedPage).values(
+                url=url,
+                digest=digest,
+                kind=kind,
+                court_code=self.court_code,
+                article=self.article,
+                sub_type=self.sub_type,
+                size=len(text),
+            )
+            db.session.execute(query)
+        db.session.commit()
+        return digest
+
+    def load(self, digest):
+        with gzip.open(self.file_path(digest), "rt", encoding="utf-8") as file:
+            return file.read()
+
+    def latest_digest(self, url):
+        query = (
+            db.select(ArchivedPage.digest)
+            .where(ArchivedPage.url == normalize_url(url))
+            .order_by(ArchivedPage.updated_at.desc(), ArchivedPage.id.desc())
+            .limit(1)
+        )
+        return db.session.execute(query).scalar()
+
+    def latest_pages(self, kind, court_code=None):
+        # Returns the most recently seen version of every archived URL
+        query = db.select(ArchivedPage).where(ArchivedPage.kind == kind)
+        if court_code is not None:
+            query = query.where(ArchivedPage.court_code == court_code)
+        query = query.order_by(
+            ArchivedPage.url, ArchivedPage.updated_at.desc(), ArchivedPage.id.desc()
+        )
+        pages = []
+        for page in db.session.execute(query).scalars():
+            if len(pages) == 0 or pages[-1].url != page.url:
+                pages.append(page)
+        return pages
+
+
+class ArchivedResponse:
+    def __init__(self, text, status_code):
+        self.text = text
+        self.status_code = status_code
+
+
+class ArchiveReplay:
+    # Answers requests of the scraper with archived pages instead of fetching
+    # them from the courts, this allows us to re-parse everything offline
+
+    def __init__(self, archive):
+        self.archive = archive
+
+    def get(self, url=None, **kwargs):
+        digest = self.archive.latest_digest(url)
+        if digest is None:
+            return ArchivedResponse("", 404)
+        return ArchivedResponse(self.archive.load(digest), 200)
+
+
+# Returns an archive for this search when archiving is enabled
+def get_archive(court_code=None, article=None, sub_type=None):
+    path = current_app.config["SCRAPER_ARCHIVE_PATH"]
+    if not path:
+        return None
+    return PageArchive(path, court_code, article, sub_type)
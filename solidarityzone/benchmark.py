@@ -0,0 +1,244 @@
+import datetime
+import math
+import random
+import statistics
+import threading
+import time
+import urllib.parse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from .models import Case, Court, Region, db
+from .scraper import CourtScraperMoscow
+
+# Number of case cards on every search result page of the fixture
+FIXTURE_CARDS_PER_PAGE = 20
+
+# Synthetic cases get inserted in batches of this size
+SYNTHETIC_BATCH_SIZE = 100000
+
+# Number of courts synthetic cases are spread over
+SYNTHETIC_COURTS = 100
+
+
+class MoscowFixture:
+    # Local stand-in for the Moscow meta search, serving `cards` case cards
+    # on as many search result pages as needed. Every card answer takes
+    # `latency_sec`, like a slow court server would
+
+    def __init__(self, cards, latency_sec):
+        self.cards = cards
+        self.latency_sec = latency_sec
+        self.search_urls = []
+        fixture = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.startswith("/search?"):
+                    fixture.search_urls.append(self.path)
+                    body = fixture.search_page(self.path)
+                else:
+                    time.sleep(fixture.latency_sec)
+                    body = fixture.card_page(self.path)
+                body = body.encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "text/html; charset=utf-8")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.url = "http://127.0.0.1:{}".format(self.server.server_address[1])
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def search_page(self, path):
+        query = urllib.parse.parse_qs(urllib.parse.urlsplit(path).query)
+        page = int(query["page"][0])
+        first = (page - 1) * FIXTURE_CARDS_PER_PAGE
+        last = min(first + FIXTURE_CARDS_PER_PAGE, self.cards)
+        rows = "".join(
+            '<tr><td><nobr><a class="detailsLink" href="/rs/fixture/services/'
+            'cases/criminal/details/{}">{}</a></nobr></td></tr>'.format(card, card)
+            for card in range(first, last)
+        )
+        return (
+            "<html><body>По вашему запросу найдено записей: {}"
+            '<input id="paginationFormMaxPages" value="{}"><table>{}</table>'
+            "</body></html>"
+        ).format(self.cards, math.ceil(self.cards / FIXTURE_CARDS_PER_PAGE), rows)
+
+    def card_page(self, path):
+        card = path.rsplit("/", 1)[-1]
+        return (
+            '<html><body><div class="main searchDetails">'
+            '<div class="row_card"><div class="left">Номер дела</div>'
+            '<div class="right">1-{}/2024</div></div>'
+            '<div class="row_card"><div class="left">Подсудимый</div>'
+            '<div class="right"><span>Фамилия И.О.</span> (ст. 205 ч.1)</div>'
+            "</div></div></body></html>"
+        ).format(card)
+
+
+# Scrapes the local fixture with the Moscow scraper and returns how many
+# cards per minute it managed to fetch
+def benchmark_moscow(cards, latency_sec, workers, min_interval_sec, max_interval_sec):
+    with MoscowFixture(cards, latency_sec) as fixture:
+        scraper = CourtScraperMoscow(
+            card_workers=workers,
+            card_min_interval_sec=min_interval_sec,
+            card_max_interval_sec=max_interval_sec,
+        )
+        scraper.court_url = fixture.url
+
+        started_at = time.monotonic()
+        results = 0
+        for items, _ in scraper.iter_court_data("205"):
+            results += len(items)
+        duration = time.monotonic() - started_at
+
+    if scraper.request_res["error"]:
+        raise Exception(
+            "Scraper failed with error_type={}: {}".format(
+                scraper.request_res["error_type"],
+                scraper.request_res["error_debug_message"],
+            )
+        )
+    return {
+        "cards": scraper.profile["card_requests"],
+        "results": results,
+        "seconds": duration,
+        "cards_per_minute": scraper.profile["card_requests"] / duration * 60,
+        "pages_with_instance": sum("instance=" in url for url in fixture.search_urls),
+        "pages": len(fixture.search_urls),
+    }
+
+
+def insert_synthetic_cases(rows):
+    # Fill the cases table up to the given number of rows, entry dates are
+    # spread over ten years with some cases without one and many on the same
+    # day, like scraped cases
+    existing = db.session.execute(db.select(db.func.count(Case.id))).scalar()
+    if existing >= rows:
+        return existing
+    if db.session.execute(db.select(Court.id)).first() is None:
+        db.session.execute(db.insert(Region).values(name="Synthetic"))
+        region_id = db.session.execute(db.select(Region.id)).scalar()
+        db.session.execute(
+            db.insert(Court),
+            [
+                {
+                    "code": "synthetic-{}".format(index),
+                    "name": "Synthetic {}".format(index),
+                    "region_id": region_id,
+                    "is_military": False,
+                }
+                for index in range(SYNTHETIC_COURTS)
+            ],
+        )
+        db.session.commit()
+    court_ids = db.session.execute(db.select(Court.id)).scalars().all()
+
+    start = datetime.datetime(2015, 1, 1)
+    for offset in range(existing, rows, SYNTHETIC_BATCH_SIZE):
+        values = []
+        for index in range(offset, min(offset + SYNTHETIC_BATCH_SIZE, rows)):
+            entry_date = None
+            if random.random() > 0.01:
+                entry_date = start + datetime.timedelta(days=random.randrange(3650))
+            values.append(
+                {
+                    "court_id": random.choice(court_ids),
+                    "case_number": "1-{}/2024".format(index),
+                    "articles": "205",
+                    "defendant_name": "Фамилия И.О.",
+                    "entry_date": entry_date,
+                }
+            )
+        db.session.execute(db.insert(Case), values)
+        db.session.commit()
+    return rows
+
+
+# Requests pages of the case listing starting at deep offsets from a
+# database of synthetic cases and returns the median latency of the pages
+# next to the latency of skipping to the same offset with OFFSET
+def benchmark_pagination(database, rows, offsets, repeat, items_per_page=50):
+    from .api import cursor_encode
+    from .app import init_app
+
+    app = init_app(
+        {
+            "SQLALCHEMY_DATABASE_URI": "sqlite:///{}".format(database),
+            "REDIS_URL": "memory://",
+        }
+    )
+    results = []
+    with app.app_context():
+        db.create_all()
+        rows = insert_synthetic_cases(rows)
+        client = app.test_client()
+        path = "/api/cases"
+
+        # Count the cases once, like a client paging through them would
+        client.get("{}?itemsPerPage={}".format(path, items_per_page))
+
+        order = (Case.entry_date.desc(), Case.id.desc())
+        for offset in offsets:
+            if offset + repeat >= rows:
+                continue
+            query = (
+                db.select(Case.id, db.cast(Case.entry_date, db.String))
+                .order_by(*order)
+                .offset(offset)
+                .limit(repeat)
+            )
+            with app.test_request_context(path):
+                cursors = [
+                    cursor_encode(value, id)
+                    for id, value in db.session.execute(query).all()
+                ]
+
+            # Every cursor is a different URL, so no page comes from the cache
+            page_seconds = []
+            for cursor in cursors:
+                started_at = time.monotonic()
+                response = client.get(
+                    path,
+                    query_string={"after": cursor, "itemsPerPage": items_per_page},
+                )
+                page_seconds.append(time.monotonic() - started_at)
+                if len(response.get_json()["items"]) != items_per_page:
+                    raise Exception("Page at offset {} is not full".format(offset))
+
+            offset_seconds = []
+            for index in range(repeat):
+                query = (
+                    db.select(Case)
+                    .join(Court)
+                    .join(Region)
+                    .order_by(*order)
+                    .offset(offset + index + 1)
+                    .limit(items_per_page + 1)
+                )
+                started_at = time.monotonic()
+                db.session.execute(query).scalars().all()
+                offset_seconds.append(time.monotonic() - started_at)
+
+            results.append(
+                {
+                    "offset": offset,
+                    "page_ms": statistics.median(page_seconds) * 1000,
+                    "offset_ms": statistics.median(offset_seconds) * 1000,
+                }
+            )
+    return {"rows": rows, "results": results}
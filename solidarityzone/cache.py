@@ -0,0 +1,123 @@
+import functools
+import hashlib
+import logging
+import time
+
+import redis
+from flask import current_app, make_response, request
+from werkzeug.http import http_date, parse_date
+
+from .models import primary
+from .store import get_store, key
+
+logger = logging.getLogger(__name__)
+
+# Parts of the data which change independently from each other, every API
+# endpoint declares which of them it depends on
+CASES = "cases"
+SESSIONS = "sessions"
+COURTS = "courts"
+
+
+# Invalidate all cached responses depending on these parts of the data, to be
+# called whenever we've committed changes to them
+def bump_data_version(*domains):
+    try:
+        store = get_store()
+        for domain in domains:
+            store.incr(key("version", domain))
+            store.set(key("modified", domain), time.time())
+    except redis.RedisError as err:
+        logger.warning("Could not bump data version: {}".format(err))
+
+
+def data_version(domains):
+    store = get_store()
+    versions = store.mget([key("version", domain) for domain in domains])
+    modified = store.mget([key("modified", domain) for domain in domains])
+    version = "-".join([str(v or 0) for v in versions])
+    last_modified = max([float(m or 0) for m in modified])
+    return version, last_modified
+
+
+def normalized_query():
+    return "&".join(
+        "{}={}".format(k, v) for k, v in sorted(request.args.items(multi=True))
+    )
+
+
+def is_not_modified(etag, last_modified):
+    if request.if_none_match:
+        return request.if_none_match.contains_weak(etag)
+    if_modified_since = request.headers.get("If-Modified-Since")
+    if if_modified_since is not None and last_modified > 0:
+        date = parse_date(if_modified_since)
+        return date is not None and int(last_modified) <= date.timestamp()
+    return False
+
+
+# Cache JSON responses of an API endpoint until the data it depends on changes,
+# clients can revalidate with ETag / Last-Modified and get a 304 response
+def cached(*domains):
+    def decorator(view):
+        @functools.wraps(view)
+        def wrapper(*args, **kwargs):
+            if not current_app.config["API_CACHE_ENABLED"]:
+                return view(*args, **kwargs)
+
+            try:
+                version, last_modified = data_version(domains)
+            except redis.RedisError as err:
+                logger.warning("Could not read data version: {}".format(err))
+                return view(*args, **kwargs)
+
+            digest = hashlib.sha1(
+                "{}?{}".format(request.path, normalized_query()).encode("utf-8")
+            ).hexdigest()
+            etag = "{}-{}".format(version, digest)
+            headers = {"ETag": '"{}"'.format(etag), "Cache-Control": "no-cache"}
+            if last_modified > 0:
+                headers["Last-Modified"] = http_date(last_modified)
+
+            if is_not_modified(etag, last_modified):
+                return "", 304, headers
+
+            cache_key = key("api-cache", etag)
+            store = get_store()
+            try:
+                body = store.get(cache_key)
+            except redis.RedisError as err:
+                logger.warning("Could not read cached response: {}".format(err))
+                body = None
+            if body is not None:
+                headers["X-Cache"] = "HIT"
+                return current_app.response_class(
+                    body, mimetype="application/json", headers=headers
+                )
+
+            # Responses get cached under the current version, a lagging
+            # read-only database might not have its changes yet
+            if (
+                time.time() - last_modified
+                < current_app.config["SQLALCHEMY_READ_MAX_LAG_SEC"]
+            ):
+                with primary():
+                    response = make_response(view(*args, **kwargs))
+            else:
+                response = make_response(view(*args, **kwargs))
+            if response.status_code == 200 and response.is_json:
+                try:
+                    store.set(
+                        cache_key,
+                        response.get_data(as_text=True),
+                        ex=current_app.config["API_CACHE_TTL_SEC"],
+                    )
+                except redis.RedisError as err:
+                    logger.warning("Could not cache response: {}".format(err))
+                headers["X-Cache"] = "MISS"
+                response.headers.extend(headers)
+            return response
+
+        return wrapper
+
+    return decorator
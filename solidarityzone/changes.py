@@ -0,0 +1,130 @@
+import logging
+import threading
+import time
+
+import redis
+
+from . import metrics
+from .models import ScrapeLog, db
+from .store import get_store, key, store_url
+
+logger = logging.getLogger(__name__)
+
+# Ingestion publishes the id of the last scrape log entry it committed here
+CHANNEL = key("changes")
+LAST_ID_KEY = key("changes", "last_id")
+
+_listeners = {}
+_listeners_lock = threading.Lock()
+
+_stream_slots = {}
+
+
+# To be called after committing new scrape log entries. SQLite only allows
+# one writer at a time, so entries get committed in the order of their ids
+# and no entry below the published one can show up later
+def publish_changes(last_id, store=None):
+    store = store if store is not None else get_store()
+    try:
+        store.set(LAST_ID_KEY, last_id)
+        store.publish(CHANNEL, last_id)
+    except redis.RedisError as err:
+        logger.warning("Could not publish changes: {}".format(err))
+
+
+def published_change_id(store):
+    try:
+        last_id = store.get(LAST_ID_KEY)
+    except redis.RedisError as err:
+        logger.warning("Could not read last change: {}".format(err))
+        return 0
+    return int(last_id or 0)
+
+
+class ChangeListener:
+    # One subscription per web process, waking up all of its streams as soon
+    # as new changes got published. Streams only query the database when
+    # there is something new for them
+
+    def __init__(self, app, last_id):
+        self.app = app
+        self.condition = threading.Condition()
+        self.last_id = max(last_id, published_change_id(get_store(app)))
+        self.thread = threading.Thread(target=self.listen, daemon=True)
+        self.thread.start()
+
+    def listen(self):
+        while True:
+            pubsub = None
+            try:
+                pubsub = get_store(self.app).pubsub()
+                pubsub.subscribe(CHANNEL)
+                while True:
+                    message = pubsub.get_message(
+                        ignore_subscribe_messages=True, timeout=1.0
+                    )
+                    if message is not None and message["type"] == "message":
+                        self.notify(int(message["data"]))
+            except redis.RedisError as err:
+                logger.warning("Lost subscription to changes: {}".format(err))
+                metrics.incr("api_change_listener_errors_total")
+                time.sleep(1)
+            finally:
+                # Give the connection back before we subscribe again
+                if pubsub is not None:
+                    pubsub.close()
+
+    def notify(self, last_id):
+        with self.condition:
+            if last_id > self.last_id:
+                self.last_id = last_id
+                self.condition.notify_all()
+
+    def wait(self, after_id, timeout):
+        # Returns `True` as soon as there are changes after the given id,
+        # `False` when there were none within the timeout
+        deadline = time.monotonic() + timeout
+        with self.condition:
+            while self.last_id <= after_id:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self.condition.wait(remaining)
+        if self.last_id <= after_id:
+            # Messages get lost while the subscription reconnects
+            self.notify(published_change_id(get_store(self.app)))
+        return self.last_id > after_id
+
+
+def last_change_id():
+    last_id = db.session.execute(db.select(db.func.max(ScrapeLog.id))).scalar()
+    db.session.close()
+    return last_id or 0
+
+
+def get_listener(app):
+    url = store_url(app)
+    with _listeners_lock:
+        if url not in _listeners:
+            # Changes which got committed before we started listening
+            _listeners[url] = ChangeListener(app, last_change_id())
+        return _listeners[url]
+
+
+def acquire_stream(app):
+    # Every open stream or long-poll holds a worker thread, only a limited
+    # number of them per process so other requests still get served.
+    # Returns `False` when all slots are taken
+    with _listeners_lock:
+        if app not in _stream_slots:
+            _stream_slots[app] = threading.BoundedSemaphore(
+                app.config["API_CHANGES_MAX_STREAMS"]
+            )
+    if not _stream_slots[app].acquire(blocking=False):
+        metrics.incr("api_change_streams_rejected_total")
+        return False
+    return True
+
+
+def release_stream(app):
+    _stream_slots[app].release()
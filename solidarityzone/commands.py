@@ -1,10 +1,24 @@
 import json
+import subprocess
+import sys
+from collections import Counter
 
 import click
 from flask import current_app
+from werkzeug.datastructures import MultiDict
 
-from . import tasks
-from .models import Court, Region, db
+from . import metrics
+from .api import cases_filter
+from .cache import CASES, COURTS, bump_data_version
+from .export import EXPORT_FORMATS, export, gzip_stream
+from .hours import hour_stats, local_hour, preferred_hours, region_timezones
+from .ingestion import backfill_case_articles, backfill_case_fingerprints
+from .models import Court, Region, db, read_only
+from .pools import assign_pool, pool_queue, pool_stats, pools
+from .stats import rebuild_stats, verify_stats
+
+# Commands import `tasks` only when they run: it pulls in the scraper and the
+# captcha solver (torch), which the web process should never load
 
 
 @click.command("init-db")
@@ -14,43 +28,141 @@ def init_db_command():
         click.echo("Create tables ..")
         db.create_all()
 
+        # Add columns which got introduced after the tables were created
+        add_missing_columns()
+
+        # Add indexes which got introduced after the tables were created
+        for table in db.metadata.sorted_tables:
+            for index in table.indexes:
+                index.create(db.engine, checkfirst=True)
+
+        # Index articles of cases scraped before the article index existed
+        click.echo("Index case articles ..")
+        indexed_articles = backfill_case_articles()
+        if indexed_articles > 0:
+            bump_data_version(CASES)
+
         # Populate database with initial courts and regions data
         click.echo("Populate database with initial data ..")
         with open("./solidarityzone/data/court-codes.json", "r") as file:
-            data = json.load(file)
-            courts_added = []
-            for region_name, courts in data.items():
-                # Insert region
-                query = db.select(Region).where(Region.name == region_name)
-                result = db.session.execute(query).scalars().first()
-                if result is None:
-                    query = db.insert(Region).values(name=region_name)
-                    result = db.session.execute(query)
-                    region_id = result.inserted_primary_key[0]
-                else:
-                    region_id = result.id
-
-                # Insert courts in this region
-                for court_name, court_code in courts.items():
-                    query = db.select(Court).where(Court.code == court_code)
-                    result = db.session.execute(query).scalars().first()
-                    if result is None:
-                        courts_added.append(court_code)
-                        query = db.insert(Court).values(
-                            name=court_name,
-                            code=court_code,
-                            # @TODO: Value should be inside the .json file
-                            is_military=False,
-                            region_id=region_id,
-                        )
-                        db.session.execute(query)
-            db.session.commit()
+            changes = load_courts(json.load(file))
+        if changes["added"] or changes["updated"]:
+            bump_data_version(COURTS)
 
     click.echo(
-        "Initialized database successfully, added {} new courts".format(
-            len(courts_added)
+        "Initialized database successfully, added {} new regions, added {} and \
+updated {} courts ({} unchanged) and indexed {} case articles".format(
+            changes["regions"],
+            len(changes["added"]),
+            len(changes["updated"]),
+            changes["unchanged"],
+            indexed_articles,
         )
     )
+    for court_code in changes["updated"]:
+        click.echo("Updated court {}".format(court_code))
+
+
+# Adds columns of the models which the tables don't have yet, we only ever
+# add nullable columns so existing rows stay valid
+def add_missing_columns():
+    existing = {
+        table_name: {
+            column["name"] for column in db.inspect(db.engine).get_columns(table_name)
+        }
+        for table_name in db.metadata.tables.keys()
+    }
+    with db.engine.begin() as connection:
+        for table in db.metadata.sorted_tables:
+            for column in table.columns:
+                if column.name in existing[table.name]:
+                    continue
+                connection.execute(
+                    db.text(
+                        "ALTER TABLE {} ADD COLUMN {} {}".format(
+                            table.name,
+                            column.name,
+                            column.type.compile(dialect=db.engine.dialect),
+                        )
+                    )
+                )
+
+
+def is_military_court(court_name):
+    return "военный" in court_name.lower()
+
+
+# Brings regions and courts in line with the given data ({region name: {court
+# name: court code}}): compares it with the tables in memory and only writes
+# the differences in a few batched statements, so running it again is cheap
+def load_courts(data):
+    query = db.select(Region.id, Region.name)
+    regions = {row.name: row.id for row in db.session.execute(query)}
+    new_regions = [name for name in data.keys() if name not in regions]
+    if len(new_regions) > 0:
+        db.session.execute(db.insert(Region), [{"name": name} for name in new_regions])
+        query = db.select(Region.id, Region.name).where(Region.name.in_(new_regions))
+        regions.update({row.name: row.id for row in db.session.execute(query)})
+
+    query = db.select(
+        Court.id, Court.code, Court.name, Court.region_id, Court.is_military
+    )
+    courts = {row.code: row for row in db.session.execute(query)}
+    inserts = []
+    updates = []
+    unchanged = 0
+    for region_name, region_courts in data.items():
+        for court_name, court_code in region_courts.items():
+            values = {
+                "name": court_name,
+                "region_id": regions[region_name],
+                "is_military": is_military_court(court_name),
+            }
+            court = courts.get(court_code)
+            if court is None:
+                inserts.append(dict(values, code=court_code))
+            elif any(getattr(court, name) != value for name, value in values.items()):
+                updates.append(dict(values, id=court.id, code=court_code))
+            else:
+                unchanged += 1
+
+    if len(inserts) > 0:
+        db.session.execute(db.insert(Court), inserts)
+    if len(updates) > 0:
+        # Updates by primary key get executed as one batched statement
+        db.session.execute(db.update(Court), updates)
+    db.session.commit()
+
+    return {
+        "regions": len(new_regions),
+        "added": [court["code"] for court in inserts],
+        "updated": [court["code"] for court in updates],
+        "unchanged": unchanged,
+    }
+
+
+@click.command("export")
+@click.argument("entity", type=click.Choice(["cases", "history"]))
+@click.option("--format", type=click.Choice(EXPORT_FORMATS), default="ndjson")
+@click.option("--since", type=click.DateTime(), help="Only export recent changes")
+@click.option(
+    "--filter",
+    "filters",
+    multiple=True,
+    help="Filter like the cases API, for example 'region=12' or 'article=205'",
+)
+@click.option("--gzip", "compress", is_flag=True, help="Compress output")
+@click.option("--output", type=click.File("wb"), default="-")
+def export_command(entity, format, since, filters, compress, output):
+    with current_app.app_context(), read_only():
+        args = MultiDict([filter.split("=", 1) for filter in filters])
+        chunks = export(entity, format, cases_filter(args), since)
+        if compress:
+            chunks = gzip_stream(chunks)
+        else:
+            chunks = (chunk.encode("utf-8") for chunk in chunks)
+        for chunk in chunks:
+            output.write(chunk)
 
 
 @click.command("scrape")
@@ -58,16 +170,18 @@ def init_db_command():
 @click.argument("article")
 @click.argument("sub_type_index")
 def scrape(court_code, article, sub_type_index):
+    from . import tasks
+
     with current_app.app_context():
         click.echo("Send scraping task to worker queue ..")
-        tasks.scrape_court.apply_async(
-            (court_code, article, tasks.SUB_TYPES[int(sub_type_index)]), retry=False
-        )
+        tasks.enqueue_scrape(court_code, article, tasks.SUB_TYPES[int(sub_type_index)])
 
 
 @click.command("scrape-all-articles")
 @click.argument("court_code")
 def scrape_all(court_code):
+    from . import tasks
+
     with current_app.app_context():
         click.echo("Send scraping all articles task to worker queue ..")
         tasks.scrape_all_articles.apply_async((court_code,), retry=False)
@@ -75,6 +189,8 @@ def scrape_all(court_code):
 
 @click.command("scrape-test-courts")
 def scrape_test_courts():
+    from . import tasks
+
     with current_app.app_context():
         click.echo("Send scraping test courts task to worker queue ..")
         tasks.scrape_test_courts.apply_async((), retry=False)
@@ -82,13 +198,258 @@ def scrape_test_courts():
 
 @click.command("scrape-next-batch")
 def scrape_next_batch():
+    from . import tasks
+
     with current_app.app_context():
         click.echo("Send scraping next batch task to worker queue ..")
         tasks.scrape_next_batch.apply_async((5,), retry=False)
 
 
+@click.command("reparse-archive")
+@click.argument("court_code", required=False)
+def reparse_archive(court_code):
+    from . import tasks
+
+    with current_app.app_context():
+        click.echo("Send re-parse archive task to worker queue ..")
+        tasks.reparse_archive.apply_async((court_code,), retry=False)
+
+
+@click.command("rebuild-stats")
+@click.option("--verify-only", is_flag=True, help="Only report differences")
+def rebuild_stats_command(verify_only):
+    with current_app.app_context():
+        # Compare statistics kept up-to-date by the ingestion with the cases
+        differences = verify_stats()
+        for key, (stored, expected) in sorted(differences.items()):
+            dimension, value, date_field, month = key
+            click.echo(
+                "{}={} {}={}: stored {}, expected {}".format(
+                    dimension, value, date_field, month or "-", stored, expected
+                )
+            )
+        click.echo("Found {} differences".format(len(differences)))
+        if verify_only:
+            return
+
+        click.echo("Rebuild statistics ..")
+        count = rebuild_stats()
+        bump_data_version(CASES)
+        click.echo("Stored {} statistic rows".format(count))
+
+
+@click.command("fingerprint-cases")
+def fingerprint_cases():
+    with current_app.app_context():
+        # Fingerprint cases which were scraped before we had fingerprints,
+        # otherwise the next scrape compares all their fields once
+        click.echo("Fingerprint cases ..")
+        count = backfill_case_fingerprints()
+        click.echo("Fingerprinted {} cases".format(count))
+
+
 @click.command("clean-sessions")
 def clean_sessions():
+    from . import tasks
+
     with current_app.app_context():
         click.echo("Send clean sessions task to worker queue ..")
         tasks.clean_sessions.apply_async((), retry=False)
+
+
+@click.command("release-court")
+@click.argument("court_code")
+def release_court(court_code):
+    from .retry import release_court
+
+    with current_app.app_context():
+        # Scrape a quarantined court again, for example after fixing the parser
+        if release_court(court_code):
+            click.echo("Released court {} from quarantine".format(court_code))
+        else:
+            click.echo("Court {} was not quarantined".format(court_code))
+
+
+@click.command("vacuum-database")
+@click.option(
+    "--full",
+    is_flag=True,
+    help="Rebuild the whole database and switch it to incremental vacuum mode, "
+    "locks the database until done",
+)
+def vacuum_database(full):
+    from . import tasks
+
+    with current_app.app_context():
+        if full:
+            from .retention import full_vacuum
+
+            click.echo("Rebuild database, this blocks all other writers ..")
+            freed_pages = full_vacuum()
+            if freed_pages is None:
+                click.echo("Database does not need to be vacuumed")
+            else:
+                click.echo("Vacuumed database, freed {} pages".format(freed_pages))
+            return
+        click.echo("Send vacuum database task to worker queue ..")
+        tasks.vacuum_database.apply_async((), retry=False)
+
+
+@click.command("benchmark-moscow")
+@click.option("--cards", default=100, show_default=True)
+@click.option("--latency-sec", default=0.5, show_default=True)
+@click.option("--workers", default=4, show_default=True)
+@click.option("--min-interval-sec", default=0.0, show_default=True)
+@click.option("--max-interval-sec", default=0.0, show_default=True)
+def benchmark_moscow(cards, latency_sec, workers, min_interval_sec, max_interval_sec):
+    from .benchmark import benchmark_moscow
+
+    with current_app.app_context():
+        # Scrape a local stand-in of the Moscow meta search
+        result = benchmark_moscow(
+            cards, latency_sec, workers, min_interval_sec, max_interval_sec
+        )
+        click.echo(
+            "Fetched {} cards ({} results) in {:.1f}s: {:.1f} cards/minute".format(
+                result["cards"],
+                result["results"],
+                result["seconds"],
+                result["cards_per_minute"],
+            )
+        )
+        click.echo(
+            "{} of {} search pages kept the instance".format(
+                result["pages_with_instance"], result["pages"]
+            )
+        )
+
+
+@click.command("benchmark-pagination")
+@click.option("--database", default="/tmp/solidarityzone-pagination.sqlite")
+@click.option("--rows", default=2000000, show_default=True)
+@click.option("--offsets", default="0,10000,100000,1000000,1900000", show_default=True)
+@click.option("--repeat", default=5, show_default=True)
+def benchmark_pagination(database, rows, offsets, repeat):
+    from .benchmark import benchmark_pagination
+
+    with current_app.app_context():
+        # Page through a database of synthetic cases, creating it first
+        click.echo("Prepare {} synthetic cases in {} ..".format(rows, database))
+        result = benchmark_pagination(
+            database, rows, [int(offset) for offset in offsets.split(",")], repeat
+        )
+        for row in result["results"]:
+            click.echo(
+                "Offset {:>9}: page {:.1f}ms (with OFFSET {:.1f}ms)".format(
+                    row["offset"], row["page_ms"], row["offset_ms"]
+                )
+            )
+
+
+@click.command("scrape-hours")
+def scrape_hours():
+    with current_app.app_context():
+        # Show how searches went per local hour and when we're scraping
+        stats = hour_stats()
+        timezones = sorted(set(region_timezones().values()) | set(stats.keys()))
+        for timezone in timezones:
+            timezone_stats = stats.get(timezone, {})
+            hours = preferred_hours(timezone_stats)
+            click.echo(
+                "{} (now {}h): scraping at {}".format(
+                    timezone,
+                    local_hour(timezone),
+                    ", ".join("{}h".format(hour) for hour in sorted(hours)),
+                )
+            )
+            for hour, stat in sorted(timezone_stats.items()):
+                click.echo(
+                    "  {:>2}h searches={} success={:.0%} latency={:.2f}s".format(
+                        hour, stat["searches"], stat["success_rate"], stat["latency"]
+                    )
+                )
+
+
+@click.command("scraper-pools")
+def scraper_pools():
+    with current_app.app_context():
+        # Show which pool scrapes how many courts and how often it got blocked
+        court_codes = db.session.execute(db.select(Court.code)).scalars().all()
+        assigned = Counter(assign_pool(court_code) for court_code in court_codes)
+        for pool, proxy in sorted(pools().items()):
+            stats = pool_stats(pool)
+            click.echo(
+                "{} queue={} proxy={} courts={} searches={} blocked={} ({:.0%}){}".format(
+                    pool,
+                    pool_queue(pool),
+                    proxy or "-",
+                    assigned[pool],
+                    stats["searches"],
+                    stats["blocked"],
+                    stats["blocked_rate"],
+                    " cooling down" if stats["cooling_down"] else "",
+                )
+            )
+        click.echo("Found {} pools".format(len(pools())))
+
+
+@click.command("metrics")
+def show_metrics():
+    with current_app.app_context():
+        for name, value in metrics.all_metrics().items():
+            click.echo("{} {}".format(name, value))
+
+
+# Heavy modules only the worker needs, none of them may be loaded by the web
+# process
+HEAVY_MODULES = [
+    "bs4",
+    "pytorch_lightning",
+    "torch",
+    "torchvision",
+    "solidarityzone.captcha",
+    "solidarityzone.scraper",
+    "solidarityzone.tasks",
+]
+
+STARTUP_SCRIPT = """
+import json, resource, sys, time
+started_at = time.perf_counter()
+import solidarityzone
+import_sec = time.perf_counter() - started_at
+print(json.dumps({
+    "import_sec": import_sec,
+    "rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+    "heavy_modules": [name for name in %r if name in sys.modules],
+}))
+"""
+
+
+@click.command("benchmark-startup")
+@click.option("--max-import-sec", default=5.0, show_default=True)
+@click.option("--max-rss-mb", default=150.0, show_default=True)
+def benchmark_startup(max_import_sec, max_rss_mb):
+    # Start the web process in a fresh interpreter and check it stays light
+    result = subprocess.run(
+        [sys.executable, "-c", STARTUP_SCRIPT % HEAVY_MODULES],
+        capture_output=True,
+        check=True,
+        text=True,
+    )
+    startup = json.loads(result.stdout.strip().splitlines()[-1])
+    click.echo("import time: {:.2f}s".format(startup["import_sec"]))
+    click.echo("max. RSS: {:.1f}MB".format(startup["rss_mb"]))
+    click.echo("heavy modules: {}".format(", ".join(startup["heavy_modules"]) or "-"))
+
+    failed = False
+    if startup["import_sec"] > max_import_sec:
+        click.echo("import takes longer than {}s".format(max_import_sec), err=True)
+        failed = True
+    if startup["rss_mb"] > max_rss_mb:
+        click.echo("RSS is larger than {}MB".format(max_rss_mb), err=True)
+        failed = True
+    if len(startup["heavy_modules"]) > 0:
+        click.echo("web process loads heavy modules", err=True)
+        failed = True
+    if failed:
+        raise SystemExit(1)
@@ -0,0 +1,189 @@
+import json
+import zlib
+
+from sqlalchemy.exc import IntegrityError
+
+from .models import (
+    Court,
+    ScrapeSession,
+    ScrapeSessionDetail,
+    ScrapeSessionProfile,
+    Url,
+    db,
+)
+
+# Number of URLs we're looking up in the database at once
+URL_BATCH_SIZE = 500
+
+
+class SessionDiagnostics:
+    # Everything we want to know about a scrape session when debugging it:
+    # search parameters and outcome, all visited URLs and the error message
+
+    def __init__(self, fields, urls=None, message=None):
+        self.fields = fields
+        self.urls = urls if urls is not None else []
+        self.message = message
+
+    def format(self):
+        lines = ["{}={}".format(name, value) for name, value in self.fields.items()]
+        lines.append("urls=" + "".join("\n* {}".format(url) for url in self.urls))
+        lines.append("debug_message={}".format(self.message))
+        return "\n".join(lines)
+
+
+def intern_urls(urls):
+    # Store every URL only once and return their ids in the same order
+    ids = {}
+    distinct_urls = list(dict.fromkeys(urls))
+    while len(distinct_urls) > 0:
+        batch = distinct_urls[:URL_BATCH_SIZE]
+        distinct_urls = distinct_urls[URL_BATCH_SIZE:]
+        # Mark existing URLs as used before we look up their ids, so the
+        # retention task can't remove them anymore once we hold their ids
+        query = (
+            db.update(Url).where(Url.url.in_(batch)).values(last_used_at=db.func.now())
+        )
+        db.session.execute(query)
+        query = db.select(Url.id, Url.url).where(Url.url.in_(batch))
+        ids.update({row.url: row.id for row in db.session.execute(query)})
+        for url in batch:
+            if url in ids:
+                continue
+            try:
+                # Another worker might insert the same URL at the same time
+                with db.session.begin_nested():
+                    result = db.session.execute(
+                        db.insert(Url).values(url=url, last_used_at=db.func.now())
+                    )
+                ids[url] = result.inserted_primary_key[0]
+            except IntegrityError:
+                query = db.select(Url.id).where(Url.url == url)
+                ids[url] = db.session.execute(query).scalar()
+    return [ids[url] for url in urls]
+
+
+def pack_diagnostics(fields, url_ids, message):
+    return zlib.compress(
+        json.dumps(
+            {"fields": fields, "url_ids": url_ids, "message": message},
+            ensure_ascii=False,
+        ).encode("utf-8")
+    )
+
+
+def unpack_diagnostics(data):
+    return json.loads(zlib.decompress(data).decode("utf-8"))
+
+
+def store_diagnostics(session_id, diagnostics):
+    data = pack_diagnostics(
+        diagnostics.fields, intern_urls(diagnostics.urls), diagnostics.message
+    )
+    query = (
+        db.update(ScrapeSessionDetail)
+        .where(ScrapeSessionDetail.scrape_session_id == session_id)
+        .values(data=data)
+    )
+    if db.session.execute(query).rowcount == 0:
+        query = db.insert(ScrapeSessionDetail).values(
+            scrape_session_id=session_id, data=data
+        )
+        db.session.execute(query)
+
+
+def load_diagnostics(session_id):
+    query = db.select(ScrapeSessionDetail.data).where(
+        ScrapeSessionDetail.scrape_session_id == session_id
+    )
+    data = db.session.execute(query).scalar()
+    if data is None:
+        return None
+    data = unpack_diagnostics(data)
+
+    # URLs which got removed in the meantime are left out
+    query = db.select(Url.id, Url.url).where(Url.id.in_(set(data["url_ids"])))
+    urls = {row.id: row.url for row in db.session.execute(query)}
+    return SessionDiagnostics(
+        data["fields"],
+        [urls[url_id] for url_id in data["url_ids"] if url_id in urls],
+        data["message"],
+    )
+
+
+# Stages of a scrape we're measuring the time of, in seconds
+PROFILE_STAGES = [
+    "network_seconds",
+    "delay_seconds",
+    "captcha_seconds",
+    "parse_seconds",
+    "ingest_seconds",
+]
+
+# Counters we're keeping next to the timings, with their name in the profile
+PROFILE_COUNTERS = {
+    "pages": "search_requests",
+    "cards": "card_requests",
+    "captchas": "captcha_requests",
+    "bytes": "bytes",
+}
+
+
+def store_profile(session_id, profile):
+    values = {stage: profile.get(stage, 0) for stage in PROFILE_STAGES}
+    values.update(
+        {column: profile.get(name, 0) for column, name in PROFILE_COUNTERS.items()}
+    )
+    query = (
+        db.update(ScrapeSessionProfile)
+        .where(ScrapeSessionProfile.scrape_session_id == session_id)
+        .values(**values)
+    )
+    if db.session.execute(query).rowcount == 0:
+        query = db.insert(ScrapeSessionProfile).values(
+            scrape_session_id=session_id, **values
+        )
+        db.session.execute(query)
+
+
+def load_profile(session_id):
+    query = db.select(ScrapeSessionProfile).where(
+        ScrapeSessionProfile.scrape_session_id == session_id
+    )
+    profile = db.session.execute(query).scalars().first()
+    if profile is None:
+        return None
+    return {
+        name: getattr(profile, name)
+        for name in PROFILE_STAGES + list(PROFILE_COUNTERS.keys())
+    }
+
+
+# Returns average profile of the scrapes per court, courts with the most
+# time spent in the given stage first
+def court_profiles(order, court_ids=None, since=None, limit=None):
+    columns = PROFILE_STAGES + list(PROFILE_COUNTERS.keys())
+    query = (
+        db.select(
+            ScrapeSession.court_id,
+            ScrapeSession.input_court_code,
+            Court.name.label("court_name"),
+            db.func.count(ScrapeSessionProfile.id).label("sessions"),
+            *[
+                db.func.avg(getattr(ScrapeSessionProfile, column)).label(column)
+                for column in columns
+            ],
+        )
+        .select_from(ScrapeSessionProfile)
+        .join(ScrapeSession)
+        .outerjoin(Court)
+        .group_by(ScrapeSession.court_id, ScrapeSession.input_court_code, Court.name)
+        .order_by(db.desc(order))
+    )
+    if court_ids:
+        query = query.where(ScrapeSession.court_id.in_(court_ids))
+    if since is not None:
+        query = query.where(ScrapeSessionProfile.created_at >= since)
+    if limit is not None:
+        query = query.limit(limit)
+    return [row._asdict() for row in db.session.execute(query)]
@@ -0,0 +1,134 @@
+import csv
+import datetime
+import io
+import json
+import zlib
+
+from .models import Case, Court, Region, ScrapeLog, db
+
+# Number of rows we're loading from the database at once
+EXPORT_BATCH_SIZE = 1000
+
+EXPORT_FORMATS = ("ndjson", "csv")
+
+CASE_COLUMNS = [
+    Case.id,
+    Case.case_number,
+    Case.defendant_name,
+    Case.articles,
+    Case.judge_name,
+    Case.sub_type,
+    Case.entry_date,
+    Case.result_date,
+    Case.effective_date,
+    Case.result,
+    Case.url,
+    Case.created_at,
+    Case.updated_at,
+    Court.id.label("court_id"),
+    Court.code.label("court_code"),
+    Court.name.label("court_name"),
+    Region.id.label("region_id"),
+    Region.name.label("region_name"),
+]
+
+HISTORY_COLUMNS = [
+    ScrapeLog.id,
+    ScrapeLog.case_id,
+    ScrapeLog.scrape_session_id,
+    ScrapeLog.is_update,
+    ScrapeLog.diff,
+    ScrapeLog.created_at,
+    Court.id.label("court_id"),
+    Court.code.label("court_code"),
+    Region.id.label("region_id"),
+]
+
+
+def field_names(columns):
+    return [column.key for column in columns]
+
+
+def prepare_value(value):
+    if isinstance(value, (datetime.date, datetime.datetime)):
+        return value.isoformat()
+    return value
+
+
+def iter_rows(query, id, columns):
+    # Walk through the table in batches ordered by id, this keeps memory
+    # constant no matter how many rows we're exporting
+    names = field_names(columns)
+    last_id = 0
+    while True:
+        batch = db.session.execute(
+            query.where(id > last_id).order_by(id.asc()).limit(EXPORT_BATCH_SIZE)
+        ).all()
+        for row in batch:
+            yield dict(zip(names, [prepare_value(value) for value in row]))
+        if len(batch) < EXPORT_BATCH_SIZE:
+            return
+        last_id = batch[-1].id
+
+
+def iter_cases(filter, since=None):
+    query = (
+        db.select(*CASE_COLUMNS)
+        .select_from(Case)
+        .join(Court)
+        .join(Region)
+        .where(*filter)
+    )
+    if since is not None:
+        query = query.where(Case.updated_at >= since)
+    return iter_rows(query, Case.id, CASE_COLUMNS)
+
+
+def iter_history(filter, since=None):
+    query = (
+        db.select(*HISTORY_COLUMNS)
+        .select_from(ScrapeLog)
+        .join(Case)
+        .join(Court)
+        .join(Region)
+        .where(*filter)
+    )
+    if since is not None:
+        query = query.where(ScrapeLog.created_at >= since)
+    return iter_rows(query, ScrapeLog.id, HISTORY_COLUMNS)
+
+
+def to_ndjson(rows):
+    for row in rows:
+        yield json.dumps(row, ensure_ascii=False) + "\n"
+
+
+def to_csv(rows, fields):
+    buffer = io.StringIO()
+    writer = csv.DictWriter(buffer, fieldnames=fields)
+    writer.writeheader()
+    for row in rows:
+        writer.writerow(row)
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate(0)
+    yield buffer.getvalue()
+
+
+def export(entity, format, filter, since=None):
+    if entity == "cases":
+        rows, fields = iter_cases(filter, since), field_names(CASE_COLUMNS)
+    else:
+        rows, fields = iter_history(filter, since), field_names(HISTORY_COLUMNS)
+    if format == "csv":
+        return to_csv(rows, fields)
+    return to_ndjson(rows)
+
+
+def gzip_stream(chunks):
+    compressor = zlib.compressobj(wbits=31)
+    for chunk in chunks:
+        data = compressor.compress(chunk.encode("utf-8"))
+        if len(data) > 0:
+            yield data
+    yield compressor.flush()
@@ -3,15 +3,16 @@ import { Typography } from '@mui/material';
 import { CaseHistoryTable } from '~/components/CaseHistoryTable';
 import { usePaginationQuery } from '~/hooks';
 
-import type { ScrapeLog } from '~/types';
+import type { PaginationResult, ScrapeLog } from '~/types';
 
 type Props = {
   id: string;
+  initialResult?: PaginationResult<ScrapeLog>;
 };
 
-export const CaseHistory = ({ id }: Props) => {
+export const CaseHistory = ({ id, initialResult }: Props) => {
   const { isLoading, result, handlePaginationChange } =
-    usePaginationQuery<ScrapeLog>(`/api/cases/${id}/history`);
+    usePaginationQuery<ScrapeLog>(`/api/cases/${id}/history`, initialResult);
 
   return isLoading && !result ? (
     <Typography>Loading ...</Typography>
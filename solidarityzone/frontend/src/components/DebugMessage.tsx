@@ -1,7 +1,7 @@
 import { OutlinedInput } from '@mui/material';
 
 type Props = {
-  message: string;
+  message?: string;
 };
 
 export const DebugMessage = ({ message }: Props) => {
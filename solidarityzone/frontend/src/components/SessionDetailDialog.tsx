@@ -6,8 +6,10 @@ import {
   IconButton,
   Typography,
 } from '@mui/material';
+import { useEffect, useState } from 'react';
 
 import { formatDateTime } from '~/utils';
+import { get } from '~/request';
 import { SessionDetail } from '~/components/SessionDetail';
 import { DebugMessage } from '~/components/DebugMessage';
 
@@ -18,28 +20,51 @@ type Props = {
   handleClose: () => void;
 };
 
-export const SessionDetailDialog = ({ session, handleClose }: Props) => (
-  <Dialog onClose={handleClose} open={session !== undefined}>
-    <DialogTitle>
-      Session {formatDateTime(session?.created_at)}
-      <IconButton
-        onClick={handleClose}
-        sx={{
-          position: 'absolute',
-          right: 8,
-          top: 8,
-          color: (theme) => theme.palette.grey[500],
-        }}
-      >
-        <Close />
-      </IconButton>
-    </DialogTitle>
-    <DialogContent dividers>
-      {session && <SessionDetail data={session} />}
-      <Typography mt={2} variant="subtitle1" fontWeight="bold">
-        Debug Message
-      </Typography>
-      {session && <DebugMessage message={session.debug_message} />}
-    </DialogContent>
-  </Dialog>
-);
+export const SessionDetailDialog = ({ session, handleClose }: Props) => {
+  const [details, setDetails] = useState<ScrapeSession | undefined>();
+
+  // Debug messages are not part of the sessions list, load them on demand
+  useEffect(() => {
+    setDetails(undefined);
+    if (!session) {
+      return;
+    }
+
+    const fetchData = async () => {
+      const response = await get<ScrapeSession>(`/api/sessions/${session.id}`);
+      setDetails(response);
+    };
+
+    fetchData();
+  }, [session]);
+
+  return (
+    <Dialog onClose={handleClose} open={session !== undefined}>
+      <DialogTitle>
+        Session {formatDateTime(session?.created_at)}
+        <IconButton
+          onClick={handleClose}
+          sx={{
+            position: 'absolute',
+            right: 8,
+            top: 8,
+            color: (theme) => theme.palette.grey[500],
+          }}
+        >
+          <Close />
+        </IconButton>
+      </DialogTitle>
+      <DialogContent dividers>
+        {session && <SessionDetail data={session} />}
+        <Typography mt={2} variant="subtitle1" fontWeight="bold">
+          Debug Message
+        </Typography>
+        {details ? (
+          <DebugMessage message={details.debug_message} />
+        ) : (
+          <Typography>Loading ...</Typography>
+        )}
+      </DialogContent>
+    </Dialog>
+  );
+};
@@ -1,15 +1,23 @@
-import { useCallback, useEffect, useMemo, useState } from 'react';
+import { useCallback, useEffect, useMemo, useRef, useState } from 'react';
 import { useSearchParams } from 'react-router-dom';
 
 import { toPaginationParams } from '~/utils';
 import { get } from '~/request';
 
-import type { PaginationResult } from '~/types';
+import type { BatchResult, PaginationResult } from '~/types';
 
-export function usePaginationQuery<T>(path: string) {
+export function usePaginationQuery<T>(
+  path: string,
+  initialResult?: PaginationResult<T>,
+) {
   const [searchParams, setSearchParams] = useSearchParams();
   const [isLoading, setIsLoading] = useState(false);
-  const [result, setResult] = useState<PaginationResult<T> | undefined>();
+  const [result, setResult] = useState<PaginationResult<T> | undefined>(
+    initialResult,
+  );
+  // Page of the current params might have been loaded together with other
+  // data already
+  const skipFirstPage = useRef(initialResult !== undefined);
 
   const handlePaginationChange = useCallback(
     (before?: string, after?: string, itemsPerPage?: number) => {
@@ -19,6 +27,11 @@ export function usePaginationQuery<T>(path: string) {
   );
 
   useEffect(() => {
+    if (skipFirstPage.current) {
+      skipFirstPage.current = false;
+      return;
+    }
+
     const fetchData = async () => {
       setIsLoading(true);
 
@@ -196,8 +209,8 @@ export function useResolveIdQuery<T>(
         value.map((value) => ['id', value.toString()]),
       );
 
-      const response = await window.fetch(`${path}?${params}`);
-      const data: PaginationResult<T> = await response.json();
+      const response = await window.fetch(`${path}/batch?${params}`);
+      const data: BatchResult<T> = await response.json();
       setResolved(data.items);
       setIsLoading(false);
     };
@@ -12,6 +12,10 @@ export type PaginationResult<T> = {
   items: T[];
 };
 
+export type BatchResult<T> = {
+  items: T[];
+};
+
 export type PaginationArgs = {
   itemsPerPage?: number;
   before?: string;
@@ -46,7 +50,9 @@ export type ScrapeSession = Base & {
   ignored_cases: number;
   court: Court;
   region: Region;
-  debug_message: string;
+  // Only included in session details
+  debug_message?: string;
+  urls?: string[];
 };
 
 export type ScrapeLog = Base & {
@@ -71,4 +77,9 @@ export type Case = Base & {
   region: Region;
 };
 
+export type CaseDetail = {
+  case: Case;
+  history: PaginationResult<ScrapeLog>;
+};
+
 export type DateValue = string | null;
@@ -1,17 +1,22 @@
 import { Article } from '@mui/icons-material';
 import { Typography } from '@mui/material';
-import { Fragment, useEffect, useState } from 'react';
-import { useParams } from 'react-router-dom';
+import { Fragment, useEffect, useRef, useState } from 'react';
+import { useParams, useSearchParams } from 'react-router-dom';
 
 import { CaseDetail } from '~/components/CaseDetail';
 import { CaseHistory } from '~/components/CaseHistory';
 import { get } from '~/request';
 
-import type { Case as CaseType } from '~/types';
+import type { CaseDetail as CaseDetailType } from '~/types';
 
 const Case = () => {
-  const [data, setData] = useState<CaseType | undefined>();
+  const [data, setData] = useState<CaseDetailType | undefined>();
   const { id } = useParams();
+  const [searchParams] = useSearchParams();
+  // History pagination params of the URL, following pages get loaded by the
+  // history itself so they don't load the case again
+  const historyParams = useRef(searchParams);
+  historyParams.current = searchParams;
 
   useEffect(() => {
     const fetchData = async () => {
@@ -19,7 +24,10 @@ const Case = () => {
         return;
       }
 
-      const response = await get<CaseType>(`/api/cases/${id}`);
+      const response = await get<CaseDetailType>(
+        `/api/cases/${id}/detail`,
+        historyParams.current,
+      );
       setData(response);
     };
 
@@ -31,13 +39,13 @@ const Case = () => {
   ) : (
     <Fragment>
       <Typography mb={2} variant="h5">
-        <Article /> {data.defendant_name} ({data.court.name})
+        <Article /> {data.case.defendant_name} ({data.case.court.name})
       </Typography>
-      <CaseDetail data={data} />
+      <CaseDetail data={data.case} />
       <Typography mt={4} mb={2} variant="h5">
         History
       </Typography>
-      <CaseHistory id={id} />
+      <CaseHistory id={id} initialResult={data.history} />
     </Fragment>
   );
 };
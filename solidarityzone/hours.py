@@ -0,0 +1,203 @@
+import datetime
+import json
+import os
+from zoneinfo import ZoneInfo
+
+from flask import current_app
+from sqlalchemy.exc import IntegrityError
+
+from .models import Court, CourtSchedule, Region, ScrapeHourStat, db
+
+REGION_TIMEZONES_PATH = os.path.join(
+    os.path.dirname(__file__), "data", "region-timezones.json"
+)
+
+_region_timezones = None
+
+
+def region_timezones():
+    # Timezone per region name, can be extended or changed via the
+    # SCRAPER_REGION_TIMEZONES setting
+    global _region_timezones
+    if _region_timezones is None:
+        with open(REGION_TIMEZONES_PATH, "r") as file:
+            _region_timezones = json.load(file)
+    timezones = dict(_region_timezones)
+    timezones.update(current_app.config["SCRAPER_REGION_TIMEZONES"] or {})
+    return timezones
+
+
+def region_timezone(region_name, timezones=None):
+    timezones = timezones if timezones is not None else region_timezones()
+    return timezones.get(
+        (region_name or "").strip(), current_app.config["SCRAPER_DEFAULT_TIMEZONE"]
+    )
+
+
+def court_timezone(court_code):
+    # Courts which are not in the database (Moscow meta search) use the
+    # default timezone
+    query = (
+        db.select(Region.name)
+        .select_from(Court)
+        .join(Region)
+        .where(Court.code == court_code)
+    )
+    return region_timezone(db.session.execute(query).scalar())
+
+
+def local_hour(timezone, now=None):
+    if now is None:
+        now = datetime.datetime.now(datetime.timezone.utc)
+    return now.astimezone(ZoneInfo(timezone)).hour
+
+
+def is_off_peak(hour):
+    # Configured window can span midnight, for example from 18 to 9 o'clock
+    start = current_app.config["SCRAPER_OFF_PEAK_START_HOUR"]
+    end = current_app.config["SCRAPER_OFF_PEAK_END_HOUR"]
+    if start <= end:
+        return start <= hour < end
+    return hour >= start or hour < end
+
+
+def record_hour_stat(timezone, hour, is_successful, requests, network_seconds):
+    values = {
+        "searches": 1,
+        "successful_searches": int(is_successful),
+        "requests": requests,
+        "network_seconds": network_seconds,
+    }
+    query = (
+        db.update(ScrapeHourStat)
+        .where(ScrapeHourStat.timezone == timezone, ScrapeHourStat.hour == hour)
+        .values(
+            **{
+                name: getattr(ScrapeHourStat, name) + value
+                for name, value in values.items()
+            }
+        )
+    )
+    if db.session.execute(query).rowcount > 0:
+        return
+    try:
+        # Another worker might insert the same row at the same time
+        with db.session.begin_nested():
+            query = db.insert(ScrapeHourStat).values(
+                timezone=timezone, hour=hour, **values
+            )
+            db.session.execute(query)
+    except IntegrityError:
+        record_hour_stat(timezone, hour, is_successful, requests, network_seconds)
+
+
+def hour_stats():
+    query = db.select(ScrapeHourStat).order_by(
+        ScrapeHourStat.timezone, ScrapeHourStat.hour
+    )
+    stats = {}
+    for stat in db.session.execute(query).scalars():
+        stats.setdefault(stat.timezone, {})[stat.hour] = {
+            "searches": stat.searches,
+            "success_rate": stat.successful_searches / stat.searches,
+            "latency": stat.network_seconds / stat.requests if stat.requests else 0,
+        }
+    return stats
+
+
+# Returns the local hours we'd like to scrape courts of a timezone at: hours
+# with enough searches count when most of them went through fast enough,
+# otherwise the configured off-peak window decides
+def preferred_hours(timezone_stats):
+    config = current_app.config
+    searched = [
+        stat
+        for stat in timezone_stats.values()
+        if stat["searches"] >= config["SCRAPER_HOUR_MIN_SEARCHES"]
+    ]
+    average_latency = (
+        sum(stat["latency"] for stat in searched) / len(searched) if searched else 0
+    )
+
+    hours = set()
+    for hour in range(24):
+        stat = timezone_stats.get(hour)
+        if stat is None or stat["searches"] < config["SCRAPER_HOUR_MIN_SEARCHES"]:
+            if is_off_peak(hour):
+                hours.add(hour)
+        elif (
+            stat["success_rate"] >= config["SCRAPER_HOUR_MIN_SUCCESS_RATE"]
+            and stat["latency"]
+            <= average_latency * config["SCRAPER_HOUR_MAX_LATENCY_FACTOR"]
+        ):
+            hours.add(hour)
+
+    # Never leave a timezone without any hours
+    if len(hours) == 0:
+        hours = {hour for hour in range(24) if is_off_peak(hour)}
+    return hours
+
+
+# Returns the next courts to scrape, those which waited longest first. Only
+# courts which are in one of their preferred local hours right now get picked,
+# unless they waited too long already
+def pick_courts(num_courts, court_codes=(), now=None):
+    config = current_app.config
+    if now is None:
+        now = datetime.datetime.now(datetime.timezone.utc)
+    utcnow = now.astimezone(datetime.timezone.utc).replace(tzinfo=None)
+    min_interval = datetime.timedelta(
+        seconds=config["SCRAPER_SCHEDULE_MIN_INTERVAL_SEC"]
+    )
+    max_wait = datetime.timedelta(seconds=config["SCRAPER_SCHEDULE_MAX_WAIT_SEC"])
+
+    timezones = region_timezones()
+    query = (
+        db.select(Court.code, Region.name.label("region_name"))
+        .join(Region)
+        .order_by(Court.id)
+    )
+    courts = [
+        (row.code, region_timezone(row.region_name, timezones))
+        for row in db.session.execute(query)
+    ]
+    courts.extend(
+        (court_code, config["SCRAPER_DEFAULT_TIMEZONE"]) for court_code in court_codes
+    )
+    query = db.select(CourtSchedule.court_code, CourtSchedule.scheduled_at)
+    scheduled = {row.court_code: row.scheduled_at for row in db.session.execute(query)}
+    courts.sort(key=lambda court: scheduled.get(court[0]) or datetime.datetime.min)
+
+    stats = hour_stats()
+    hours = {}
+    picked = []
+    for court_code, timezone in courts:
+        if len(picked) >= num_courts:
+            break
+        scheduled_at = scheduled.get(court_code)
+        if scheduled_at is not None and scheduled_at > utcnow - min_interval:
+            # Everything else has been scraped recently as well
+            break
+        if timezone not in hours:
+            hours[timezone] = preferred_hours(stats.get(timezone, {}))
+        if local_hour(timezone, now) in hours[timezone] or (
+            scheduled_at is not None and scheduled_at < utcnow - max_wait
+        ):
+            picked.append(court_code)
+
+    # Remember when we've scheduled these courts
+    known = [court_code for court_code in picked if court_code in scheduled]
+    if len(known) > 0:
+        db.session.execute(
+            db.update(CourtSchedule)
+            .where(CourtSchedule.court_code.in_(known))
+            .values(scheduled_at=utcnow)
+        )
+    new = [court_code for court_code in picked if court_code not in scheduled]
+    if len(new) > 0:
+        db.session.execute(
+            db.insert(CourtSchedule),
+            [{"court_code": court_code, "scheduled_at": utcnow} for court_code in new],
+        )
+    db.session.commit()
+    return picked
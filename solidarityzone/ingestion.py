@@ -0,0 +1,119 @@
+import hashlib
+
+from flask import json
+
+from .models import Case, CaseArticle, db
+from .utils import parse_articles
+
+UPDATEABLE_CASE_FIELDS = [
+    "effective_date",
+    "judge_name",
+    "result",
+    "result_date",
+]
+
+
+# Change format to make comparison of values possible
+def normalize_field(field_name, value):
+    if value is None:
+        return None
+    if "date" in field_name:
+        return value.strftime("%d.%m.%Y")
+    return value.strip()
+
+
+# Hash of all updateable fields of a case, normalized the same way as when
+# comparing them. Takes a scraped item or a row of the cases table
+def case_fingerprint(case):
+    values = [
+        normalize_field(
+            field_name,
+            case[field_name] if isinstance(case, dict) else getattr(case, field_name),
+        )
+        for field_name in UPDATEABLE_CASE_FIELDS
+    ]
+    return hashlib.sha256(
+        json.dumps(values, ensure_ascii=False).encode("utf-8")
+    ).hexdigest()
+
+
+# Keep parsed articles of a case in a separate table, so we can look them up
+# via an index instead of searching in the raw `articles` string. Returns the
+# number of inserted articles
+def insert_case_articles(case_id, articles):
+    values = [
+        {"case_id": case_id, "article": article, "part": part}
+        for article, part in parse_articles(articles)
+    ]
+    if len(values) > 0:
+        db.session.execute(db.insert(CaseArticle), values)
+    return len(values)
+
+
+def backfill_case_articles(batch_size=1000):
+    # Index articles of all cases which have not been indexed yet and return
+    # how many articles got inserted. Cases whose articles can't be parsed
+    # are marked as well, so they don't get read again every time
+    indexed = db.select(CaseArticle.id).where(CaseArticle.case_id == Case.id)
+    count = 0
+    last_id = 0
+    while True:
+        query = (
+            db.select(Case.id, Case.articles, indexed.exists().label("is_indexed"))
+            .where(Case.id > last_id, Case.articles_parsed.is_(None))
+            .order_by(Case.id)
+            .limit(batch_size)
+        )
+        cases = db.session.execute(query).all()
+        parsed = {True: [], False: []}
+        for case in cases:
+            # Cases indexed before we marked them already have their rows
+            inserted = (
+                0 if case.is_indexed else insert_case_articles(case.id, case.articles)
+            )
+            count += inserted
+            parsed[case.is_indexed or inserted > 0].append(case.id)
+        for articles_parsed, case_ids in parsed.items():
+            if len(case_ids) > 0:
+                db.session.execute(
+                    db.update(Case)
+                    .where(Case.id.in_(case_ids))
+                    .values(articles_parsed=articles_parsed, updated_at=Case.updated_at)
+                )
+        db.session.commit()
+        if len(cases) < batch_size:
+            return count
+        last_id = cases[-1].id
+
+
+def backfill_case_fingerprints(batch_size=1000):
+    # Fingerprint all cases which were scraped before we had fingerprints,
+    # their data did not change so they keep their update time
+    fields = [getattr(Case, field_name) for field_name in UPDATEABLE_CASE_FIELDS]
+    count = 0
+    last_id = 0
+    while True:
+        query = (
+            db.select(Case.id, Case.updated_at, *fields)
+            .where(Case.id > last_id, Case.fingerprint.is_(None))
+            .order_by(Case.id)
+            .limit(batch_size)
+        )
+        cases = db.session.execute(query).all()
+        if len(cases) > 0:
+            db.session.execute(
+                db.update(Case),
+                [
+                    {
+                        "id": case.id,
+                        "fingerprint": case_fingerprint(case),
+                        "updated_at": case.updated_at,
+                    }
+                    for case in cases
+                ],
+            )
+        db.session.commit()
+        count += len(cases)
+        if len(cases) < batch_size:
+            return count
+        last_id = cases[-1].id
@@ -0,0 +1,41 @@
+import threading
+import uuid
+
+from .store import get_store, key
+
+
+class HostLease:
+    # Distributed lease on a court host, making sure that only one task talks
+    # to the same server at a time. The lease expires automatically after
+    # `ttl_sec` if a worker dies, while it is held a background thread keeps
+    # renewing it
+
+    def __init__(self, host, ttl_sec, store=None):
+        self.host = host
+        self.ttl_ms = int(ttl_sec * 1000)
+        self.store = store if store is not None else get_store()
+        self.key = key("lease", host)
+        self.token = uuid.uuid4().hex
+        self.stopped = threading.Event()
+        self.renewer = None
+
+    def acquire(self):
+        if not self.store.set(self.key, self.token, nx=True, px=self.ttl_ms):
+            return False
+        self.stopped.clear()
+        self.renewer = threading.Thread(target=self._renew, daemon=True)
+        self.renewer.start()
+        return True
+
+    def _renew(self):
+        # Renew three times per TTL so a slow network never loses the lease
+        while not self.stopped.wait(self.ttl_ms / 1000 / 3):
+            if not self.store.compare_and_pexpire(self.key, self.token, self.ttl_ms):
+                break
+
+    def release(self):
+        self.stopped.set()
+        if self.renewer is not None:
+            self.renewer.join()
+            self.renewer = None
+        self.store.compare_and_delete(self.key, self.token)
@@ -0,0 +1,53 @@
+import logging
+
+import redis
+
+from .store import get_store, key
+
+logger = logging.getLogger(__name__)
+
+# All counters live in one Redis hash, so web and worker processes can read
+# and write them alike
+METRICS_KEY = key("metrics")
+
+
+def metric_name(name, labels):
+    if len(labels) == 0:
+        return name
+    return "{}{{{}}}".format(
+        name,
+        ",".join(
+            '{}="{}"'.format(label, str(value).replace('"', '\\"'))
+            for label, value in sorted(labels.items())
+        ),
+    )
+
+
+# Increase a counter, failing silently as metrics should never break scraping
+def incr(name, amount=1, **labels):
+    try:
+        get_store().hincrbyfloat(METRICS_KEY, metric_name(name, labels), amount)
+    except redis.RedisError as err:
+        logger.warning("Could not record metric {}: {}".format(name, err))
+
+
+# Record a measurement (for example a duration in seconds) as sum and count
+def observe(name, value, **labels):
+    incr("{}_sum".format(name), value, **labels)
+    incr("{}_count".format(name), 1, **labels)
+
+
+def all_metrics():
+    try:
+        values = get_store().hgetall(METRICS_KEY)
+    except redis.RedisError as err:
+        logger.warning("Could not read metrics: {}".format(err))
+        values = {}
+    return {name: float(value) for name, value in sorted(values.items())}
+
+
+# Renders all metrics in the text format Prometheus is scraping
+def exposition():
+    return "".join(
+        "{} {}\n".format(name, repr(value)) for name, value in all_metrics().items()
+    )
@@ -1,8 +1,60 @@
+import contextlib
 from typing import List
 
+from flask import g, has_app_context
 from flask_sqlalchemy import SQLAlchemy
+from flask_sqlalchemy.session import Session
 
-db = SQLAlchemy()
+# Bind of the read-only database, configured via SQLALCHEMY_READ_DATABASE_URI
+READ_BIND = "read"
+
+
+def is_read_only():
+    return has_app_context() and g.get("read_only", False)
+
+
+# Send queries of the enclosed code to the read-only database, when there is
+# one. Only use this for code which never writes
+@contextlib.contextmanager
+def read_only():
+    previous = g.get("read_only", False)
+    g.read_only = True
+    try:
+        yield
+    finally:
+        g.read_only = previous
+
+
+# Send all queries of the enclosed code to the primary database, even when
+# the request is only reading
+@contextlib.contextmanager
+def primary():
+    previous = g.get("read_only", False)
+    g.read_only = False
+    try:
+        yield
+    finally:
+        g.read_only = previous
+
+
+class RoutingSession(Session):
+    # Selects go to the read-only database while we're only reading,
+    # everything else (and everything without read-only database) goes to
+    # the primary database
+
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        if (
+            bind is None
+            and READ_BIND in self._db.engines
+            and is_read_only()
+            and not self._flushing
+            and getattr(clause, "is_select", False)
+        ):
+            return self._db.engines[READ_BIND]
+        return super().get_bind(mapper=mapper, clause=clause, bind=bind, **kwargs)
+
+
+db = SQLAlchemy(session_options={"class_": RoutingSession})
 
 
 class BaseMixin(object):
@@ -25,9 +77,117 @@ class ScrapeState(BaseMixin, db.Model):
     batch_next_index = db.Column(db.Integer, nullable=False)
 
 
+class ArchivedPage(BaseMixin, db.Model):
+    __tablename__ = "archived_pages"
+    __table_args__ = (
+        db.UniqueConstraint("url", "digest"),
+        {"sqlite_autoincrement": True},
+    )
+
+    # Normalized URL and SHA-256 hash of the page content, `updated_at`
+    # tells us when we've seen this content under this URL for the last time
+    url = db.Column(db.String, nullable=False)
+    digest = db.Column(db.String, nullable=False, index=True)
+    kind = db.Column(db.String, nullable=False)
+    court_code = db.Column(db.String)
+    article = db.Column(db.String)
+    sub_type = db.Column(db.String)
+    size = db.Column(db.Integer, nullable=False)
+
+
+class CourtSchedule(BaseMixin, db.Model):
+    __tablename__ = "court_schedules"
+    __table_args__ = (
+        db.UniqueConstraint("court_code"),
+        {"sqlite_autoincrement": True},
+    )
+
+    # When we've sent the scrape tasks of a court the last time, courts which
+    # waited longest come first in the next batch
+    court_code = db.Column(db.String, nullable=False)
+    scheduled_at = db.Column(db.DateTime(timezone=True), nullable=False)
+
+
+class ScrapeHourStat(BaseMixin, db.Model):
+    __tablename__ = "scrape_hour_stats"
+    __table_args__ = (
+        db.UniqueConstraint("timezone", "hour"),
+        {"sqlite_autoincrement": True},
+    )
+
+    # Outcome of searches per timezone of the courts and hour in their local
+    # time, tells us when the court servers are usually (un)available
+    timezone = db.Column(db.String, nullable=False)
+    hour = db.Column(db.Integer, nullable=False)
+    searches = db.Column(db.Integer, nullable=False)
+    successful_searches = db.Column(db.Integer, nullable=False)
+    requests = db.Column(db.Integer, nullable=False)
+    network_seconds = db.Column(db.Float, nullable=False)
+
+
+class ScrapeCheckpoint(BaseMixin, db.Model):
+    __tablename__ = "scrape_checkpoints"
+    __table_args__ = (
+        db.UniqueConstraint("court_code", "article", "sub_type"),
+        {"sqlite_autoincrement": True},
+    )
+
+    court_code = db.Column(db.String, nullable=False)
+    article = db.Column(db.String, nullable=False)
+    sub_type = db.Column(db.String, nullable=False)
+    # Last completed page of the search, including everything we need to
+    # request the following pages (vnkod, parameters and cookies) as JSON
+    page = db.Column(db.Integer, nullable=False)
+    state = db.Column(db.String, nullable=False)
+
+
+class SearchFingerprint(BaseMixin, db.Model):
+    __tablename__ = "search_fingerprints"
+    __table_args__ = (
+        db.UniqueConstraint("court_code", "article", "sub_type"),
+        {"sqlite_autoincrement": True},
+    )
+
+    court_code = db.Column(db.String, nullable=False)
+    article = db.Column(db.String, nullable=False)
+    sub_type = db.Column(db.String, nullable=False)
+    # Number of results and hashes of the result rows per page (as JSON) of
+    # the last complete search, pages which did not change get skipped. After
+    # a number of `cycles` we're doing a full pass again
+    n_results = db.Column(db.Integer, nullable=False)
+    pages = db.Column(db.String, nullable=False)
+    cycles = db.Column(db.Integer, nullable=False)
+
+
+class CaseStat(BaseMixin, db.Model):
+    __tablename__ = "case_stats"
+    __table_args__ = (
+        db.UniqueConstraint("dimension", "value", "date_field", "month"),
+        {"sqlite_autoincrement": True},
+    )
+
+    # Number of cases per value of a dimension (for example a region id or an
+    # article) and month ("YYYY-MM", empty when date is unknown) of either the
+    # entry or result date, kept up-to-date by the ingestion
+    dimension = db.Column(db.String, nullable=False)
+    value = db.Column(db.String, nullable=False)
+    date_field = db.Column(db.String, nullable=False)
+    month = db.Column(db.String, nullable=False)
+    count = db.Column(db.Integer, nullable=False)
+
+
 class ScrapeSession(BaseMixin, db.Model):
     __tablename__ = "scrape_sessions"
-    __table_args__ = {"sqlite_autoincrement": True}
+    __table_args__ = (
+        # Used to find old sessions which did not change any data
+        db.Index(
+            "ix_scrape_sessions_created_cases_updated_cases_created_at",
+            "created_cases",
+            "updated_cases",
+            "created_at",
+        ),
+        {"sqlite_autoincrement": True},
+    )
 
     court_id: db.Mapped[int] = db.mapped_column(
         db.ForeignKey("courts.id"), nullable=True
@@ -43,15 +203,101 @@ class ScrapeSession(BaseMixin, db.Model):
     is_captcha = db.Column(db.Boolean, nullable=False)
     is_captcha_successful = db.Column(db.Boolean, nullable=False)
     error_type = db.Column(db.String)
+    # Only set for older sessions, see `ScrapeSessionDetail`
     debug_message = db.Column(db.String)
 
 
+class ScrapeSessionDetail(BaseMixin, db.Model):
+    __tablename__ = "scrape_session_details"
+    __table_args__ = (
+        db.UniqueConstraint("scrape_session_id"),
+        {"sqlite_autoincrement": True},
+    )
+
+    scrape_session_id: db.Mapped[int] = db.mapped_column(
+        db.ForeignKey("scrape_sessions.id"), nullable=False
+    )
+
+    # Compressed JSON with diagnostics of the scrape session, visited URLs
+    # are stored as ids of `Url`
+    data = db.Column(db.LargeBinary, nullable=False)
+
+    # Set once URLs and long messages got removed after some time
+    compacted_at = db.Column(db.DateTime)
+
+
+class ScrapeSessionProfile(BaseMixin, db.Model):
+    __tablename__ = "scrape_session_profiles"
+    __table_args__ = (
+        db.UniqueConstraint("scrape_session_id"),
+        {"sqlite_autoincrement": True},
+    )
+
+    scrape_session_id: db.Mapped[int] = db.mapped_column(
+        db.ForeignKey("scrape_sessions.id"), nullable=False
+    )
+
+    # Where the search this session belongs to spent its time, all sessions
+    # of one search share the same profile
+    network_seconds = db.Column(db.Float, nullable=False)
+    delay_seconds = db.Column(db.Float, nullable=False)
+    captcha_seconds = db.Column(db.Float, nullable=False)
+    parse_seconds = db.Column(db.Float, nullable=False)
+    ingest_seconds = db.Column(db.Float, nullable=False)
+    pages = db.Column(db.Integer, nullable=False)
+    cards = db.Column(db.Integer, nullable=False)
+    captchas = db.Column(db.Integer, nullable=False)
+    bytes = db.Column(db.Integer, nullable=False)
+
+
+class Url(BaseMixin, db.Model):
+    __tablename__ = "urls"
+    __table_args__ = (
+        db.UniqueConstraint("url"),
+        {"sqlite_autoincrement": True},
+    )
+
+    url = db.Column(db.String, nullable=False)
+
+    # When the URL was last referenced from diagnostics, unused URLs only get
+    # removed some time after that
+    last_used_at = db.Column(db.DateTime)
+
+
+class ScrapeSessionRollup(BaseMixin, db.Model):
+    __tablename__ = "scrape_session_rollups"
+    __table_args__ = (
+        db.UniqueConstraint("day", "input_court_code", "error_type"),
+        {"sqlite_autoincrement": True},
+    )
+
+    # Daily summary of scrape sessions which got removed after some time
+    day = db.Column(db.Date, nullable=False)
+    input_court_code = db.Column(db.String, nullable=False)
+    error_type = db.Column(db.String, nullable=False)
+    sessions = db.Column(db.Integer, nullable=False)
+    successful_sessions = db.Column(db.Integer, nullable=False)
+    captcha_sessions = db.Column(db.Integer, nullable=False)
+    ignored_cases = db.Column(db.Integer, nullable=False)
+
+
 class ScrapeLog(BaseMixin, db.Model):
     __tablename__ = "scrape_log"
-    __table_args__ = {"sqlite_autoincrement": True}
+    __table_args__ = (
+        # History of a case gets paginated by creation date and id
+        db.Index("ix_scrape_log_case_id_created_at_id", "case_id", "created_at", "id"),
+        # History of a session gets paginated by creation date and id
+        db.Index(
+            "ix_scrape_log_scrape_session_id_created_at_id",
+            "scrape_session_id",
+            "created_at",
+            "id",
+        ),
+        {"sqlite_autoincrement": True},
+    )
 
     scrape_session_id: db.Mapped[int] = db.mapped_column(
-        db.ForeignKey("scrape_sessions.id"), nullable=False
+        db.ForeignKey("scrape_sessions.id"), nullable=False, index=True
     )
     scrape_session: db.Mapped["ScrapeSession"] = db.relationship()
     case_id: db.Mapped[int] = db.mapped_column(
@@ -92,6 +338,11 @@ class Court(BaseMixin, db.Model):
     is_military = db.Column(db.Boolean, nullable=False)
 
 
+CASE_FINGERPRINT_INDEX = (
+    "ix_cases_case_number_court_id_articles_defendant_name_fingerprint"
+)
+
+
 class Case(BaseMixin, db.Model):
     __tablename__ = "cases"
     __table_args__ = (
@@ -99,6 +350,19 @@ class Case(BaseMixin, db.Model):
         # in case they are both anonymized we distinct them via
         # articles
         db.UniqueConstraint("case_number", "court_id", "articles", "defendant_name"),
+        # Cases of a court get paginated by entry date and id
+        db.Index("ix_cases_court_id_entry_date_id", "court_id", "entry_date", "id"),
+        # Unique columns with the fingerprint trailing, covers looking up a
+        # scraped case so unchanged cases are recognized without reading the
+        # table
+        db.Index(
+            CASE_FINGERPRINT_INDEX,
+            "case_number",
+            "court_id",
+            "articles",
+            "defendant_name",
+            "fingerprint",
+        ),
         {"sqlite_autoincrement": True},
     )
 
@@ -117,3 +381,28 @@ class Case(BaseMixin, db.Model):
     result_date = db.Column(db.DateTime)
     sub_type = db.Column(db.String)
     url = db.Column(db.String)
+
+    # Hash of the normalized updateable fields, changes whenever one of them
+    # changed
+    fingerprint = db.Column(db.String)
+
+    # Whether articles could be parsed into `CaseArticle` rows, empty while
+    # the articles of the case were not indexed yet
+    articles_parsed = db.Column(db.Boolean)
+
+
+class CaseArticle(BaseMixin, db.Model):
+    __tablename__ = "case_articles"
+    __table_args__ = (
+        db.Index("ix_case_articles_article_part_case_id", "article", "part", "case_id"),
+        {"sqlite_autoincrement": True},
+    )
+
+    case_id: db.Mapped[int] = db.mapped_column(
+        db.ForeignKey("cases.id"), nullable=False, index=True
+    )
+
+    # Article of the criminal code (for example "205.2") and its part, parsed
+    # from the raw `articles` string of the case
+    article = db.Column(db.String, nullable=False)
+    part = db.Column(db.String)
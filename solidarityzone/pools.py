@@ -0,0 +1,126 @@
+import bisect
+import hashlib
+import time
+
+from flask import current_app
+
+from . import metrics
+from .store import get_store, key
+
+# Number of points every pool gets on the hash ring, more points spread the
+# courts more evenly
+RING_REPLICAS = 100
+
+
+def ring_hash(value):
+    return int(hashlib.md5(value.encode("utf-8")).hexdigest()[:16], 16)
+
+
+class HashRing:
+    # Consistent hashing of court codes to pools: a court always lands on the
+    # same pool, so cookies and captcha state stay with one egress. When a
+    # pool is left out, only its courts move to the following pools
+
+    def __init__(self, pools, replicas=RING_REPLICAS):
+        self.points = sorted(
+            (ring_hash("{}#{}".format(pool, replica)), pool)
+            for pool in pools
+            for replica in range(replicas)
+        )
+        self.hashes = [point for point, _ in self.points]
+
+    def get(self, value, exclude=()):
+        if len(self.points) == 0:
+            return None
+        start = bisect.bisect(self.hashes, ring_hash(value))
+        for index in range(len(self.points)):
+            _, pool = self.points[(start + index) % len(self.points)]
+            if pool not in exclude:
+                return pool
+        return None
+
+
+def pools():
+    # Configured pools with the proxy they're sending requests through, an
+    # empty proxy means the workers of that pool have their own network
+    return current_app.config["SCRAPER_POOLS"] or {}
+
+
+def pool_queue(pool):
+    # Workers of a pool only consume from its queue
+    return "scrape-{}".format(pool)
+
+
+def pool_proxy(pool):
+    if pool is None:
+        return None
+    return pools().get(pool) or None
+
+
+def is_cooling_down(pool, store=None):
+    store = store if store is not None else get_store()
+    return store.get(key("pool", pool, "cooldown")) is not None
+
+
+def assign_pool(court_code, store=None):
+    # Returns the pool scraping this court, skipping pools which got blocked
+    # too often recently. Returns `None` when no pools are configured
+    names = sorted(pools().keys())
+    if len(names) == 0:
+        return None
+    store = store if store is not None else get_store()
+    ring = HashRing(names)
+    cooling_down = [name for name in names if is_cooling_down(name, store)]
+    pool = ring.get(court_code, exclude=cooling_down)
+    if pool is None:
+        # All pools are blocked, stay with the usual one
+        pool = ring.get(court_code)
+    return pool
+
+
+def window_keys(pool, window_sec):
+    window = int(time.time() // window_sec)
+    return (
+        key("pool", pool, "searches", window),
+        key("pool", pool, "blocked", window),
+    )
+
+
+def pool_stats(pool, store=None):
+    config = current_app.config
+    store = store if store is not None else get_store()
+    searches, blocked = store.mget(window_keys(pool, config["SCRAPER_POOL_WINDOW_SEC"]))
+    searches = int(searches or 0)
+    blocked = int(blocked or 0)
+    return {
+        "searches": searches,
+        "blocked": blocked,
+        "blocked_rate": blocked / searches if searches > 0 else 0.0,
+        "cooling_down": is_cooling_down(pool, store),
+    }
+
+
+def record_search(pool, is_blocked, store=None):
+    # Count searches and blocked searches of a pool in the current time
+    # window. When too many get blocked its courts move to the other pools
+    # until the cooldown is over
+    config = current_app.config
+    store = store if store is not None else get_store()
+    window_sec = config["SCRAPER_POOL_WINDOW_SEC"]
+    searches_key, blocked_key = window_keys(pool, window_sec)
+    searches = store.incr(searches_key)
+    store.pexpire(searches_key, window_sec * 2 * 1000)
+    metrics.incr("scraper_pool_searches_total", pool=pool)
+    if not is_blocked:
+        return
+    blocked = store.incr(blocked_key)
+    store.pexpire(blocked_key, window_sec * 2 * 1000)
+    metrics.incr("scraper_pool_blocked_total", pool=pool)
+
+    if (
+        searches >= config["SCRAPER_POOL_MIN_SEARCHES"]
+        and blocked / searches >= config["SCRAPER_POOL_MAX_BLOCKED_RATE"]
+    ):
+        cooldown_key = key("pool", pool, "cooldown")
+        if store.set(cooldown_key, 1, nx=True, ex=config["SCRAPER_POOL_COOLDOWN_SEC"]):
+            metrics.incr("scraper_pool_rebalanced_total", pool=pool)
@@ -0,0 +1,355 @@
+import time
+from collections import Counter
+
+from . import metrics
+from .diagnostics import pack_diagnostics, unpack_diagnostics
+from .models import (
+    ScrapeLog,
+    ScrapeSession,
+    ScrapeSessionDetail,
+    ScrapeSessionProfile,
+    ScrapeSessionRollup,
+    Url,
+    db,
+)
+
+# SQLite "auto_vacuum" mode which allows freeing pages step by step
+SQLITE_AUTO_VACUUM_INCREMENTAL = 2
+
+
+def rollup_sessions(sessions):
+    # Summarize sessions per day, court and error before we remove them
+    rollups = {}
+    for session in sessions:
+        key = (session.created_at.date(), session.input_court_code, session.error_type)
+        rollup = rollups.setdefault(key, Counter())
+        rollup["sessions"] += 1
+        rollup["successful_sessions"] += int(session.is_successful)
+        rollup["captcha_sessions"] += int(session.is_captcha)
+        rollup["ignored_cases"] += session.ignored_cases
+
+    for (day, court_code, error_type), counts in rollups.items():
+        query = (
+            db.update(ScrapeSessionRollup)
+            .where(
+                ScrapeSessionRollup.day == day,
+                ScrapeSessionRollup.input_court_code == court_code,
+                ScrapeSessionRollup.error_type == error_type,
+            )
+            .values(
+                **{
+                    name: getattr(ScrapeSessionRollup, name) + value
+                    for name, value in counts.items()
+                }
+            )
+        )
+        if db.session.execute(query).rowcount == 0:
+            query = db.insert(ScrapeSessionRollup).values(
+                day=day,
+                input_court_code=court_code,
+                error_type=error_type,
+                **counts,
+            )
+            db.session.execute(query)
+
+
+def remove_sessions(threshold, batch_size, pause_sec):
+    # Remove sessions which did not change any data in small batches, so we
+    # never hold the write lock for long and ingestion can continue in between
+    has_history = db.select(ScrapeLog.id).where(
+        ScrapeLog.scrape_session_id == ScrapeSession.id
+    )
+    query = (
+        db.select(
+            ScrapeSession.id,
+            ScrapeSession.created_at,
+            ScrapeSession.input_court_code,
+            ScrapeSession.error_type,
+            ScrapeSession.is_successful,
+            ScrapeSession.is_captcha,
+            ScrapeSession.ignored_cases,
+        )
+        .where(
+            ScrapeSession.created_cases == 0,
+            ScrapeSession.updated_cases == 0,
+            ScrapeSession.created_at < threshold,
+            ~has_history.exists(),
+        )
+        .order_by(ScrapeSession.created_at)
+        .limit(batch_size)
+    )
+
+    removed = 0
+    while True:
+        sessions = db.session.execute(query).all()
+        if len(sessions) == 0:
+            break
+
+        started_at = time.monotonic()
+        rollup_sessions(sessions)
+        session_ids = [session.id for session in sessions]
+        for model in (ScrapeSessionDetail, ScrapeSessionProfile):
+            db.session.execute(
+                db.delete(model).where(model.scrape_session_id.in_(session_ids))
+            )
+        db.session.execute(
+            db.delete(ScrapeSession).where(ScrapeSession.id.in_(session_ids))
+        )
+        db.session.commit()
+        metrics.observe(
+            "retention_lock_seconds",
+            time.monotonic() - started_at,
+            table="scrape_sessions",
+        )
+        metrics.incr(
+            "retention_removed_rows_total", len(sessions), table="scrape_sessions"
+        )
+
+        removed += len(sessions)
+        if len(sessions) < batch_size:
+            break
+        time.sleep(pause_sec)
+    return removed
+
+
+# Remove list of visited URLs from a debug message and cut it to a maximum
+# length, the remaining lines still tell us what went wrong
+def compact_debug_message(message, max_length):
+    lines = message.split("\n")
+    urls = [line for line in lines if line.startswith("* ")]
+    lines = [
+        "urls={} (removed)".format(len(urls)) if line == "urls=" else line
+        for line in lines
+        if not line.startswith("* ")
+    ]
+    return "\n".join(lines)[:max_length]
+
+
+def compact_sessions(threshold, batch_size, pause_sec, max_length):
+    # Compact long debug messages of old sessions we're keeping
+    compacted = 0
+    last_id = 0
+    while True:
+        query = (
+            db.select(ScrapeSession.id, ScrapeSession.debug_message)
+            .where(
+                ScrapeSession.id > last_id,
+                ScrapeSession.created_at < threshold,
+                db.func.length(ScrapeSession.debug_message) > max_length,
+            )
+            .order_by(ScrapeSession.id)
+            .limit(batch_size)
+        )
+        sessions = db.session.execute(query).all()
+        if len(sessions) == 0:
+            break
+
+        started_at = time.monotonic()
+        for session in sessions:
+            query = (
+                db.update(ScrapeSession)
+                .where(ScrapeSession.id == session.id)
+                .values(
+                    debug_message=compact_debug_message(
+                        session.debug_message, max_length
+                    )
+                )
+            )
+            db.session.execute(query)
+        db.session.commit()
+        metrics.observe(
+            "retention_lock_seconds",
+            time.monotonic() - started_at,
+            table="scrape_sessions",
+        )
+        metrics.incr(
+            "retention_compacted_rows_total", len(sessions), table="scrape_sessions"
+        )
+
+        compacted += len(sessions)
+        last_id = sessions[-1].id
+        if len(sessions) < batch_size:
+            break
+        time.sleep(pause_sec)
+    return compacted
+
+
+def compact_details(threshold, batch_size, pause_sec, max_length):
+    # Remove visited URLs from the diagnostics of old sessions we're keeping
+    # and cut their messages, which can contain whole unknown pages
+    compacted = 0
+    last_id = 0
+    while True:
+        query = (
+            db.select(ScrapeSessionDetail.id, ScrapeSessionDetail.data)
+            .join(
+                ScrapeSession,
+                ScrapeSession.id == ScrapeSessionDetail.scrape_session_id,
+            )
+            .where(
+                ScrapeSessionDetail.id > last_id,
+                ScrapeSessionDetail.compacted_at.is_(None),
+                ScrapeSession.created_at < threshold,
+            )
+            .order_by(ScrapeSessionDetail.id)
+            .limit(batch_size)
+        )
+        details = db.session.execute(query).all()
+        if len(details) == 0:
+            break
+
+        started_at = time.monotonic()
+        for detail in details:
+            data = unpack_diagnostics(detail.data)
+            fields = dict(data["fields"], removed_urls=len(data["url_ids"]))
+            message = data["message"]
+            if message is not None:
+                message = message[:max_length]
+            query = (
+                db.update(ScrapeSessionDetail)
+                .where(ScrapeSessionDetail.id == detail.id)
+                .values(
+                    data=pack_diagnostics(fields, [], message),
+                    compacted_at=db.func.now(),
+                )
+            )
+            db.session.execute(query)
+        db.session.commit()
+        metrics.observe(
+            "retention_lock_seconds",
+            time.monotonic() - started_at,
+            table="scrape_session_details",
+        )
+        metrics.incr(
+            "retention_compacted_rows_total",
+            len(details),
+            table="scrape_session_details",
+        )
+
+        compacted += len(details)
+        last_id = details[-1].id
+        if len(details) < batch_size:
+            break
+        time.sleep(pause_sec)
+    return compacted
+
+
+def remove_unused_urls(threshold, batch_size, pause_sec):
+    # URLs are only referenced from within the compressed diagnostics, so we
+    # collect the ids still in use and remove all other URLs which were not
+    # used since the threshold. Scrapes mark the URLs they reuse while we're
+    # collecting, so the check is repeated within the delete
+    is_stale = db.func.coalesce(Url.last_used_at, Url.created_at) < threshold
+
+    used = set()
+    last_id = 0
+    while True:
+        query = (
+            db.select(ScrapeSessionDetail.id, ScrapeSessionDetail.data)
+            .where(
+                ScrapeSessionDetail.id > last_id,
+                ScrapeSessionDetail.compacted_at.is_(None),
+            )
+            .order_by(ScrapeSessionDetail.id)
+            .limit(batch_size)
+        )
+        details = db.session.execute(query).all()
+        for detail in details:
+            used.update(unpack_diagnostics(detail.data)["url_ids"])
+        if len(details) < batch_size:
+            break
+        last_id = details[-1].id
+
+    removed = 0
+    last_id = 0
+    while True:
+        query = (
+            db.select(Url.id)
+            .where(Url.id > last_id, is_stale)
+            .order_by(Url.id)
+            .limit(batch_size)
+        )
+        url_ids = db.session.execute(query).scalars().all()
+        if len(url_ids) == 0:
+            break
+
+        unused = [url_id for url_id in url_ids if url_id not in used]
+        if len(unused) > 0:
+            started_at = time.monotonic()
+            result = db.session.execute(
+                db.delete(Url).where(Url.id.in_(unused), is_stale)
+            )
+            db.session.commit()
+            metrics.observe(
+                "retention_lock_seconds", time.monotonic() - started_at, table="urls"
+            )
+            metrics.incr("retention_removed_rows_total", result.rowcount, table="urls")
+            removed += result.rowcount
+
+        last_id = url_ids[-1]
+        if len(url_ids) < batch_size:
+            break
+        if len(unused) > 0:
+            time.sleep(pause_sec)
+    return removed
+
+
+def is_incremental_vacuum():
+    with db.engine.connect() as connection:
+        mode = connection.exec_driver_sql("PRAGMA auto_vacuum").scalar()
+    return mode == SQLITE_AUTO_VACUUM_INCREMENTAL
+
+
+def vacuum(step_pages, pause_sec):
+    # Give space of removed rows back to the file system in small steps, so
+    # writers are only blocked shortly. Only SQLite in incremental mode needs
+    # this, other databases take care of it themselves
+    if db.engine.dialect.name != "sqlite" or not is_incremental_vacuum():
+        return None
+
+    started_at = time.monotonic()
+    freed_pages = 0
+    with db.engine.connect() as connection:
+        connection = connection.execution_options(isolation_level="AUTOCOMMIT")
+        while True:
+            free_pages = connection.exec_driver_sql("PRAGMA freelist_count").scalar()
+            if free_pages == 0:
+                break
+            # Pages are only freed while the pragma is stepped, the driver
+            # steps statements without result columns only once unless they
+            # run as a script
+            connection.connection.driver_connection.executescript(
+                "PRAGMA incremental_vacuum({:d})".format(step_pages)
+            )
+            freed = (
+                free_pages
+                - connection.exec_driver_sql("PRAGMA freelist_count").scalar()
+            )
+            freed_pages += freed
+            if freed <= 0:
+                break
+            time.sleep(pause_sec)
+
+    metrics.observe("retention_vacuum_seconds", time.monotonic() - started_at)
+    metrics.incr("retention_vacuum_freed_pages_total", freed_pages)
+    return freed_pages
+
+
+def full_vacuum():
+    # Rebuild the whole SQLite database and switch it to incremental mode, so
+    # `vacuum` can free pages step by step afterwards. Holds an exclusive lock
+    # on the database until it is done
+    if db.engine.dialect.name != "sqlite":
+        return None
+
+    started_at = time.monotonic()
+    with db.engine.connect() as connection:
+        connection = connection.execution_options(isolation_level="AUTOCOMMIT")
+        free_pages = connection.exec_driver_sql("PRAGMA freelist_count").scalar()
+        connection.exec_driver_sql("PRAGMA auto_vacuum = INCREMENTAL")
+        connection.exec_driver_sql("VACUUM")
+        free_pages -= connection.exec_driver_sql("PRAGMA freelist_count").scalar()
+
+    metrics.observe("retention_vacuum_seconds", time.monotonic() - started_at)
+    metrics.incr("retention_vacuum_freed_pages_total", max(free_pages, 0))
+    return free_pages
@@ -0,0 +1,119 @@
+import random
+import time
+
+from flask import current_app
+
+from . import metrics
+from .scraper import ErrorType
+from .store import get_store, key
+
+# What we're doing when a search failed with one of these errors
+BACKOFF = "backoff"
+COOLDOWN = "cooldown"
+QUARANTINE = "quarantine"
+
+RETRY_POLICIES = {
+    # Usually gone after a while, try again later and wait longer every time
+    ErrorType.SERVER_UNAVAILABLE: BACKOFF,
+    ErrorType.CAPTCHA_FAILED: BACKOFF,
+    ErrorType.UNKNOWN_ERROR: BACKOFF,
+    # Leave the whole host alone for a while, more requests make it worse
+    ErrorType.ACCESS_BLOCKED: COOLDOWN,
+    # Retrying does not help when we can't parse the page, stop scraping
+    # courts failing with this over and over again
+    ErrorType.UNKNOWN_PAGE: QUARANTINE,
+}
+
+
+def backoff_countdown(attempt):
+    # Exponential backoff with jitter, so retries of many courts failing at
+    # the same time don't hit the servers at the same time again
+    config = current_app.config
+    seconds = min(
+        config["SCRAPER_RETRY_BASE_SEC"] * 2**attempt, config["SCRAPER_RETRY_MAX_SEC"]
+    )
+    return random.uniform(seconds / 2, seconds)
+
+
+def host_cooldown(host, store=None):
+    # Returns the seconds left until we may talk to a blocking host again
+    store = store if store is not None else get_store()
+    until = store.get(key("cooldown", host))
+    if until is None:
+        return 0
+    return max(float(until) - time.time(), 0)
+
+
+def start_cooldown(host, store=None):
+    store = store if store is not None else get_store()
+    seconds = current_app.config["SCRAPER_BLOCKED_COOLDOWN_SEC"]
+    store.set(key("cooldown", host), time.time() + seconds, ex=seconds)
+    metrics.incr("scraper_host_cooldowns_total", host=host)
+    return seconds + random.uniform(0, seconds / 10)
+
+
+def is_quarantined(court_code, store=None):
+    store = store if store is not None else get_store()
+    return store.get(key("quarantine", court_code)) is not None
+
+
+def record_unknown_page(court_code, host, store=None):
+    # Quarantine a court after too many searches in a row ended on a page we
+    # could not make sense of
+    config = current_app.config
+    store = store if store is not None else get_store()
+    failures_key = key("unknown_page", court_code)
+    failures = store.incr(failures_key)
+    store.pexpire(failures_key, config["SCRAPER_QUARANTINE_SEC"] * 1000)
+    if failures >= config["SCRAPER_QUARANTINE_AFTER_FAILURES"]:
+        store.set(key("quarantine", court_code), 1, ex=config["SCRAPER_QUARANTINE_SEC"])
+        store.delete(failures_key)
+        metrics.incr("scraper_quarantined_total", host=host)
+
+
+def record_success(court_code, store=None):
+    store = store if store is not None else get_store()
+    store.delete(key("unknown_page", court_code))
+
+
+def release_court(court_code, store=None):
+    store = store if store is not None else get_store()
+    return store.delete(key("quarantine", court_code), key("unknown_page", court_code))
+
+
+def take_retry_budget(store=None):
+    # Retries share a budget per hour, so they never crowd out fresh work
+    store = store if store is not None else get_store()
+    budget_key = key("retry_budget", int(time.time() // 3600))
+    used = store.incr(budget_key)
+    store.pexpire(budget_key, 2 * 3600 * 1000)
+    return used <= current_app.config["SCRAPER_RETRY_BUDGET_PER_HOUR"]
+
+
+# Returns in how many seconds a failed search should be tried again, or
+# `None` when it should not be retried at all
+def retry_countdown(court_code, host, error_type, attempt):
+    config = current_app.config
+    policy = RETRY_POLICIES.get(error_type)
+    labels = {"host": host, "error_type": str(error_type)}
+
+    if policy == QUARANTINE:
+        record_unknown_page(court_code, host)
+        return None
+    elif policy == COOLDOWN:
+        # Other tasks for this host wait for the cooldown as well, even when
+        # we're not retrying this one
+        countdown = start_cooldown(host)
+    elif policy == BACKOFF:
+        countdown = backoff_countdown(attempt)
+    else:
+        return None
+
+    if attempt >= config["SCRAPER_RETRY_MAX_ATTEMPTS"]:
+        metrics.incr("scraper_retries_exhausted_total", **labels)
+        return None
+    if not take_retry_budget():
+        metrics.incr("scraper_retry_budget_exhausted_total", **labels)
+        return None
+    metrics.incr("scraper_retries_total", **labels)
+    return countdown
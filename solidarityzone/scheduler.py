@@ -9,7 +9,8 @@ def celery_init_app(app: Flask) -> Celery:
             with app.app_context():
                 return self.run(*args, **kwargs)
 
-    celery = Celery(app.name, task_cls=FlaskTask)
+    # Tasks pull in the scraper and captcha solver, only the worker loads them
+    celery = Celery(app.name, task_cls=FlaskTask, include=["solidarityzone.tasks"])
     celery.config_from_object(app.config["CELERY"])
     celery.set_default()
     app.extensions["celery"] = celery
@@ -29,6 +30,12 @@ def celery_init_app(app: Flask) -> Celery:
             "schedule": crontab(minute=0, hour=0),
             "args": (),
         },
+        "vacuum-database": {
+            "task": "solidarityzone.tasks.vacuum_database",
+            # Run every sunday after cleaning up sessions
+            "schedule": crontab(minute=0, hour=3, day_of_week=0),
+            "args": (),
+        },
     }
 
     return celery
@@ -1,16 +1,22 @@
 import datetime
+import hashlib
 import math
+import os
 import random
 import re
 import tempfile
+import threading
 import time
 import urllib
+from collections import Counter, deque
+from concurrent.futures import ThreadPoolExecutor
 from enum import Enum
 
 import requests
 from bs4 import BeautifulSoup
 from celery.utils.log import get_task_logger
 
+from . import metrics
 from .captcha import solve_captcha
 from .utils import insert_into_dict
 
@@ -42,12 +48,57 @@ class ErrorType(Enum):
         return self.value
 
 
+class RateLimiter:
+    # Spaces requests to a host by a random interval, shared by all threads
+    # of a scraper
+
+    def __init__(self, min_interval_sec, max_interval_sec):
+        self.min_interval_sec = min_interval_sec
+        self.max_interval_sec = max_interval_sec
+        self.lock = threading.Lock()
+        self.next_at = 0
+
+    def wait(self):
+        with self.lock:
+            now = time.monotonic()
+            seconds = max(self.next_at - now, 0)
+            self.next_at = max(self.next_at, now) + random.uniform(
+                self.min_interval_sec, self.max_interval_sec
+            )
+        if seconds > 0:
+            time.sleep(seconds)
+        return seconds
+
+
 class CourtScraper:
-    def __init__(self, court_code, log=True):
+    def __init__(
+        self,
+        court_code,
+        log=True,
+        archive=None,
+        replay=None,
+        proxy=None,
+        fingerprint=None,
+    ):
         self.logger = None
         if log is True:
             self.logger = get_task_logger(__name__)
         self.court_code = court_code
+        self.host = court_host(court_code)
+        self.request_res = None
+        # Seconds spent waiting for the servers, sleeping, solving captchas or
+        # parsing, number of requests per kind and downloaded bytes
+        self.profile = Counter()
+        # Optionally keep a copy of every fetched page, or answer all requests
+        # from such an archive instead of the court servers
+        self.archive = archive
+        self.replay = replay
+        # Send all requests through this proxy, otherwise use the network of
+        # the worker (for example a VPN)
+        self.proxy = proxy
+        # Result count and page hashes of the previous search, pages which
+        # did not change since then are not parsed again
+        self.fingerprint = fingerprint
         self.translate_dict = {
             "Номер дела ~ материала": "case_number",
             "№ дела": "case_number",
@@ -118,12 +169,105 @@ class CourtScraper:
             elif log_type == "warn":
                 self.logger.warn(message)
 
+    def session(self):
+        s = requests.Session()
+        s.headers = self.headers
+        if self.proxy:
+            s.proxies = {"http": self.proxy, "https": self.proxy}
+        return s
+
+    def delay(self):
+        # Be gentle with the court servers, no need for that when replaying
+        if self.replay is None:
+            seconds = random.randint(MIN_DELAY_SEC, MAX_DELAY_SEC)
+            time.sleep(seconds)
+            self.profile["delay_seconds"] += seconds
+            metrics.incr("scraper_delay_seconds_total", seconds, host=self.host)
+
+    def record_request(self, kind, duration, size, status_code, waited=None):
+        # Concurrent requests overlap, only the time we've actually been
+        # `waited` for them counts for the profile then
+        self.profile["network_seconds"] += duration if waited is None else waited
+        self.profile["bytes"] += size
+        self.profile["{}_requests".format(kind)] += 1
+        metrics.observe("scraper_request_seconds", duration, host=self.host, kind=kind)
+        metrics.incr(
+            "scraper_requests_total", host=self.host, kind=kind, status=status_code
+        )
+        metrics.incr("scraper_downloaded_bytes_total", size, host=self.host, kind=kind)
+
+    def request(self, s, url, kind):
+        started_at = time.monotonic()
+        r = s.get(url=url)
+        self.record_request(
+            kind, time.monotonic() - started_at, len(r.content), r.status_code
+        )
+        return r
+
+    def fetch(self, s, url, kind):
+        if self.replay is not None:
+            return self.replay.get(url=url)
+        r = self.request(s, url, kind)
+        if self.archive is not None:
+            self.archive.store(url, kind, r.text)
+        return r
+
+    def parse(self, page, case_subtype, s):
+        # Measure time spent on parsing a page, without the time we've waited
+        # for case cards in the meantime
+        waited = self.profile["network_seconds"] + self.profile["delay_seconds"]
+        started_at = time.monotonic()
+        result = self.parse_page(page, case_subtype, s)
+        waited = (
+            self.profile["network_seconds"] + self.profile["delay_seconds"] - waited
+        )
+        duration = max(time.monotonic() - started_at - waited, 0)
+        self.profile["parse_seconds"] += duration
+        metrics.observe("scraper_parse_seconds", duration, host=self.host)
+        return result
+
+    def result_rows(self, page):
+        # Returns the part of a search page listing the results
+        pass
+
+    def page_fingerprint(self, page):
+        # Hash only the result rows, the rest of the page changes with every
+        # request (session ids, captchas)
+        rows = self.result_rows(page)
+        if rows is None:
+            return None
+        return hashlib.sha256(re.sub(r"\s+", " ", rows).encode("utf-8")).hexdigest()
+
+    def start_fingerprint(self, n_results):
+        self.request_res["fingerprint"] = {"n_results": n_results, "pages": {}}
+
+    def skip_page(self, page, text):
+        # Remember the fingerprint of this page and tell if it is the same as
+        # during the previous search
+        metrics.incr("scraper_pages_total", host=self.host)
+        current = self.request_res["fingerprint"]
+        if current is None:
+            return False
+        page_fingerprint = self.page_fingerprint(text)
+        current["pages"][str(page)] = page_fingerprint
+        previous = self.fingerprint
+        if (
+            page_fingerprint is None
+            or previous is None
+            or previous["n_results"] != current["n_results"]
+            or previous["pages"].get(str(page)) != page_fingerprint
+        ):
+            return False
+        self.log("Page {} did not change, skip it".format(page))
+        self.request_res["skipped_pages"] += 1
+        metrics.incr("scraper_skipped_pages_total", host=self.host)
+        return True
+
     def parse_search_exception(
         self, text, url, request_res, status_code, captcha_attempts=0
     ):
         if "Данных по запросу не обнаружено" in text:
             self.log("No results")
-            request_res["result"] = []
 
         elif "временно недоступен" in text or "Информация временно недоступна" in text:
             self.log("Server unavailable")
@@ -166,13 +310,47 @@ class CourtScraper:
     def parse_page(self):
         pass
 
-    def get_court_data(self, articles, case_subtype, entry_date, result_date):
+    # Yields the parsed cases page by page, together with the state needed
+    # to continue the search from there. Errors, visited URLs and the number
+    # of results are collected in `self.request_res`
+    def iter_court_data(
+        self,
+        article,
+        case_subtype="Первая инстанция",
+        entry_date={"from": "24.02.2022", "to": ""},
+        result_date={"from": "", "to": ""},
+        checkpoint=None,
+    ):
         pass
 
+    def get_court_data(
+        self,
+        article,
+        case_subtype="Первая инстанция",
+        entry_date={"from": "24.02.2022", "to": ""},
+        result_date={"from": "", "to": ""},
+    ):
+        results = []
+        for items, _ in self.iter_court_data(
+            article, case_subtype, entry_date, result_date
+        ):
+            results.extend(items)
+        self.request_res["result"] = results
+        self.request_res["profile"] = dict(self.profile)
+        return self.request_res
+
 
 class CourtScraperRegion(CourtScraper):
-    def __init__(self, court_code):
-        super().__init__(court_code)
+    def __init__(
+        self, court_code, archive=None, replay=None, proxy=None, fingerprint=None
+    ):
+        super().__init__(
+            court_code,
+            archive=archive,
+            replay=replay,
+            proxy=proxy,
+            fingerprint=fingerprint,
+        )
         self.court_code = court_code
         self.court_url = f"https://{court_code}.sudrf.ru"
 
@@ -216,8 +394,8 @@ class CourtScraperRegion(CourtScraper):
                     res[field] = col_val
 
                 # parse persons from the case card
-                r = s.get(url=res["Карточка дела"])
-                time.sleep(random.randint(MIN_DELAY_SEC, MAX_DELAY_SEC))
+                r = self.fetch(s, res["Карточка дела"], "card")
+                self.delay()
                 text = r.text
                 soup = BeautifulSoup(text, "html.parser")
 
@@ -252,12 +430,178 @@ class CourtScraperRegion(CourtScraper):
                         all_res.append(res_1)
         return all_res
 
-    def get_court_data(
+    def result_rows(self, page):
+        table = re.search("<table[^>]*id=[\"']?tablcont.*?</table>", page, re.S)
+        if table is None:
+            return None
+        return table.group(0)
+
+    def is_results_page(self, text):
+        return re.search("id=[\"']?tablcont", text) is not None
+
+    def page_url(self, court_request_url, request_params, vnkod, page):
+        request_params["vnkod"] = vnkod
+        request_params["page"] = page
+        return court_request_url + urllib.parse.urlencode(
+            request_params, encoding="1251"
+        )
+
+    def search(self, s, court_request_url, url, request_params, request_res):
+        self.log("Make initial request ..")
+        r = self.fetch(s, url, "search")
+        text = r.text
+        captcha_attempts = 0
+        request_params_cap = None
+        while (
+            "Неверно указан проверочный код с картинки" in text
+        ) and captcha_attempts < MAX_CAPTCHA_SOLVE_ATTEMPTS:
+            request_res["is_captcha"] = True
+
+            url = (
+                court_request_url + "name=sud_delo&srv_num=1&name_op=sf&delo_id=1540005"
+            )
+            self.delay()
+            r = self.request(s, url, "captcha")
+
+            # retrieve captcha image and id
+            captcha_page_parsed = BeautifulSoup(r.text, "html.parser")
+            captcha_id_el = captcha_page_parsed.find("input", {"name": "captchaid"})
+            captcha_attempts += 1
+            metrics.incr("scraper_captcha_attempts_total", host=self.host)
+            try:
+                captcha_id = captcha_id_el["value"]
+                captcha_img_url = captcha_id_el.parent.find("img")["src"]
+                captcha_img_url = captcha_img_url.replace(" ", "")
+
+                # download and solve captcha
+                file = tempfile.NamedTemporaryFile(suffix=f"-{self.court_code}.png")
+                captcha_path = file.name
+                started_at = time.monotonic()
+                proxies = {"http": self.proxy, "https": self.proxy}
+                opener = urllib.request.build_opener(
+                    urllib.request.ProxyHandler(proxies if self.proxy else None)
+                )
+                with opener.open(captcha_img_url) as response:
+                    file.write(response.read())
+                file.flush()
+                self.record_request(
+                    "captcha_image",
+                    time.monotonic() - started_at,
+                    os.path.getsize(captcha_path),
+                    200,
+                )
+                started_at = time.monotonic()
+                captcha = solve_captcha(captcha_path)
+                duration = time.monotonic() - started_at
+                self.profile["captcha_seconds"] += duration
+                metrics.observe("scraper_captcha_seconds", duration, host=self.host)
+                file.close()
+
+                request_params_cap = insert_into_dict(
+                    request_params, 12, "captcha", captcha
+                )
+                request_params_cap = insert_into_dict(
+                    request_params_cap, 13, "captchaid", captcha_id
+                )
+
+                url = court_request_url + urllib.parse.urlencode(
+                    request_params_cap, encoding="1251", doseq=True
+                )
+                r = self.fetch(s, url, "search")
+                text = r.text
+                self.log(f"Detected captcha {captcha}")
+                request_res["url"].append(url)
+
+            except Exception as e:
+                self.log(
+                    f" Could not locate and/or retrieve a captcha image from the page. Error text: {e}",
+                    "warn",
+                )
+                text = ""
+
+        if request_params_cap:
+            request_params = request_params_cap.copy()
+
+        return url, r, text, request_params, captcha_attempts
+
+    def parse_pages(
+        self,
+        s,
+        r,
+        court_request_url,
+        request_params,
+        vnkod,
+        first_page,
+        n_pages,
+        case_subtype,
+        request_res,
+    ):
+        # `r` is the response of the first page when we've requested it already
+        for i in range(first_page, n_pages + 1):
+            self.log("Request page {} ..".format(i))
+            url = self.page_url(court_request_url, request_params, vnkod, i)
+            if r is None or i > first_page:
+                self.delay()
+                r = self.fetch(s, url, "search")
+
+            # Stop when the server failed us, a later attempt can continue
+            # from the last completed page
+            if not self.is_results_page(r.text):
+                self.parse_search_exception(r.text, url, request_res, r.status_code)
+                return
+
+            if self.skip_page(i, r.text):
+                results = []
+            else:
+                results = self.parse(r.text, case_subtype, s)
+                self.log("Added {} results".format(len(results)))
+            request_res["n_results"] += len(results)
+            request_res["url"].append(url)
+            yield results, {
+                "vnkod": vnkod,
+                "page": i,
+                "n_pages": n_pages,
+                "request_params": dict(request_params),
+                "cookies": s.cookies.get_dict(),
+            }
+
+    def resume_pages(self, s, court_request_url, checkpoint, case_subtype, request_res):
+        # Continue with the search results of an earlier, interrupted attempt,
+        # this saves us from solving another captcha
+        page = checkpoint["page"] + 1
+        self.log("Resume search at page {} ..".format(page))
+        s.cookies.update(checkpoint["cookies"])
+        request_params = dict(checkpoint["request_params"])
+        url = self.page_url(
+            court_request_url, request_params, checkpoint["vnkod"], page
+        )
+        r = self.fetch(s, url, "search")
+        if not self.is_results_page(r.text):
+            self.log("Could not resume search, start a new one", "warn")
+            s.cookies.clear()
+            return False
+
+        request_res["is_captcha_successful"] = True
+        yield from self.parse_pages(
+            s,
+            r,
+            court_request_url,
+            request_params,
+            checkpoint["vnkod"],
+            page,
+            checkpoint["n_pages"],
+            case_subtype,
+            request_res,
+        )
+        return True
+
+    def iter_court_data(
         self,
         article,
         case_subtype="Первая инстанция",
         entry_date={"from": "24.02.2022", "to": ""},
         result_date={"from": "", "to": ""},
+        checkpoint=None,
     ):
         u_case = self.case_subtypes[case_subtype]
         article_str = ""
@@ -356,117 +700,82 @@ class CourtScraperRegion(CourtScraper):
         url = court_request_url + urllib.parse.urlencode(
             request_params, encoding="1251", doseq=True
         )
-        request_res = {
+        request_res = self.request_res = {
             "error": False,
             "error_type": None,
             "error_debug_message": None,
             "url": [url],
             "is_captcha": False,
             "is_captcha_successful": False,
-            "result": [],
+            "n_results": 0,
+            "fingerprint": None,
+            "skipped_pages": 0,
         }
 
         try:
-            self.log("Make initial request ..")
-            s = requests.Session()
-            s.headers = self.headers
-            r = s.get(url=url)
-            text = r.text
-            captcha_attempts = 0
-            request_params_cap = None
-            while (
-                "Неверно указан проверочный код с картинки" in text
-            ) and captcha_attempts < MAX_CAPTCHA_SOLVE_ATTEMPTS:
-                request_res["is_captcha"] = True
-
-                url = (
-                    court_request_url
-                    + "name=sud_delo&srv_num=1&name_op=sf&delo_id=1540005"
-                )
-                time.sleep(random.randint(MIN_DELAY_SEC, MAX_DELAY_SEC))
-                r = s.get(url=url)
-
-                # retrieve captcha image and id
-                captcha_page_parsed = BeautifulSoup(r.text, "html.parser")
-                captcha_id_el = captcha_page_parsed.find("input", {"name": "captchaid"})
-                captcha_attempts += 1
-                try:
-                    captcha_id = captcha_id_el["value"]
-                    captcha_img_url = captcha_id_el.parent.find("img")["src"]
-                    captcha_img_url = captcha_img_url.replace(" ", "")
-
-                    # download and solve captcha
-                    file = tempfile.NamedTemporaryFile(suffix=f"-{self.court_code}.png")
-                    captcha_path = file.name
-                    urllib.request.urlretrieve(captcha_img_url, captcha_path)
-                    captcha = solve_captcha(captcha_path)
-                    file.close()
-
-                    request_params_cap = insert_into_dict(
-                        request_params, 12, "captcha", captcha
-                    )
-                    request_params_cap = insert_into_dict(
-                        request_params_cap, 13, "captchaid", captcha_id
-                    )
+            s = self.session()
 
-                    url = court_request_url + urllib.parse.urlencode(
-                        request_params_cap, encoding="1251", doseq=True
-                    )
-                    r = s.get(url=url)
-                    text = r.text
-                    self.log(f"Detected captcha {captcha}")
-                    request_res["url"].append(url)
-
-                except Exception as e:
-                    self.log(
-                        f" Could not locate and/or retrieve a captcha image from the page. Error text: {e}",
-                        "warn",
-                    )
-                    text = ""
-
-            if request_params_cap:
-                request_params = request_params_cap.copy()
-
-            re_n_results = (
-                "Всего по запросу найдено — \d+\. На странице записи с 1\s*по \d+\."
-            )
+            resumed = False
+            if checkpoint is not None:
+                resumed = yield from self.resume_pages(
+                    s, court_request_url, checkpoint, case_subtype, request_res
+                )
 
-            if re.search(re_n_results, text):
-                request_res["is_captcha_successful"] = True
-                n_results_text = re.search(re_n_results, text).group(0)
-                n_results, first_page, last_page = re.findall("\d+", n_results_text)
-                n_pages = math.ceil(int(n_results) / int(last_page))
+            if not resumed:
+                url, r, text, request_params, captcha_attempts = self.search(
+                    s, court_request_url, url, request_params, request_res
+                )
 
-                if n_pages > 1:
-                    self.log("Detected {} pages".format(n_pages + 1))
-                    vnkod = re.search("vnkod=\w+&", text).group(0)[6:-1]
+                re_n_results = (
+                    "Всего по запросу найдено — \d+\. На странице записи с 1\s*по \d+\."
+                )
 
-                    for i in range(1, n_pages + 1):
-                        self.log("Request page {} ..".format(i))
-                        request_params["vnkod"] = vnkod
-                        request_params["page"] = i
-                        url = court_request_url + urllib.parse.urlencode(
-                            request_params, encoding="1251"
+                if re.search(re_n_results, text):
+                    request_res["is_captcha_successful"] = True
+                    if captcha_attempts > 0:
+                        metrics.incr("scraper_captcha_solved_total", host=self.host)
+                    n_results_text = re.search(re_n_results, text).group(0)
+                    n_results, first_page, last_page = re.findall("\d+", n_results_text)
+                    n_pages = math.ceil(int(n_results) / int(last_page))
+                    self.start_fingerprint(int(n_results))
+
+                    if n_pages > 1:
+                        self.log("Detected {} pages".format(n_pages + 1))
+                        vnkod = re.search("vnkod=\w+&", text).group(0)[6:-1]
+
+                        # Skip the pages we've already completed during an
+                        # earlier attempt when the results did not change
+                        first_page = 1
+                        if checkpoint is not None and checkpoint["n_pages"] == n_pages:
+                            first_page = checkpoint["page"] + 1
+                            r = None
+
+                        yield from self.parse_pages(
+                            s,
+                            r,
+                            court_request_url,
+                            request_params,
+                            vnkod,
+                            first_page,
+                            n_pages,
+                            case_subtype,
+                            request_res,
                         )
 
-                        # No need to make a request for the first page as we already did that
-                        if i > 1:
-                            time.sleep(random.randint(MIN_DELAY_SEC, MAX_DELAY_SEC))
-                            r = s.get(url=url)
-                        results = self.parse_page(r.text, case_subtype, s)
-                        self.log("Added {} results".format(len(results)))
-                        request_res["result"].extend(results)
+                    else:
+                        if self.skip_page(1, text):
+                            results = []
+                        else:
+                            results = self.parse(text, case_subtype, s)
+                            self.log("Added {} results".format(len(results)))
+                        request_res["n_results"] += len(results)
                         request_res["url"].append(url)
+                        yield results, None
 
                 else:
-                    request_res["result"] = self.parse_page(text, case_subtype, s)
-                    self.log("Added {} results".format(len(request_res["result"])))
-                    request_res["url"].append(url)
-
-            else:
-                request_res = self.parse_search_exception(
-                    text, url, request_res, r.status_code, captcha_attempts
-                )
+                    request_res = self.parse_search_exception(
+                        text, url, request_res, r.status_code, captcha_attempts
+                    )
 
             s.close()
 
@@ -483,22 +792,126 @@ class CourtScraperRegion(CourtScraper):
             request_res["url"].append(url)
 
         request_res["url"] = list(set(request_res["url"]))
-        return request_res
 
 
 class CourtScraperMoscow(CourtScraper):
     # Use the meta search page "mos-gorsud.ru" for scraping cases in Moscow region
     HOST = "www.mos-gorsud.ru"
+    COURT_CODE = "mos-gorsud"
 
-    def __init__(self):
-        super().__init__("mos-gorsud")
+    def __init__(
+        self,
+        archive=None,
+        replay=None,
+        proxy=None,
+        fingerprint=None,
+        card_workers=1,
+        card_min_interval_sec=MIN_DELAY_SEC,
+        card_max_interval_sec=MAX_DELAY_SEC,
+    ):
+        super().__init__(
+            self.COURT_CODE,
+            archive=archive,
+            replay=replay,
+            proxy=proxy,
+            fingerprint=fingerprint,
+        )
         self.court_url = f"https://{self.HOST}"
+        # Case cards are fetched concurrently, but never faster than one card
+        # per interval
+        self.card_workers = card_workers
+        self.rate_limiter = RateLimiter(card_min_interval_sec, card_max_interval_sec)
 
         self.case_subtypes = {
             "Первая инстанция": 1,
             "Апелляционная инстанция": 2,
         }
 
+    def session(self):
+        # One session for the search and all its case cards, keeping a
+        # connection open for every card worker
+        s = super().session()
+        adapter = requests.adapters.HTTPAdapter(pool_maxsize=self.card_workers)
+        s.mount("http://", adapter)
+        s.mount("https://", adapter)
+        return s
+
+    def result_rows(self, page):
+        rows = re.findall("<tr[^>]*>(?:(?!</tr>).)*?detailsLink.*?</tr>", page, re.S)
+        if len(rows) == 0:
+            return None
+        return "".join(rows)
+
+    def get_card(self, s, link):
+        # Runs in a card worker thread, it only talks to the server. Metrics
+        # and the archive need the app context of the calling thread
+        waited = self.rate_limiter.wait()
+        started_at = time.monotonic()
+        r = s.get(url=link)
+        return r, waited, time.monotonic() - started_at
+
+    def is_blocked_card(self, r):
+        # Server answered with a blocked or captcha page instead of the card
+        return "searchDetails" not in r.text and (
+            r.status_code in (403, 429)
+            or "запрос заблокирован по соображениям безопасности" in r.text
+            or "captcha" in r.text.lower()
+        )
+
+    def fetch_cards(self, s, links):
+        # Yields responses for all case cards in order and stops at the first
+        # blocked card, the error is kept in `self.request_res`
+        if self.replay is not None:
+            for link in links:
+                yield link, self.replay.get(url=link)
+            return
+
+        with ThreadPoolExecutor(max_workers=self.card_workers) as executor:
+            # Only submit as many cards as there are workers, so we stop
+            # asking for more once the server started blocking us
+            links = iter(links)
+            futures = deque()
+            for link in links:
+                futures.append((link, executor.submit(self.get_card, s, link)))
+                if len(futures) >= self.card_workers:
+                    break
+            while len(futures) > 0:
+                link, future = futures.popleft()
+                started_at = time.monotonic()
+                r, waited, duration = future.result()
+                blocked = time.monotonic() - started_at
+                delay = min(waited, blocked)
+                self.profile["delay_seconds"] += delay
+                metrics.incr("scraper_delay_seconds_total", waited, host=self.host)
+                self.record_request(
+                    "card",
+                    duration,
+                    len(r.content),
+                    r.status_code,
+                    waited=blocked - delay,
+                )
+                if self.archive is not None:
+                    self.archive.store(link, "card", r.text)
+
+                if self.is_blocked_card(r):
+                    self.log("Case card blocked, stop fetching cards", "warn")
+                    for _, pending in futures:
+                        pending.cancel()
+                    self.request_res["error"] = True
+                    self.request_res["error_type"] = ErrorType.ACCESS_BLOCKED
+                    self.request_res[
+                        "error_debug_message"
+                    ] = "Access to case cards is blocked ({})".format(r.status_code)
+                    self.request_res["url"].append(link)
+                    return
+
+                link_next = next(links, None)
+                if link_next is not None:
+                    futures.append(
+                        (link_next, executor.submit(self.get_card, s, link_next))
+                    )
+                yield link, r
+
     def parse_page(self, page, case_subtype, s):
         all_res = []
         all_urls = []
@@ -510,11 +923,7 @@ class CourtScraperMoscow(CourtScraper):
             if row_link:
                 links.append(self.court_url + row_link.get("href"))
 
-        for link in links:
-            s = requests.Session()
-            s.headers = self.headers
-            time.sleep(random.randint(MIN_DELAY_SEC, MAX_DELAY_SEC))
-            r = s.get(url=link)
+        for link, r in self.fetch_cards(s, links):
             all_urls.append(link)
 
             soup = BeautifulSoup(r.text, "html.parser")
@@ -566,39 +975,47 @@ class CourtScraperMoscow(CourtScraper):
 
         return all_res, all_urls
 
-    def get_court_data(
+    def iter_court_data(
         self,
         article,
         case_subtype="Первая инстанция",
         entry_date={"from": "24.02.2022", "to": ""},
         result_date={"from": "", "to": ""},
+        checkpoint=None,
     ):
         u_case = self.case_subtypes[case_subtype]
         court_request_url = self.court_url + "/search?"
-        url = (
+        # Following pages need the same parameters, otherwise they show the
+        # results of all instances
+        search_url = (
             court_request_url
-            + f"caseDateFrom={entry_date['from']}&codex={article}&instance={u_case}&processType=6&formType=fullForm&page=1"
+            + f"caseDateFrom={entry_date['from']}&codex={article}&instance={u_case}&processType=6&formType=fullForm"
         )
+        url = search_url + "&page=1"
 
-        request_res = {
+        request_res = self.request_res = {
             "error": False,
             "error_type": None,
             "error_debug_message": None,
             "url": [url],
             "is_captcha": False,
             "is_captcha_successful": True,
-            "result": [],
+            "n_results": 0,
+            "fingerprint": None,
+            "skipped_pages": 0,
         }
 
         try:
             self.log("Make initial request ..")
-            s = requests.Session()
-            s.headers = self.headers
-            r = s.get(url=url)
+            s = self.session()
+            r = self.fetch(s, url, "search")
             # r.encoding = "utf-8"  # override encoding manually
             text = r.text
 
             if "По вашему запросу найдено записей" in r.text:
+                n_results = re.search("найдено записей:?\s*(\d+)", text)
+                if n_results is not None:
+                    self.start_fingerprint(int(n_results.group(1)))
                 soup = BeautifulSoup(text, "html.parser")
                 max_page = soup.find("input", {"id": "paginationFormMaxPages"})
 
@@ -606,27 +1023,54 @@ class CourtScraperMoscow(CourtScraper):
                     n_pages = int(max_page.get("value"))
                     self.log("Detected {} pages".format(n_pages + 1))
 
-                    for i in range(1, n_pages + 1):
+                    # Skip the pages we've already completed during an
+                    # earlier attempt when the results did not change
+                    first_page = 1
+                    if checkpoint is not None and checkpoint["n_pages"] == n_pages:
+                        first_page = checkpoint["page"] + 1
+                        self.log("Resume search at page {} ..".format(first_page))
+
+                    for i in range(first_page, n_pages + 1):
                         self.log("Request page {} ..".format(i))
                         if i > 1:
-                            url = (
-                                court_request_url
-                                + f"caseDateFrom={entry_date['from']}&caseDateTo={entry_date['to']}&codex={article}&processType=6&formType=fullForm&page={i}"
-                            )
-                            r = s.get(url=url)
+                            url = search_url + f"&page={i}"
+                            r = self.fetch(s, url, "search")
                             # r.encoding = "utf-8"  # override encoding manually
 
-                        results, urls = self.parse_page(r.text, case_subtype, s)
-                        self.log("Added {} results".format(len(results)))
-
-                        request_res["result"].extend(results)
+                            # Stop when the server failed us, a later attempt
+                            # can continue from the last completed page
+                            if "По вашему запросу найдено записей" not in r.text:
+                                self.parse_search_exception(
+                                    r.text, url, request_res, r.status_code
+                                )
+                                break
+
+                        if self.skip_page(i, r.text):
+                            results, urls = [], []
+                        else:
+                            results, urls = self.parse(r.text, case_subtype, s)
+                            self.log("Added {} results".format(len(results)))
+
+                        # Cards of this page got blocked, a later attempt
+                        # continues with this page
+                        if request_res["error"]:
+                            request_res["url"].extend([url] + urls)
+                            break
+
+                        request_res["n_results"] += len(results)
                         request_res["url"].extend([url] + urls)
+                        yield results, {"page": i, "n_pages": n_pages}
 
                 else:
-                    results, urls = self.parse_page(text, case_subtype, s)
-                    self.log("Added {} results".format(len(request_res["result"])))
-                    request_res["result"] = results
+                    if self.skip_page(1, text):
+                        results, urls = [], []
+                    else:
+                        results, urls = self.parse(text, case_subtype, s)
+                        self.log("Added {} results".format(len(results)))
                     request_res["url"].extend([url] + urls)
+                    if not request_res["error"]:
+                        request_res["n_results"] += len(results)
+                        yield results, None
 
             else:
                 request_res = self.parse_search_exception(
@@ -649,4 +1093,9 @@ class CourtScraperMoscow(CourtScraper):
 
         request_res["url"] = list(set(request_res["url"]))
 
-        return request_res
+
+# Returns the server host name we're talking to when scraping a court
+def court_host(court_code):
+    if court_code == CourtScraperMoscow.COURT_CODE:
+        return CourtScraperMoscow.HOST
+    return "{}.sudrf.ru".format(court_code)
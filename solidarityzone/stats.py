@@ -0,0 +1,225 @@
+from collections import Counter
+
+from sqlalchemy.exc import IntegrityError
+
+from .models import Case, CaseStat, Court, Region, db
+from .utils import parse_articles
+
+# Dimensions we're counting cases by, "all" counts every case once
+DIMENSIONS = ["all", "region", "court", "article", "sub_type", "result"]
+
+# Date fields which can be used to distribute the counts over months
+DATE_FIELDS = ["entry_date", "result_date"]
+
+# Categories of case results, first matching keyword wins
+RESULT_CATEGORIES = [
+    ("приговор", "sentence"),
+    ("прекращ", "terminated"),
+    ("возвращ", "returned"),
+    ("подсудност", "transferred"),
+    ("без изменения", "upheld"),
+    ("отмен", "overturned"),
+    ("измен", "changed"),
+]
+
+
+def result_category(result):
+    if result is None or result.strip() == "":
+        return "pending"
+    result = result.lower()
+    for keyword, category in RESULT_CATEGORIES:
+        if keyword in result:
+            return category
+    return "other"
+
+
+def month(date):
+    if date is None:
+        return ""
+    return date.strftime("%Y-%m")
+
+
+# Returns all statistic keys a case is counted in
+def case_stat_keys(case, court_id, region_id):
+    values = {
+        "all": [""],
+        "region": [str(region_id)],
+        "court": [str(court_id)],
+        "article": list(
+            dict.fromkeys(article for article, _ in parse_articles(case["articles"]))
+        ),
+        "sub_type": [case["sub_type"] or ""],
+        "result": [result_category(case["result"])],
+    }
+    keys = []
+    for date_field in DATE_FIELDS:
+        date_month = month(case[date_field])
+        for dimension in DIMENSIONS:
+            for value in values[dimension]:
+                keys.append((dimension, value, date_field, date_month))
+    return keys
+
+
+class StatChanges:
+    # Collects changes of statistics during ingestion to apply them at once
+
+    def __init__(self):
+        self.changes = Counter()
+
+    def add(self, case, court_id, region_id):
+        self.changes.update(case_stat_keys(case, court_id, region_id))
+
+    def remove(self, case, court_id, region_id):
+        self.changes.subtract(case_stat_keys(case, court_id, region_id))
+
+    def apply(self):
+        # Changes become part of the current transaction, so they get
+        # committed (or rolled back) together with the case itself
+        for key, delta in self.changes.items():
+            if delta != 0:
+                apply_stat_change(key, delta)
+        self.changes.clear()
+
+
+def apply_stat_change(key, delta):
+    dimension, value, date_field, date_month = key
+    query = (
+        db.update(CaseStat)
+        .where(
+            CaseStat.dimension == dimension,
+            CaseStat.value == value,
+            CaseStat.date_field == date_field,
+            CaseStat.month == date_month,
+        )
+        .values(count=CaseStat.count + delta)
+    )
+    if db.session.execute(query).rowcount > 0:
+        return
+    try:
+        # Another worker might insert the same row at the same time, use a
+        # savepoint so we don't lose the rest of the transaction then
+        with db.session.begin_nested():
+            query = db.insert(CaseStat).values(
+                dimension=dimension,
+                value=value,
+                date_field=date_field,
+                month=date_month,
+                count=delta,
+            )
+            db.session.execute(query)
+    except IntegrityError:
+        apply_stat_change(key, delta)
+
+
+def compute_stats():
+    # Count all cases from scratch
+    query = db.select(
+        Case.articles,
+        Case.sub_type,
+        Case.result,
+        Case.entry_date,
+        Case.result_date,
+        Case.court_id,
+        Court.region_id,
+    ).join(Court)
+    changes = StatChanges()
+    for row in db.session.execute(query.execution_options(yield_per=1000)):
+        changes.add(row._asdict(), row.court_id, row.region_id)
+    return Counter({k: v for k, v in changes.changes.items() if v != 0})
+
+
+def stored_stats():
+    query = db.select(
+        CaseStat.dimension,
+        CaseStat.value,
+        CaseStat.date_field,
+        CaseStat.month,
+        CaseStat.count,
+    )
+    return Counter(
+        {
+            (row.dimension, row.value, row.date_field, row.month): row.count
+            for row in db.session.execute(query)
+            if row.count != 0
+        }
+    )
+
+
+# Compares stored statistics with the base tables, returns all keys which
+# differ together with (stored, expected) counts
+def verify_stats():
+    expected = compute_stats()
+    stored = stored_stats()
+    return {
+        key: (stored[key], expected[key])
+        for key in set(expected.keys()) | set(stored.keys())
+        if stored[key] != expected[key]
+    }
+
+
+def rebuild_stats():
+    expected = compute_stats()
+    db.session.execute(db.delete(CaseStat))
+    if len(expected) > 0:
+        db.session.execute(
+            db.insert(CaseStat),
+            [
+                {
+                    "dimension": dimension,
+                    "value": value,
+                    "date_field": date_field,
+                    "month": date_month,
+                    "count": count,
+                }
+                for (
+                    dimension,
+                    value,
+                    date_field,
+                    date_month,
+                ), count in expected.items()
+            ],
+        )
+    db.session.commit()
+    return len(expected)
+
+
+# Returns counts of a dimension per value and month, optionally limited to
+# some values and a range of months ("YYYY-MM", both inclusive)
+def query_stats(dimension, date_field, values=None, month_from=None, month_to=None):
+    query = (
+        db.select(CaseStat.value, CaseStat.month, CaseStat.count)
+        .where(
+            CaseStat.dimension == dimension,
+            CaseStat.date_field == date_field,
+            CaseStat.count != 0,
+        )
+        .order_by(CaseStat.value, CaseStat.month)
+    )
+    if values:
+        query = query.where(CaseStat.value.in_(values))
+    if month_from is not None:
+        query = query.where(CaseStat.month >= month_from)
+    if month_to is not None:
+        query = query.where(CaseStat.month <= month_to)
+
+    items = {}
+    for row in db.session.execute(query):
+        item = items.setdefault(
+            row.value, {"value": row.value, "total": 0, "months": {}}
+        )
+        item["total"] += row.count
+        item["months"][row.month] = row.count
+    return list(items.values())
+
+
+# Returns human-readable names for region and court ids
+def stat_labels(dimension, values):
+    if dimension == "region":
+        model = Region
+    elif dimension == "court":
+        model = Court
+    else:
+        return {}
+    ids = [int(value) for value in values if value.isdigit()]
+    query = db.select(model.id, model.name).where(model.id.in_(ids))
+    return {str(row.id): row.name for row in db.session.execute(query)}
@@ -0,0 +1,229 @@
+import queue
+import threading
+import time
+
+import redis
+from flask import current_app
+
+# Use this URL to keep all shared state inside the current process, this is
+# useful for local development or tests when no Redis instance is running
+MEMORY_URL = "memory://"
+
+# Prefix for all keys we're writing into Redis, the broker shares the database
+KEY_PREFIX = "solidarityzone"
+
+# Expired keys of the in-process store get removed at most this often when
+# writing keys, even when nobody reads them anymore
+MEMORY_SWEEP_INTERVAL_SEC = 60
+
+_clients = {}
+
+
+def key(*parts):
+    return ":".join([KEY_PREFIX] + [str(part) for part in parts])
+
+
+class MemoryPubSub:
+    # Stand-in for a Redis pub/sub connection, receiving messages published
+    # to the same in-process store
+
+    def __init__(self, store):
+        self.store = store
+        self.channels = set()
+        self.messages = queue.Queue()
+
+    def subscribe(self, *channels):
+        with self.store.lock:
+            self.channels.update(channels)
+            self.store.subscribers.add(self)
+
+    def get_message(self, ignore_subscribe_messages=False, timeout=0.0):
+        try:
+            return self.messages.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+    def close(self):
+        with self.store.lock:
+            self.store.subscribers.discard(self)
+
+
+class MemoryStore:
+    # Minimal in-process stand-in for the few Redis commands we use. State is
+    # not shared between processes, so it is only useful with one worker
+
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.values = {}
+        self.expires = {}
+        self.subscribers = set()
+        self.swept_at = time.monotonic()
+
+    def _sweep(self):
+        # Cached responses and counts are keyed by data version, old versions
+        # are never read again and would stay around forever otherwise
+        now = time.monotonic()
+        if now - self.swept_at < MEMORY_SWEEP_INTERVAL_SEC:
+            return
+        self.swept_at = now
+        expired = [name for name, at in self.expires.items() if at <= now]
+        for name in expired:
+            self.values.pop(name, None)
+            self.expires.pop(name, None)
+
+    def _expire(self, name):
+        expires_at = self.expires.get(name)
+        if expires_at is not None and expires_at <= time.monotonic():
+            self.values.pop(name, None)
+            self.expires.pop(name, None)
+
+    def get(self, name):
+        with self.lock:
+            self._expire(name)
+            return self.values.get(name)
+
+    def set(self, name, value, nx=False, px=None, ex=None):
+        with self.lock:
+            self._sweep()
+            self._expire(name)
+            if nx and name in self.values:
+                return None
+            self.values[name] = str(value)
+            self.expires.pop(name, None)
+            if ex is not None:
+                px = ex * 1000
+            if px is not None:
+                self.expires[name] = time.monotonic() + px / 1000
+            return True
+
+    def delete(self, *names):
+        with self.lock:
+            deleted = 0
+            for name in names:
+                self._expire(name)
+                if name in self.values:
+                    deleted += 1
+                self.values.pop(name, None)
+                self.expires.pop(name, None)
+            return deleted
+
+    def pexpire(self, name, px):
+        with self.lock:
+            self._expire(name)
+            if name not in self.values:
+                return False
+            self.expires[name] = time.monotonic() + px / 1000
+            return True
+
+    def incr(self, name, amount=1):
+        with self.lock:
+            self._sweep()
+            self._expire(name)
+            value = int(self.values.get(name, 0)) + amount
+            self.values[name] = str(value)
+            return value
+
+    def incrbyfloat(self, name, amount=1.0):
+        with self.lock:
+            self._expire(name)
+            value = float(self.values.get(name, 0)) + amount
+            self.values[name] = repr(value)
+            return value
+
+    def hincrbyfloat(self, name, field, amount=1.0):
+        with self.lock:
+            fields = self.values.setdefault(name, {})
+            value = float(fields.get(field, 0)) + amount
+            fields[field] = repr(value)
+            return value
+
+    def mget(self, names):
+        return [self.get(name) for name in names]
+
+    def hgetall(self, name):
+        with self.lock:
+            return dict(self.values.get(name, {}))
+
+    def compare_and_delete(self, name, value):
+        with self.lock:
+            self._expire(name)
+            if self.values.get(name) != value:
+                return False
+            self.delete(name)
+            return True
+
+    def compare_and_pexpire(self, name, value, px):
+        with self.lock:
+            self._expire(name)
+            if self.values.get(name) != value:
+                return False
+            return self.pexpire(name, px)
+
+    def publish(self, channel, message):
+        with self.lock:
+            receivers = [
+                pubsub for pubsub in self.subscribers if channel in pubsub.channels
+            ]
+        for pubsub in receivers:
+            pubsub.messages.put(
+                {"type": "message", "channel": channel, "data": str(message)}
+            )
+        return len(receivers)
+
+    def pubsub(self):
+        return MemoryPubSub(self)
+
+
+class RedisStore:
+    # Thin wrapper around a Redis client which adds the atomic helpers the
+    # in-process stand-in offers as well
+
+    COMPARE_AND_DELETE = """
+if redis.call("get", KEYS[1]) == ARGV[1] then
+    return redis.call("del", KEYS[1])
+end
+return 0
+"""
+
+    COMPARE_AND_PEXPIRE = """
+if redis.call("get", KEYS[1]) == ARGV[1] then
+    return redis.call("pexpire", KEYS[1], ARGV[2])
+end
+return 0
+"""
+
+    def __init__(self, url):
+        self.client = redis.Redis.from_url(url, decode_responses=True)
+
+    def __getattr__(self, name):
+        return getattr(self.client, name)
+
+    def compare_and_delete(self, name, value):
+        return bool(self.client.eval(self.COMPARE_AND_DELETE, 1, name, value))
+
+    def compare_and_pexpire(self, name, value, px):
+        return bool(self.client.eval(self.COMPARE_AND_PEXPIRE, 1, name, value, px))
+
+
+def store_url(app=None):
+    if app is None:
+        app = current_app
+    url = app.config.get("REDIS_URL")
+    if url:
+        return url
+    # Fall back to the task queue broker when it is a Redis instance
+    broker_url = app.config["CELERY"].get("broker_url", "")
+    if broker_url.startswith("redis://") or broker_url.startswith("rediss://"):
+        return broker_url
+    return MEMORY_URL
+
+
+# Returns a (cached) client for shared state between web and worker processes
+def get_store(app=None):
+    url = store_url(app)
+    if url not in _clients:
+        if url == MEMORY_URL:
+            _clients[url] = MemoryStore()
+        else:
+            _clients[url] = RedisStore(url)
+    return _clients[url]
@@ -1,13 +1,48 @@
 import datetime
+import random
+import time
 
 from celery import shared_task
 from celery.utils.log import get_task_logger
 from flask import current_app, json
 from sqlalchemy.exc import IntegrityError
 
-from .models import Case, Court, ScrapeLog, ScrapeSession, ScrapeState, db
-from .scraper import CourtScraperMoscow, CourtScraperRegion
-from .utils import group_by
+from . import metrics
+from .archive import ArchiveReplay, get_archive
+from .cache import CASES, SESSIONS, bump_data_version
+from .changes import publish_changes
+from .diagnostics import SessionDiagnostics, store_diagnostics, store_profile
+from .hours import court_timezone, local_hour, pick_courts, record_hour_stat
+from .ingestion import (
+    UPDATEABLE_CASE_FIELDS,
+    case_fingerprint,
+    insert_case_articles,
+    normalize_field,
+)
+from .lease import HostLease
+from .models import (
+    CASE_FINGERPRINT_INDEX,
+    Case,
+    Court,
+    ScrapeCheckpoint,
+    ScrapeLog,
+    ScrapeSession,
+    SearchFingerprint,
+    db,
+)
+from .pools import assign_pool, pool_proxy, pool_queue, record_search
+from .retention import (
+    compact_details,
+    compact_sessions,
+    is_incremental_vacuum,
+    remove_sessions,
+    remove_unused_urls,
+    vacuum,
+)
+from .retry import host_cooldown, is_quarantined, record_success, retry_countdown
+from .scraper import CourtScraperMoscow, CourtScraperRegion, ErrorType, court_host
+from .stats import StatChanges
+from .utils import group_by, parse_articles
 
 logger = get_task_logger(__name__)
 
@@ -51,15 +86,6 @@ CASE_FIELDS = [
     "url",
 ]
 
-UPDATEABLE_CASE_FIELDS = [
-    "effective_date",
-    "judge_name",
-    "result",
-    "result_date",
-]
-
-CLEAN_UP_AFTER_DAYS = 7
-
 
 # Helper method to find out if a case changed
 def get_updated_fields(updated_case, current_case):
@@ -69,23 +95,8 @@ def get_updated_fields(updated_case, current_case):
         return changed_field_names
 
     for field_name in UPDATEABLE_CASE_FIELDS:
-        updated = getattr(updated_case, field_name)
-        current = current_case[field_name]
-
-        # Change format to make date comparison possible
-        if "date" in field_name:
-            if updated is not None:
-                updated = updated.strftime("%d.%m.%Y")
-
-            if current is not None:
-                current = current.strftime("%d.%m.%Y")
-        else:
-            if updated is not None:
-                updated = updated.strip()
-
-            if current is not None:
-                current = current.strip()
-
+        updated = normalize_field(field_name, getattr(updated_case, field_name))
+        current = normalize_field(field_name, current_case[field_name])
         if updated != current:
             changed_field_names.append(field_name)
 
@@ -103,151 +114,245 @@ def calculate_diff(case, updated_fields):
     return json.dumps(case_dict)
 
 
-@shared_task(ignore_result=True)
-def scrape_court(court_code, article, sub_type):
-    with current_app.app_context():
-        # Hard-coded scrape parameters
-        entry_date = {"from": BEGIN_OF_WAR, "to": ""}
-        result_date = {"from": "", "to": ""}
+def get_scraper(court_code, archive=None, replay=None, proxy=None, fingerprint=None):
+    if court_code == ALL_MOSCOW_COURTS:
+        config = current_app.config
+        return CourtScraperMoscow(
+            archive=archive,
+            replay=replay,
+            proxy=proxy,
+            fingerprint=fingerprint,
+            card_workers=config["SCRAPER_MOSCOW_CARD_WORKERS"],
+            card_min_interval_sec=config["SCRAPER_MOSCOW_CARD_MIN_INTERVAL_SEC"],
+            card_max_interval_sec=config["SCRAPER_MOSCOW_CARD_MAX_INTERVAL_SEC"],
+        )
+    return CourtScraperRegion(
+        court_code, archive=archive, replay=replay, proxy=proxy, fingerprint=fingerprint
+    )
 
-        logger.info(
-            "Start scraping with: sub_type='{}', article={}, \
-entry_date={}, court_code={}".format(
-                sub_type, article, BEGIN_OF_WAR, court_code
-            )
+
+# Returns id and fingerprint of a scraped case if it exists already, read from
+# the covering index only. Missing values compare as IS NULL
+def find_case(court_id, item):
+    if db.engine.dialect.name != "sqlite":
+        query = db.select(Case.id, Case.fingerprint).where(
+            Case.court_id == court_id,
+            Case.case_number == item["case_number"],
+            Case.articles == item["articles"],
+            Case.defendant_name == item["defendant_name"],
         )
+        return db.session.execute(query).first()
+
+    # SQLite prefers the unique index, which does not contain the fingerprint,
+    # and would read every case from the table as well
+    query = db.text(
+        "SELECT id, fingerprint FROM cases INDEXED BY "
+        + CASE_FINGERPRINT_INDEX
+        + " WHERE case_number IS :case_number AND court_id = :court_id"
+        + " AND articles IS :articles AND defendant_name IS :defendant_name"
+    )
+    params = {
+        "court_id": court_id,
+        "case_number": item["case_number"],
+        "articles": item["articles"],
+        "defendant_name": item["defendant_name"],
+    }
+    return db.session.execute(query, params).first()
 
-        # Run scraper
-        if court_code == ALL_MOSCOW_COURTS:
-            scraper = CourtScraperMoscow()
-        else:
-            scraper = CourtScraperRegion(court_code)
-        data = scraper.get_court_data(article, sub_type, entry_date, result_date)
-        (
-            error,
-            error_type,
-            error_debug_message,
-            urls,
-            is_captcha,
-            is_captcha_successful,
-            data_items,
-        ) = (
-            data["error"],
-            data["error_type"],
-            data["error_debug_message"],
-            data["url"],
-            data["is_captcha"],
-            data["is_captcha_successful"],
-            data["result"],
+
+class ScrapeError(Exception):
+    # Scraper failed with a known error type, which tells us if and when it
+    # makes sense to try again
+    def __init__(self, message, error_type=None):
+        super().__init__(message)
+        self.error_type = error_type
+
+
+class ResumableScrapeError(ScrapeError):
+    # Scraper failed, but left a checkpoint a later attempt can continue from
+    pass
+
+
+def load_checkpoint(court_code, article, sub_type):
+    query = db.select(ScrapeCheckpoint).where(
+        ScrapeCheckpoint.court_code == court_code,
+        ScrapeCheckpoint.article == article,
+        ScrapeCheckpoint.sub_type == sub_type,
+    )
+    checkpoint = db.session.execute(query).scalars().first()
+    if checkpoint is None:
+        return None
+
+    # Search results expire on the court servers after a while, there's no
+    # point in continuing old ones
+    max_age = datetime.timedelta(
+        seconds=current_app.config["SCRAPER_CHECKPOINT_MAX_AGE_SEC"]
+    )
+    if checkpoint.updated_at < datetime.datetime.utcnow() - max_age:
+        delete_checkpoint(court_code, article, sub_type)
+        return None
+
+    state = json.loads(checkpoint.state)
+    state["page"] = checkpoint.page
+    return state
+
+
+def save_checkpoint(court_code, article, sub_type, state):
+    page = state["page"]
+    state = json.dumps({k: v for k, v in state.items() if k != "page"})
+    query = db.update(ScrapeCheckpoint).where(
+        ScrapeCheckpoint.court_code == court_code,
+        ScrapeCheckpoint.article == article,
+        ScrapeCheckpoint.sub_type == sub_type,
+    )
+    result = db.session.execute(query.values(page=page, state=state))
+    if result.rowcount == 0:
+        query = db.insert(ScrapeCheckpoint).values(
+            court_code=court_code,
+            article=article,
+            sub_type=sub_type,
+            page=page,
+            state=state,
         )
+        db.session.execute(query)
+    db.session.commit()
 
-        # Format debug and error messages
-        debug_message = "court_code={}\narticle={}\nsub_type={}\nis_captcha={}\nis_captcha_successful={}\nerror_type={}\nurls=\n* {}\ndebug_message={}".format(
-            court_code,
-            article,
-            sub_type,
-            is_captcha,
-            is_captcha_successful,
-            error_type,
-            "\n* ".join(urls),
-            error_debug_message,
+
+def delete_checkpoint(court_code, article, sub_type):
+    query = db.delete(ScrapeCheckpoint).where(
+        ScrapeCheckpoint.court_code == court_code,
+        ScrapeCheckpoint.article == article,
+        ScrapeCheckpoint.sub_type == sub_type,
+    )
+    db.session.execute(query)
+    db.session.commit()
+
+
+def load_fingerprint(court_code, article, sub_type):
+    query = db.select(SearchFingerprint).where(
+        SearchFingerprint.court_code == court_code,
+        SearchFingerprint.article == article,
+        SearchFingerprint.sub_type == sub_type,
+    )
+    fingerprint = db.session.execute(query).scalars().first()
+    if fingerprint is None:
+        return None
+    return {
+        "n_results": fingerprint.n_results,
+        "pages": json.loads(fingerprint.pages),
+        "cycles": fingerprint.cycles,
+    }
+
+
+def save_fingerprint(court_code, article, sub_type, fingerprint, cycles):
+    values = {
+        "n_results": fingerprint["n_results"],
+        "pages": json.dumps(fingerprint["pages"]),
+        "cycles": cycles,
+    }
+    query = db.update(SearchFingerprint).where(
+        SearchFingerprint.court_code == court_code,
+        SearchFingerprint.article == article,
+        SearchFingerprint.sub_type == sub_type,
+    )
+    result = db.session.execute(query.values(**values))
+    if result.rowcount == 0:
+        query = db.insert(SearchFingerprint).values(
+            court_code=court_code, article=article, sub_type=sub_type, **values
         )
+        db.session.execute(query)
+    db.session.commit()
 
-        if error and len(data_items) == 0:
-            # Insert scrape session even when it was not successful, it will help us during debugging
-            court = (
-                db.session.execute(db.select(Court).where(Court.code == court_code))
-                .scalars()
-                .first()
-            )
-            if court is not None:
-                court_id = court.id
-            else:
-                court_id = None
-            query = db.insert(ScrapeSession).values(
-                court_id=court_id,
-                input_article=article,
-                input_court_code=court_code,
-                created_cases=0,
-                updated_cases=0,
-                ignored_cases=0,
-                is_successful=not error,
-                is_captcha=is_captcha,
-                is_captcha_successful=is_captcha_successful,
-                error_type=str(error_type),
-                debug_message=debug_message,
-            )
-            db.session.execute(query)
-            db.session.commit()
-            raise Exception("Scraper failed with error_type={}".format(error_type))
 
-        elif error:
-            logger.error(
-                "Scraper failed but found {} data items, error_type={}".format(
-                    len(data_items), error_type
-                )
-            )
-        else:
-            logger.info("Scraper found total {} data items".format(len(data_items)))
+class CaseIngestion:
+    # Creates or updates scraped cases page by page, keeping one scrape
+    # session per court. Sessions get finalized when the scraper is done
 
-        # Group results by court code
-        grouped_by_court = group_by(data_items, "court_code")
-        total_created_cases = 0
-        total_updated_cases = 0
-        total_ignored_cases = 0
-
-        for group in grouped_by_court:
-            group_court_code = group[0]["court_code"]
-
-            # Get court from database
-            court = (
-                db.session.execute(
-                    db.select(Court).where(Court.code == group_court_code)
-                )
-                .scalars()
-                .first()
-            )
-            if court is None:
-                raise Exception(
-                    "Could not find court with code '{}' in database".format(court_code)
-                )
+    def __init__(self, court_code, article, sub_type):
+        self.court_code = court_code
+        self.article = article
+        self.sub_type = sub_type
+        self.sessions = {}
+        self.last_log_id = None
+
+    def get_session(self, court_code):
+        if court_code in self.sessions:
+            return self.sessions[court_code]
 
-            # Insert scrape session with initial values, to be completed later when we're done
-            query = db.insert(ScrapeSession).values(
-                court_id=court.id,
-                input_article=article,
-                input_court_code=court_code,
-                created_cases=0,
-                updated_cases=0,
-                ignored_cases=0,
-                is_successful=not error,
-                is_captcha=is_captcha,
-                is_captcha_successful=is_captcha_successful,
-                error_type=str(error_type),
-                debug_message=debug_message,
+        # Get court from database
+        court = (
+            db.session.execute(db.select(Court).where(Court.code == court_code))
+            .scalars()
+            .first()
+        )
+        if court is None:
+            raise Exception(
+                "Could not find court with code '{}' in database".format(court_code)
             )
-            session_data = db.session.execute(query)
-            session_id = session_data.inserted_primary_key[0]
-            db.session.commit()
+
+        # Insert scrape session with initial values, to be completed later when we're done
+        query = db.insert(ScrapeSession).values(
+            court_id=court.id,
+            input_article=self.article,
+            input_court_code=self.court_code,
+            created_cases=0,
+            updated_cases=0,
+            ignored_cases=0,
+            is_successful=False,
+            is_captcha=False,
+            is_captcha_successful=False,
+            error_type=str(None),
+        )
+        session_data = db.session.execute(query)
+        db.session.commit()
+        bump_data_version(SESSIONS)
+
+        session = {
+            "id": session_data.inserted_primary_key[0],
+            "court_id": court.id,
+            "region_id": court.region_id,
+            "created_cases": 0,
+            "updated_cases": 0,
+            "ignored_cases": 0,
+        }
+        self.sessions[court_code] = session
+        return session
+
+    def ingest(self, items):
+        # Group results by court code
+        for group in group_by(items, "court_code"):
+            session = self.get_session(group[0]["court_code"])
+            session_id = session["id"]
+            court_id = session["court_id"]
+            region_id = session["region_id"]
 
             # Create or update all cases from this court group
-            created_cases = 0
-            updated_cases = 0
-            ignored_cases = 0
+            counters = {
+                action: session[action]
+                for action in ("created_cases", "updated_cases", "ignored_cases")
+            }
             for item in group:
-                # Check if case already exists
-                query = db.select(Case).where(
-                    Case.articles == item["articles"],
-                    Case.case_number == item["case_number"],
-                    Case.defendant_name == item["defendant_name"],
-                    Case.court_id == court.id,
-                )
-                existing_case = db.session.execute(query).scalars().first()
+                fingerprint = case_fingerprint(item)
 
-                # Find out how many fields got changed when case already existed
-                updated_fields = get_updated_fields(existing_case, item)
+                # Check if case already exists
+                existing = find_case(court_id, item)
+
+                # Compare all fields only when the fingerprint changed, cases
+                # without fingerprint get one when nothing changed
+                existing_case = None
+                updated_fields = []
+                if existing is not None and existing.fingerprint != fingerprint:
+                    existing_case = db.session.get(Case, existing.id)
+                    updated_fields = get_updated_fields(existing_case, item)
+                    if len(updated_fields) == 0:
+                        query = (
+                            db.update(Case)
+                            .where(Case.id == existing.id)
+                            .values(fingerprint=fingerprint, updated_at=Case.updated_at)
+                        )
+                        db.session.execute(query)
 
-                if not existing_case:
+                if existing is None:
                     try:
                         # Create new case
                         query = db.insert(Case).values(
@@ -259,12 +364,15 @@ entry_date={}, court_code={}".format(
                             judge_name=item["judge_name"],
                             result=item["result"],
                             result_date=item["result_date"],
-                            court_id=court.id,
-                            sub_type=sub_type,
+                            court_id=court_id,
+                            sub_type=self.sub_type,
                             url=item["url"],
+                            fingerprint=fingerprint,
+                            articles_parsed=len(parse_articles(item["articles"])) > 0,
                         )
                         case_data = db.session.execute(query)
                         case_id = case_data.inserted_primary_key[0]
+                        insert_case_articles(case_id, item["articles"])
 
                         # Keep history of all fields which got created
                         query = db.insert(ScrapeLog).values(
@@ -273,15 +381,39 @@ entry_date={}, court_code={}".format(
                             case_id=case_id,
                             diff=calculate_diff(item, CASE_FIELDS),
                         )
-                        db.session.execute(query)
+                        log_id = db.session.execute(query).inserted_primary_key[0]
+
+                        # Count new case in statistics
+                        stats = StatChanges()
+                        stats.add(
+                            dict(item, sub_type=self.sub_type), court_id, region_id
+                        )
+                        stats.apply()
 
-                        db.session.commit()
-                        created_cases += 1
+                        self.commit()
+                        self.last_log_id = log_id
+                        session["created_cases"] += 1
                     except IntegrityError as err:
                         # Silently ignore duplicate errors, we should have checked for them,
                         # so this is a race condition
+                        db.session.rollback()
                         print(err)
                 elif len(updated_fields) > 0:
+                    # Remember statistics of case before we update it
+                    current_case = {
+                        field_name: getattr(existing_case, field_name)
+                        for field_name in CASE_FIELDS + ["sub_type"]
+                    }
+                    stats = StatChanges()
+                    stats.remove(current_case, court_id, region_id)
+                    stats.add(
+                        dict(
+                            current_case, **{f: item[f] for f in UPDATEABLE_CASE_FIELDS}
+                        ),
+                        court_id,
+                        region_id,
+                    )
+
                     # Update existing case
                     query = (
                         db.update(Case)
@@ -292,6 +424,7 @@ entry_date={}, court_code={}".format(
                             result=item["result"],
                             result_date=item["result_date"],
                             url=item["url"],
+                            fingerprint=fingerprint,
                         )
                     )
                     db.session.execute(query)
@@ -303,45 +436,453 @@ entry_date={}, court_code={}".format(
                         case_id=existing_case.id,
                         diff=calculate_diff(item, updated_fields),
                     )
-                    db.session.execute(query)
+                    log_id = db.session.execute(query).inserted_primary_key[0]
 
-                    db.session.commit()
-                    updated_cases += 1
+                    # Move case to other statistics when result changed
+                    stats.apply()
+
+                    self.commit()
+                    self.last_log_id = log_id
+                    session["updated_cases"] += 1
                 else:
                     # Do nothing
-                    ignored_cases += 1
+                    session["ignored_cases"] += 1
 
-            # Finalize scrape session
+            # Update counters of scrape session after every page, so progress
+            # becomes visible early
             query = (
                 db.update(ScrapeSession)
                 .where(ScrapeSession.id == session_id)
                 .values(
-                    created_cases=created_cases,
-                    updated_cases=updated_cases,
-                    ignored_cases=ignored_cases,
+                    created_cases=session["created_cases"],
+                    updated_cases=session["updated_cases"],
+                    ignored_cases=session["ignored_cases"],
+                )
+            )
+            db.session.execute(query)
+            self.commit()
+
+            for action, count in counters.items():
+                metrics.incr(
+                    "ingestion_cases_total", session[action] - count, action=action
+                )
+
+            # Invalidate cached API responses showing the changed cases and
+            # wake up clients following the changes
+            if (
+                session["created_cases"] > counters["created_cases"]
+                or session["updated_cases"] > counters["updated_cases"]
+            ):
+                bump_data_version(CASES, SESSIONS)
+                publish_changes(self.last_log_id)
+            else:
+                bump_data_version(SESSIONS)
+
+    def commit(self):
+        started_at = time.monotonic()
+        db.session.commit()
+        metrics.observe("ingestion_commit_seconds", time.monotonic() - started_at)
+
+    def finalize(
+        self,
+        error,
+        error_type,
+        is_captcha,
+        is_captcha_successful,
+        diagnostics,
+        profile=None,
+    ):
+        for session in self.sessions.values():
+            query = (
+                db.update(ScrapeSession)
+                .where(ScrapeSession.id == session["id"])
+                .values(
+                    is_successful=not error,
+                    is_captcha=is_captcha,
+                    is_captcha_successful=is_captcha_successful,
+                    error_type=str(error_type),
                 )
             )
             db.session.execute(query)
-            db.session.commit()
+            store_diagnostics(session["id"], diagnostics)
+            if profile is not None:
+                store_profile(session["id"], profile)
+        db.session.commit()
+        bump_data_version(SESSIONS)
+
+    def total(self, counter):
+        return sum(session[counter] for session in self.sessions.values())
+
+
+@shared_task(bind=True, ignore_result=True)
+def scrape_court(
+    self,
+    court_code,
+    article,
+    sub_type,
+    deferred_since=None,
+    deferrals=0,
+    resumes=0,
+    pool=None,
+    retries=0,
+):
+    with current_app.app_context():
+        config = current_app.config
+        host = court_host(court_code)
+
+        # Skip courts whose pages we repeatedly could not parse, and leave
+        # hosts which blocked us alone until they cooled down
+        if is_quarantined(court_code):
+            metrics.incr("scraper_quarantine_skipped_total", host=host)
+            logger.info("Court {} is quarantined, skip task".format(court_code))
+            return None
+        cooldown = host_cooldown(host)
+        if cooldown > 0:
+            metrics.incr("scraper_cooldown_deferred_total", host=host)
+            logger.info("Host {} is cooling down, defer task".format(host))
+            raise self.retry(
+                args=(court_code, article, sub_type),
+                kwargs={
+                    "deferred_since": deferred_since,
+                    "deferrals": deferrals,
+                    "resumes": resumes,
+                    "pool": pool,
+                    "retries": retries,
+                },
+                countdown=cooldown + random.randint(0, 60),
+                max_retries=None,
+            )
+
+        # Make sure we're the only task talking to this court's server right
+        # now, otherwise put the task back into the queue so the worker can
+        # pick up work for other hosts in the meantime
+        lease = HostLease(host, config["SCRAPER_LEASE_TTL_SEC"])
+        if deferred_since is None:
+            deferred_since = time.time()
+        if not lease.acquire():
+            metrics.incr("scraper_lease_deferred_total", host=host)
+            # All searches of a court wait for the same lease, busy courts
+            # can take a long time. Never drop the task, but report it
+            if deferrals == config["SCRAPER_LEASE_WARN_DEFERRALS"]:
+                metrics.incr("scraper_lease_starved_total", host=host)
+                logger.warning(
+                    "Task court_code={}, article={}, sub_type='{}' got deferred \
+{} times, host {} is still busy".format(
+                        court_code, article, sub_type, deferrals, host
+                    )
+                )
+            logger.info("Host {} is busy, defer task".format(host))
+            raise self.retry(
+                args=(court_code, article, sub_type),
+                kwargs={
+                    "deferred_since": deferred_since,
+                    "deferrals": deferrals + 1,
+                    "resumes": resumes,
+                    "pool": pool,
+                    "retries": retries,
+                },
+                countdown=random.randint(
+                    config["SCRAPER_LEASE_MIN_DEFER_SEC"],
+                    config["SCRAPER_LEASE_MAX_DEFER_SEC"],
+                ),
+                max_retries=None,
+            )
+
+        metrics.observe(
+            "scraper_lease_wait_seconds", time.time() - deferred_since, host=host
+        )
+        started_at = time.monotonic()
+        try:
+            result = scrape_and_ingest(court_code, article, sub_type, pool)
+            record_success(court_code)
+            return result
+        except ScrapeError as err:
+            if (
+                isinstance(err, ResumableScrapeError)
+                and resumes < config["SCRAPER_CHECKPOINT_MAX_RESUMES"]
+            ):
+                logger.info("Continue from checkpoint later, {}".format(err))
+                raise self.retry(
+                    args=(court_code, article, sub_type),
+                    kwargs={"resumes": resumes + 1, "pool": pool, "retries": retries},
+                    exc=err,
+                    countdown=config["SCRAPER_CHECKPOINT_RETRY_SEC"],
+                    max_retries=None,
+                )
 
-            # Increase total counters for further analytics
-            total_created_cases = total_created_cases + created_cases
-            total_updated_cases = total_updated_cases + updated_cases
-            total_ignored_cases = total_ignored_cases + ignored_cases
+            # Try again later, depending on what went wrong
+            countdown = retry_countdown(court_code, host, err.error_type, retries)
+            if countdown is None:
+                raise
+            logger.info("Retry in {:.0f}s, {}".format(countdown, err))
+            raise self.retry(
+                args=(court_code, article, sub_type),
+                kwargs={"resumes": resumes, "pool": pool, "retries": retries + 1},
+                exc=err,
+                countdown=countdown,
+                max_retries=None,
+            )
+        finally:
+            lease.release()
+            metrics.observe(
+                "scraper_task_seconds", time.monotonic() - started_at, host=host
+            )
 
+
+def scrape_and_ingest(court_code, article, sub_type, pool=None):
+    host = court_host(court_code)
+
+    # Hard-coded scrape parameters
+    entry_date = {"from": BEGIN_OF_WAR, "to": ""}
+    result_date = {"from": "", "to": ""}
+
+    logger.info(
+        "Start scraping with: sub_type='{}', article={}, \
+entry_date={}, court_code={}".format(
+            sub_type, article, BEGIN_OF_WAR, court_code
+        )
+    )
+
+    # Continue from the last completed page of an earlier attempt
+    checkpoint = load_checkpoint(court_code, article, sub_type)
+    has_checkpoint = checkpoint is not None
+
+    # Skip pages which did not change since the last search, but parse
+    # everything again every couple of cycles
+    fingerprint = load_fingerprint(court_code, article, sub_type)
+    full_pass = (
+        fingerprint is None
+        or fingerprint["cycles"] + 1
+        >= current_app.config["SCRAPER_FINGERPRINT_FULL_PASS_CYCLES"]
+    )
+
+    # Run scraper
+    scraper = get_scraper(
+        court_code,
+        archive=get_archive(court_code, article, sub_type),
+        proxy=pool_proxy(pool),
+        fingerprint=None if full_pass else fingerprint,
+    )
+    pages = scraper.iter_court_data(
+        article, sub_type, entry_date, result_date, checkpoint=checkpoint
+    )
+
+    # Ingest every page as soon as it got parsed and remember how far we got
+    ingestion = CaseIngestion(court_code, article, sub_type)
+    ingest_seconds = 0
+    for items, state in pages:
+        started_at = time.monotonic()
+        ingestion.ingest(items)
+        if state is not None:
+            save_checkpoint(court_code, article, sub_type, state)
+            has_checkpoint = True
+        ingest_seconds += time.monotonic() - started_at
+    data = scraper.request_res
+    profile = dict(scraper.profile, ingest_seconds=ingest_seconds)
+
+    # Keep track of how often a host blocks or fails us
+    metrics.incr("scraper_searches_total", host=host)
+    if data["error"]:
+        metrics.incr(
+            "scraper_errors_total", host=host, error_type=str(data["error_type"])
+        )
+
+    # Learn at which local hours the court servers are doing well
+    timezone = court_timezone(court_code)
+    record_hour_stat(
+        timezone,
+        local_hour(timezone),
+        not data["error"],
+        sum(v for k, v in profile.items() if k.endswith("_requests")),
+        profile["network_seconds"],
+    )
+    if pool is not None:
+        record_search(pool, data["error_type"] == ErrorType.ACCESS_BLOCKED)
+
+    (
+        error,
+        error_type,
+        error_debug_message,
+        urls,
+        is_captcha,
+        is_captcha_successful,
+        n_results,
+    ) = (
+        data["error"],
+        data["error_type"],
+        data["error_debug_message"],
+        data["url"],
+        data["is_captcha"],
+        data["is_captcha_successful"],
+        data["n_results"],
+    )
+
+    # Collect debug and error messages
+    diagnostics = SessionDiagnostics(
+        {
+            "court_code": court_code,
+            "article": article,
+            "sub_type": sub_type,
+            "is_captcha": is_captcha,
+            "is_captcha_successful": is_captcha_successful,
+            "error_type": str(error_type),
+        },
+        urls,
+        error_debug_message,
+    )
+
+    if error and n_results == 0:
+        # Insert scrape session even when it was not successful, it will help us during debugging
+        court = (
+            db.session.execute(db.select(Court).where(Court.code == court_code))
+            .scalars()
+            .first()
+        )
+        if court is not None:
+            court_id = court.id
+        else:
+            court_id = None
+        query = db.insert(ScrapeSession).values(
+            court_id=court_id,
+            input_article=article,
+            input_court_code=court_code,
+            created_cases=0,
+            updated_cases=0,
+            ignored_cases=0,
+            is_successful=not error,
+            is_captcha=is_captcha,
+            is_captcha_successful=is_captcha_successful,
+            error_type=str(error_type),
+        )
+        session_data = db.session.execute(query)
+        store_diagnostics(session_data.inserted_primary_key[0], diagnostics)
+        store_profile(session_data.inserted_primary_key[0], profile)
+        db.session.commit()
+        bump_data_version(SESSIONS)
+        if has_checkpoint:
+            raise ResumableScrapeError(
+                "Scraper failed with error_type={}".format(error_type), error_type
+            )
+        raise ScrapeError(
+            "Scraper failed with error_type={}".format(error_type), error_type
+        )
+
+    elif error:
+        logger.error(
+            "Scraper failed but found {} data items, error_type={}".format(
+                n_results, error_type
+            )
+        )
+    else:
         logger.info(
-            "Successfully scraped page, \
+            "Scraper found total {} data items, skipped {} unchanged pages".format(
+                n_results, data["skipped_pages"]
+            )
+        )
+
+    # Finalize scrape sessions
+    ingestion.finalize(
+        error, error_type, is_captcha, is_captcha_successful, diagnostics, profile
+    )
+    total_created_cases = ingestion.total("created_cases")
+    total_updated_cases = ingestion.total("updated_cases")
+    total_ignored_cases = ingestion.total("ignored_cases")
+
+    logger.info(
+        "Successfully scraped page, \
 created {} new cases, \
 updated {} existing ones and ignored {}".format(
-                total_created_cases, total_updated_cases, total_ignored_cases
-            )
+            total_created_cases, total_updated_cases, total_ignored_cases
         )
+    )
 
-        return {
-            "created_cases": total_created_cases,
-            "updated_cases": total_updated_cases,
-            "ignored_cases": total_ignored_cases,
-        }
+    # Remember what this search looked like when it went through completely
+    if not error and data["fingerprint"] is not None:
+        save_fingerprint(
+            court_code,
+            article,
+            sub_type,
+            data["fingerprint"],
+            0 if full_pass else fingerprint["cycles"] + 1,
+        )
+
+    if error and has_checkpoint:
+        raise ResumableScrapeError(
+            "Scraper failed with error_type={} after {} data items".format(
+                error_type, n_results
+            ),
+            error_type,
+        )
+    elif has_checkpoint:
+        delete_checkpoint(court_code, article, sub_type)
+
+    return {
+        "created_cases": total_created_cases,
+        "updated_cases": total_updated_cases,
+        "ignored_cases": total_ignored_cases,
+    }
+
+
+@shared_task(ignore_result=True)
+def reparse_archive(court_code=None):
+    # Rebuild cases from the archived search result pages and case cards,
+    # without making a single request to the courts
+    archive = get_archive()
+    if archive is None:
+        raise Exception("Archive is not enabled, set SCRAPER_ARCHIVE_PATH")
+
+    pages = [
+        (page.digest, page.court_code, page.article, page.sub_type)
+        for page in archive.latest_pages("search", court_code)
+    ]
+    logger.info("Re-parse {} archived search pages".format(len(pages)))
+
+    # Identical pages (for example the same results seen during multiple
+    # scrape cycles) get parsed and ingested only once
+    parsed_digests = set()
+    ingestions = {}
+    for digest, page_court_code, article, sub_type in pages:
+        if digest in parsed_digests:
+            continue
+        parsed_digests.add(digest)
+
+        scraper = get_scraper(page_court_code, replay=ArchiveReplay(archive))
+        text = archive.load(digest)
+        if page_court_code == ALL_MOSCOW_COURTS:
+            items, _ = scraper.parse_page(text, sub_type, None)
+        else:
+            items = scraper.parse_page(text, sub_type, None)
+
+        key = (page_court_code, article, sub_type)
+        if key not in ingestions:
+            ingestions[key] = CaseIngestion(page_court_code, article, sub_type)
+        ingestions[key].ingest(items)
+
+    for ingestion in ingestions.values():
+        ingestion.finalize(
+            False,
+            None,
+            False,
+            False,
+            SessionDiagnostics(
+                {
+                    "court_code": ingestion.court_code,
+                    "article": ingestion.article,
+                    "sub_type": ingestion.sub_type,
+                },
+                message="Re-parsed from archive",
+            ),
+        )
+
+    logger.info(
+        "Re-parsed {} distinct pages, created {} new cases, updated {} \
+existing ones and ignored {}".format(
+            len(parsed_digests),
+            sum(i.total("created_cases") for i in ingestions.values()),
+            sum(i.total("updated_cases") for i in ingestions.values()),
+            sum(i.total("ignored_cases") for i in ingestions.values()),
+        )
+    )
 
 
 @shared_task(ignore_result=True)
@@ -368,66 +909,89 @@ def scrape_test_courts():
         scrape_all_articles.apply_async((court_code,), retry=False)
 
 
+# Send a scrape task to the queue of the pool this court is assigned to, or
+# to the default queue when there are no pools
+def enqueue_scrape(court_code, article, sub_type):
+    pool = assign_pool(court_code)
+    if pool is None:
+        scrape_court.apply_async((court_code, article, sub_type), retry=False)
+    else:
+        scrape_court.apply_async(
+            (court_code, article, sub_type),
+            {"pool": pool},
+            queue=pool_queue(pool),
+            retry=False,
+        )
+
+
 @shared_task(ignore_result=True)
 def scrape_all_articles(court_code):
     for article in ARTICLES:
         for sub_type in SUB_TYPES:
-            scrape_court.apply_async((court_code, article, sub_type), retry=False)
+            enqueue_scrape(court_code, article, sub_type)
 
 
 @shared_task(ignore_result=True)
 def scrape_next_batch(num_courts):
-    # Use persisted state to identify progress of "batched" scraper
-    query = db.select(ScrapeState).where(ScrapeState.id == 1)
-    state = db.session.scalars(query).first()
-    batch_next_index = 0
-    if state is None:
-        query = db.insert(ScrapeState).values(batch_next_index=0)
-        db.session.execute(query)
-        db.session.commit()
-    else:
-        batch_next_index = state.batch_next_index
-    logger.info("Scrape next batch {}".format(batch_next_index))
-
-    # Take next batch of courts from database and scrape them
-    query = (
-        db.select(Court)
-        .order_by(Court.id.asc())
-        .offset(batch_next_index * num_courts)
-        .limit(num_courts)
+    # Take the courts which waited longest and are in their off-peak hours
+    # right now. Moscow courts are hard-coded and not in the database as they
+    # are a special case, they take their turn like any other court
+    court_codes = pick_courts(num_courts, [ALL_MOSCOW_COURTS])
+    logger.info("Scrape next batch {}".format(", ".join(court_codes)))
+    for court_code in court_codes:
+        scrape_all_articles.apply_async((court_code,), retry=False)
+
+
+@shared_task(ignore_result=True)
+def clean_sessions():
+    # Remove all sessions after some time which did not change data, keep a
+    # daily summary of them and compact debug messages of the others
+    config = current_app.config
+    threshold = datetime.datetime.now() - datetime.timedelta(
+        days=config["RETENTION_AFTER_DAYS"]
     )
-    courts = db.session.scalars(query).all()
-    for court in courts:
-        scrape_all_articles.apply_async((court.code,), retry=False)
-    # Moscow courts are hard-coded and not in the database as they are a
-    # special case, we trigger them here whenever the loop begins again
-    if batch_next_index == 0:
-        scrape_all_articles.apply_async((ALL_MOSCOW_COURTS,), retry=False)
-
-    # Prepare state for next iteration
-    if len(courts) == 0:
-        logger.info("Reset batch counter")
-        batch_next_index = 0
-    else:
-        batch_next_index += 1
-    query = (
-        db.update(ScrapeState)
-        .where(ScrapeState.id == state.id)
-        .values(batch_next_index=batch_next_index)
+    removed = remove_sessions(
+        threshold, config["RETENTION_BATCH_SIZE"], config["RETENTION_BATCH_PAUSE_SEC"]
+    )
+    compacted = compact_sessions(
+        threshold,
+        config["RETENTION_BATCH_SIZE"],
+        config["RETENTION_BATCH_PAUSE_SEC"],
+        config["RETENTION_DEBUG_MESSAGE_MAX_LENGTH"],
+    )
+    compacted += compact_details(
+        threshold,
+        config["RETENTION_BATCH_SIZE"],
+        config["RETENTION_BATCH_PAUSE_SEC"],
+        config["RETENTION_DEBUG_MESSAGE_MAX_LENGTH"],
+    )
+    removed_urls = remove_unused_urls(
+        datetime.datetime.now()
+        - datetime.timedelta(seconds=config["RETENTION_URL_GRACE_SEC"]),
+        config["RETENTION_BATCH_SIZE"],
+        config["RETENTION_BATCH_PAUSE_SEC"],
+    )
+    bump_data_version(SESSIONS)
+    logger.info(
+        "Cleaned up {} scrape sessions and {} URLs, compacted {}".format(
+            removed, removed_urls, compacted
+        )
     )
-    db.session.execute(query)
-    db.session.commit()
 
 
 @shared_task(ignore_result=True)
-def clean_sessions():
-    # Remove all sessions after some time which did not change data
-    threshold = datetime.datetime.now() - datetime.timedelta(days=CLEAN_UP_AFTER_DAYS)
-    query = db.delete(ScrapeSession).where(
-        ScrapeSession.created_cases == 0,
-        ScrapeSession.updated_cases == 0,
-        ScrapeSession.created_at < threshold,
+def vacuum_database():
+    config = current_app.config
+    if db.engine.dialect.name == "sqlite" and not is_incremental_vacuum():
+        logger.warning(
+            "Database is not in incremental vacuum mode, switch it once with \
+`vacuum-database --full`"
+        )
+        return
+    freed_pages = vacuum(
+        config["RETENTION_VACUUM_STEP_PAGES"], config["RETENTION_BATCH_PAUSE_SEC"]
     )
-    result = db.session.execute(query)
-    db.session.commit()
-    logger.info("Cleaned up {} scrape sessions".format(result.rowcount))
+    if freed_pages is None:
+        logger.info("Database does not need to be vacuumed")
+    else:
+        logger.info("Vacuumed database, freed {} pages".format(freed_pages))
@@ -1,10 +1,13 @@
-from itertools import groupby
-from operator import itemgetter
+import re
 
 
-# Helper method to group an array by values
+# Helper method to group an array by values, keeping the order in which the
+# values appeared first. Items with the same value don't need to be adjacent
 def group_by(arr, key):
-    return [[x for x in g] for k, g in groupby(arr, key=itemgetter(key))]
+    groups = {}
+    for item in arr:
+        groups.setdefault(item[key], []).append(item)
+    return list(groups.values())
 
 
 # Helper method to insert key in a certain position in a dict
@@ -23,3 +26,20 @@ def list_to_str(lst: list):
     for i in lst:
         s += chr(i + ord("0"))
     return s
+
+
+# Matches articles of the criminal code like "ст.205.2 ч.2" or "ст. 280 ч. 1"
+ARTICLE_PATTERN = re.compile(r"ст\.?\s*(\d+(?:\.\d+)*)(?:\s*ч\.?\s*(\d+))?", re.I)
+
+
+# Helper method to extract all (article, part) pairs from a raw articles string,
+# part is None when it was not mentioned
+def parse_articles(articles):
+    result = []
+    if articles is None:
+        return result
+    for article, part in ARTICLE_PATTERN.findall(articles):
+        entry = (article, part if part != "" else None)
+        if entry not in result:
+            result.append(entry)
+    return result